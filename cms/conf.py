@@ -57,6 +57,8 @@ class Config(object):
 
         # System-wide
         self.temp_dir = "/tmp"
+        self.file_cache_size = 0
+        self.shared_file_cache = False
         self.backdoor = False
         self.file_log_debug = False
         self.stream_log_detailed = False
@@ -65,14 +67,34 @@ class Config(object):
         self.database = "postgresql+psycopg2://cmsuser@localhost/cms"
         self.database_debug = False
         self.twophase_commit = False
+        self.file_store_dir = None
+
+        # EvaluationService.
+        self.worker_affinity_scheduling = True
+        self.batch_target_duration = 10.0
+        self.full_sweep_interval = 0.0
+        self.queue_journal = True
+        self.reuse_evaluations = False
+        self.lazy_evaluation = False
 
         # Worker.
         self.keep_sandbox = True
         self.use_cgroups = True
         self.sandbox_implementation = 'isolate'
+        self.worker_slots = 1
+        self.worker_pin_slots = False
+        self.worker_sandbox_pool_size = 2
+        self.worker_pipeline_depth = 1
+        self.worker_precache_concurrency = 4
+        self.worker_precache_stagger = 0.0
+        self.compilation_cache_size = 1000
 
         # Sandbox.
         self.max_file_size = 1048576
+        self.max_output_size_factor = 0.0
+        self.max_output_size_slack = 1024
+        self.isolate_num_boxes = 100
+        self.sandbox_link_files = True
 
         # WebServers.
         self.secret_key_default = "8e045a51e4b102ea803c06f92841a1fb"
@@ -29,11 +29,18 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import errno
+import fcntl
 import hashlib
 import io
 import logging
 import os
+import stat
 import tempfile
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import gevent
 
@@ -41,7 +48,8 @@ from sqlalchemy.exc import IntegrityError
 
 from cms import config, mkdir
 from cms.db import SessionGen, FSObject
-from cms.io.GeventUtils import copyfileobj, move, rmtree
+from cms.db.fsobject import LargeObject
+from cms.io.GeventUtils import copyfileobj, rmtree
 
 
 logger = logging.getLogger(__name__)
@@ -55,6 +63,14 @@ class TombstoneError(RuntimeError):
     pass
 
 
+class CorruptedFileError(IOError):
+    """An error raised reading a file whose content does not match its
+    digest.
+
+    """
+    pass
+
+
 class FileCacherBackend(object):
     """Abstract base class for all FileCacher backends.
 
@@ -237,6 +253,9 @@ class DBBackend(FileCacherBackend):
 
             if fso is None:
                 raise KeyError("File not found.")
+            if fso.loid == 0:
+                raise KeyError("File not stored in the database (is "
+                               "file_store_dir configured?).")
 
             return fso.get_lobject(mode='rb')
 
@@ -303,6 +322,9 @@ class DBBackend(FileCacherBackend):
 
             if fso is None:
                 raise KeyError("File not found.")
+            if fso.loid == 0:
+                raise KeyError("File not stored in the database (is "
+                               "file_store_dir configured?).")
 
             with fso.get_lobject(mode='rb') as lobj:
                 return lobj.seek(0, io.SEEK_END)
@@ -346,6 +368,281 @@ class DBBackend(FileCacherBackend):
                 return _list(session)
 
 
+class _VerifiedFile(io.RawIOBase):
+    """A file of the store, checking its content against its digest
+    when it is read until the end.
+
+    """
+
+    def __init__(self, fobj, digest):
+        """Wrap a file.
+
+        fobj (fileobj): the file, open for binary reading.
+        digest (unicode): the expected digest of its content.
+
+        """
+        io.RawIOBase.__init__(self)
+        self._fobj = fobj
+        self._digest = digest
+        self._hasher = hashlib.sha1()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self._fobj.read(size)
+        self._hasher.update(data)
+        if len(data) == 0 or size is None or size < 0:
+            self._check()
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def _check(self):
+        """Raise if the content read does not match the digest.
+
+        raise (CorruptedFileError): if the content does not match.
+
+        """
+        if self._hasher is None:
+            return
+        computed_digest = self._hasher.hexdigest().decode("ascii")
+        self._hasher = None
+        if computed_digest != self._digest:
+            logger.error("File %s in the store actually has hash %s.",
+                         self._digest, computed_digest)
+            raise CorruptedFileError("File %s is corrupted." % self._digest)
+
+    def close(self):
+        if not self.closed:
+            self._fobj.close()
+        io.RawIOBase.close(self)
+
+
+class _StoreWriter(io.RawIOBase):
+    """A file being written in the store, published when closed if
+    its content matches its digest.
+
+    """
+
+    def __init__(self, backend, digest, desc=None):
+        """Start writing a file.
+
+        backend (HybridBackend): the backend storing the file.
+        digest (unicode): the digest of the file.
+        desc (unicode|None): the description of the file, for its
+            FSObject; if None, no FSObject is created.
+
+        """
+        io.RawIOBase.__init__(self)
+        self._backend = backend
+        self._digest = digest
+        self._desc = desc
+        self._hasher = hashlib.sha1()
+        fd, self._temp_path = tempfile.mkstemp(dir=backend.temp_dir)
+        self._fobj = io.open(fd, "wb")
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        self._fobj.write(buf)
+        self._hasher.update(buf)
+        return len(buf)
+
+    def abort(self):
+        """Discard the file written so far."""
+        if self.closed:
+            return
+        self._fobj.close()
+        os.unlink(self._temp_path)
+        io.RawIOBase.close(self)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._fobj.close()
+            self._backend.publish(self._digest, self._temp_path,
+                                  self._hasher.hexdigest().decode("ascii"))
+            if self._desc is not None:
+                self._backend.add_object(self._digest, self._desc)
+        finally:
+            io.RawIOBase.close(self)
+
+
+class HybridBackend(DBBackend):
+    """This class implements a backend for FileCacher that keeps the
+    metadata of the files in the database (as FSObjects) and their
+    content in a directory shared by all the hosts (e.g., on NFS),
+    named after their digests.
+
+    This keeps the database small (and its backups fast). The files
+    stored in the database by DBBackend (as large objects) are moved
+    to the directory the first time they are read. The content of the
+    files is checked against their digest when read.
+
+    """
+
+    def __init__(self, path):
+        """Initialize the backend.
+
+        path (string): the directory of the store, created if needed.
+
+        """
+        self.path = path
+        self.temp_dir = os.path.join(self.path, "_temp")
+        if not mkdir(self.path) or not mkdir(self.temp_dir):
+            logger.error("Cannot create necessary directories.")
+            raise RuntimeError("Cannot create necessary directories.")
+
+    def _get_path(self, digest):
+        """Return the path of a file in the store.
+
+        The files are split among subdirectories, to keep them small.
+
+        digest (unicode): the digest of the file.
+
+        return (string): the path of the file.
+
+        """
+        return os.path.join(self.path, digest[:2], digest)
+
+    def publish(self, digest, temp_path, computed_digest):
+        """Move a file just written to its place in the store.
+
+        digest (unicode): the expected digest of the file.
+        temp_path (string): where the file was written.
+        computed_digest (unicode): the digest of its content.
+
+        raise (CorruptedFileError): if the digests differ.
+
+        """
+        if computed_digest != digest:
+            os.unlink(temp_path)
+            raise CorruptedFileError("File %s actually has hash %s." %
+                                     (digest, computed_digest))
+        os.chmod(temp_path, FileCacher.CACHE_FILE_MODE)
+        mkdir(os.path.dirname(self._get_path(digest)))
+        # Atomic, hence readers see either nothing or the whole file.
+        os.rename(temp_path, self._get_path(digest))
+
+    def add_object(self, digest, desc):
+        """Create the FSObject of a file just stored.
+
+        digest (unicode): the digest of the file.
+        desc (unicode): the description of the file.
+
+        """
+        try:
+            with SessionGen() as session:
+                fso = FSObject(description=desc)
+                fso.digest = digest
+                session.add(fso)
+                session.commit()
+        except IntegrityError:
+            logger.warning("File %s caused an IntegrityError, ignoring...",
+                           digest)
+
+    def _move_from_database(self, digest):
+        """Move a file from a large object to the store.
+
+        Another service may be moving the same file: if it completes
+        the move first (deleting the large object), the file is found
+        in the store.
+
+        digest (unicode): the digest of the file.
+
+        raise (KeyError): if the file is in neither.
+
+        """
+        with SessionGen() as session:
+            fso = FSObject.get_from_digest(digest, session)
+            loid = fso.loid if fso is not None else 0
+        if loid == 0:
+            if os.path.exists(self._get_path(digest)):
+                return
+            raise KeyError("File not found.")
+
+        logger.info("Moving file %s from the database to the store.", digest)
+        writer = _StoreWriter(self, digest)
+        try:
+            lobj = LargeObject(loid, mode='rb')
+            try:
+                copyfileobj(lobj, writer, FileCacher.CHUNK_SIZE,
+                            FileCacher.MAX_CHUNK_SIZE)
+            finally:
+                lobj.close()
+        except Exception:
+            writer.abort()
+            if os.path.exists(self._get_path(digest)):
+                logger.info("File %s was moved to the store by another "
+                            "service.", digest)
+                return
+            raise
+        writer.close()
+
+        # Only one of the services moving the file at the same time
+        # deletes the large object.
+        with SessionGen() as session:
+            moved = session.query(FSObject)\
+                .filter(FSObject.digest == digest)\
+                .filter(FSObject.loid == loid)\
+                .update({FSObject.loid: 0}, synchronize_session=False)
+            session.commit()
+        if moved > 0:
+            LargeObject.unlink(loid)
+
+    def get_file(self, digest):
+        """See FileCacherBackend.get_file().
+
+        raise (CorruptedFileError): when the file is read until the
+            end, if its content does not match the digest.
+
+        """
+        try:
+            return _VerifiedFile(io.open(self._get_path(digest), "rb"),
+                                 digest)
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        self._move_from_database(digest)
+        return _VerifiedFile(io.open(self._get_path(digest), "rb"), digest)
+
+    def put_file(self, digest, desc=""):
+        """See FileCacherBackend.put_file().
+
+        """
+        with SessionGen() as session:
+            if FSObject.get_from_digest(digest, session) is not None:
+                logger.debug("File %s already stored, not sending it "
+                             "again.", digest)
+                return None
+        return _StoreWriter(self, digest, desc)
+
+    def get_size(self, digest):
+        """See FileCacherBackend.get_size().
+
+        """
+        try:
+            return os.path.getsize(self._get_path(digest))
+        except OSError:
+            return DBBackend.get_size(self, digest)
+
+    def delete(self, digest):
+        """See FileCacherBackend.delete().
+
+        """
+        DBBackend.delete(self, digest)
+        try:
+            os.unlink(self._get_path(digest))
+        except OSError:
+            pass
+
+
 class NullBackend(FileCacherBackend):
     """This backend is always empty, it just drops each file that
     receives. It looks mostly like /dev/null. It is useful when you
@@ -373,6 +670,198 @@ class NullBackend(FileCacherBackend):
         return list()
 
 
+class CacheIndex(object):
+    """The files of a local cache, by recency of use.
+
+    The index allows to keep the cache within a maximum size, deleting
+    the least recently used files. The recency of the files is stored
+    as their modification time, which is updated when they are used,
+    so that it is not lost when the service restarts.
+
+    Deleting a file from the cache is safe even if a sandbox is using
+    it: files already opened or hard linked elsewhere are only
+    unlinked from the cache directory, and they are loaded again from
+    the backend when needed.
+
+    """
+
+    def __init__(self, path, size, rescan_interval=None):
+        """Index the files of a cache directory.
+
+        path (string): the directory of the cache.
+        size (int): the maximum total size of the files, in bytes; 0
+            means no limit.
+        rescan_interval (float|None): if the directory is shared with
+            other processes, how often (in seconds) to index it again
+            to see the files they added, used and deleted.
+
+        """
+        self.path = path
+        self.size = size
+        self.rescan_interval = rescan_interval
+        # Number of files deleted to make room for others.
+        self.evictions = 0
+        # Size of the files, the least recently used first.
+        # Type: OrderedDict{unicode: int}
+        self._files = OrderedDict()
+        self._total_size = 0
+        self._last_scan = None
+        self._scan()
+
+    def _scan(self):
+        """Rebuild the index from the content of the directory."""
+        self._files.clear()
+        self._total_size = 0
+        self._last_scan = time.time()
+        entries = []
+        for filename in os.listdir(self.path):
+            try:
+                file_stat = os.stat(os.path.join(self.path, filename))
+            except OSError:
+                continue
+            # Skip the directory of temporary files.
+            if stat.S_ISREG(file_stat.st_mode):
+                entries.append(
+                    (file_stat.st_mtime, filename, file_stat.st_size))
+                # Files cached by older versions may have other
+                # permissions; the new ones get them when stored.
+                if stat.S_IMODE(file_stat.st_mode) != \
+                        FileCacher.CACHE_FILE_MODE:
+                    try:
+                        os.chmod(os.path.join(self.path, filename),
+                                 FileCacher.CACHE_FILE_MODE)
+                    except OSError:
+                        pass
+        for unused_mtime, filename, size in sorted(entries):
+            self._files[filename] = size
+            self._total_size += size
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, digest):
+        return digest in self._files
+
+    def get_total_size(self):
+        """Return the total size of the files in the cache.
+
+        return (int): the size in bytes.
+
+        """
+        return self._total_size
+
+    def touch(self, digest):
+        """Mark a file of the cache as just used.
+
+        digest (unicode): the digest of the file.
+
+        """
+        try:
+            os.utime(os.path.join(self.path, digest), None)
+        except OSError:
+            # Deleted behind our back.
+            self.remove(digest)
+            return
+        if digest in self._files:
+            self._files[digest] = self._files.pop(digest)
+        else:
+            self.add(digest)
+
+    def add(self, digest):
+        """Add a file just stored in the cache, and make room for it.
+
+        digest (unicode): the digest of the file.
+
+        """
+        if self.rescan_interval is not None \
+                and time.time() - self._last_scan > self.rescan_interval:
+            self._scan()
+        try:
+            size = os.stat(os.path.join(self.path, digest)).st_size
+        except OSError:
+            return
+        self.remove(digest)
+        self._files[digest] = size
+        self._total_size += size
+        self._evict()
+
+    def remove(self, digest):
+        """Forget a file deleted from the cache.
+
+        digest (unicode): the digest of the file.
+
+        """
+        if digest in self._files:
+            self._total_size -= self._files.pop(digest)
+
+    def clear(self):
+        """Forget all files."""
+        self._files.clear()
+        self._total_size = 0
+
+    def _evict(self):
+        """Delete the least recently used files exceeding the size.
+
+        The most recently used file is never deleted, even if it is
+        larger than the maximum size by itself. Files hard linked
+        elsewhere (i.e., in the sandboxes) are not deleted, as that
+        would not free any space: they are in use, hence they are
+        marked as the most recently used, after the one just added.
+
+        """
+        if self.size <= 0 or self._total_size <= self.size:
+            return
+        last_digest = next(reversed(self._files))
+        while self._total_size > self.size:
+            digest = next(iter(self._files))
+            if digest == last_digest:
+                break
+            path = os.path.join(self.path, digest)
+            try:
+                linked = os.stat(path).st_nlink > 1
+            except OSError:
+                # Deleted by another process sharing the cache.
+                self.remove(digest)
+                continue
+            if linked:
+                self._files[digest] = self._files.pop(digest)
+                continue
+            self.remove(digest)
+            logger.debug("Evicting file %s from the cache.", digest)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            else:
+                self.evictions += 1
+
+
+# The indices of the cache directories used by this process, shared by
+# all the FileCacher instances using the same directory (as the slots
+# of a Worker do).
+_cache_indices = {}
+
+# How often (in seconds) the index of a cache shared by the services
+# of the host is rebuilt.
+CACHE_RESCAN_INTERVAL = 60.0
+
+
+def get_cache_index(path, shared=False):
+    """Return the index of a cache directory, creating it if needed.
+
+    path (string): the directory of the cache.
+    shared (bool): whether other processes use the directory too.
+
+    return (CacheIndex): the index of the directory.
+
+    """
+    if path not in _cache_indices:
+        _cache_indices[path] = CacheIndex(
+            path, config.file_cache_size * 1024 * 1024,
+            CACHE_RESCAN_INTERVAL if shared else None)
+    return _cache_indices[path]
+
+
 class FileCacher(object):
     """This class implement a local cache for files stored as FSObject
     in the database.
@@ -393,19 +882,35 @@ class FileCacher(object):
     # CHUNK_SIZE should be a multiple of these values.
     CHUNK_SIZE = 2 ** 14  # 16348
 
+    # When copying files between the cache and the backend, the size
+    # of the chunks grows from CHUNK_SIZE up to this value, to limit
+    # the number of queries needed for large files in the database.
+    MAX_CHUNK_SIZE = 2 ** 22
+
     # The fake digest used to mark a file as deleted in the backend.
     TOMBSTONE_DIGEST = "x"
 
+    # The permissions of the files in the cache: they are never
+    # modified, and sandboxes may hard link them (see
+    # get_file_cache_path).
+    CACHE_FILE_MODE = 0444
+
+    # How often (in seconds) to check whether another process
+    # finished loading a file we are waiting for.
+    LOCK_POLL_INTERVAL = 0.05
+
     def __init__(self, service=None, path=None, null=False):
         """Initialize.
 
-        By default the database-powered backend will be used, but this
-        can be changed using the parameters.
+        By default the database-powered backend will be used (keeping
+        the content of the files in file_store_dir, if configured),
+        but this can be changed using the parameters.
 
         service (Service|None): the service we are running for. Only
             used if present to determine the location of the
             file-system cache (and to provide the shard number to the
-            Sandbox... sigh!).
+            Sandbox... sigh!). If the configuration asks for it, the
+            cache is shared by all the services of the host.
         path (string|None): if specified, back the FileCacher with a
             file system-based storage instead of the default
             database-based one. The specified directory will be used
@@ -420,25 +925,99 @@ class FileCacher(object):
 
         if null:
             self.backend = NullBackend()
+        elif path is None and config.file_store_dir is not None:
+            self.backend = HybridBackend(config.file_store_dir)
         elif path is None:
             self.backend = DBBackend()
         else:
             self.backend = FSBackend(path)
 
+        shared = service is not None and config.shared_file_cache
         if service is None:
             self.file_dir = tempfile.mkdtemp(dir=config.temp_dir)
+        elif shared:
+            self.file_dir = os.path.join(config.cache_dir, "fs-cache-shared")
         else:
             self.file_dir = os.path.join(
                 config.cache_dir,
                 "fs-cache-%s-%d" % (service.name, service.shard))
 
         self.temp_dir = os.path.join(self.file_dir, "_temp")
+        self.lock_dir = os.path.join(self.file_dir, "_locks")
 
         if not mkdir(config.cache_dir) or not mkdir(config.temp_dir) \
-                or not mkdir(self.file_dir) or not mkdir(self.temp_dir):
+                or not mkdir(self.file_dir) or not mkdir(self.temp_dir) \
+                or not mkdir(self.lock_dir):
             logger.error("Cannot create necessary directories.")
             raise RuntimeError("Cannot create necessary directories.")
 
+        self.index = get_cache_index(self.file_dir, shared)
+
+        # Statistics on the files requested to this instance: those
+        # found in the cache ("hits"), those downloaded from the
+        # backend ("misses") and their size ("downloaded_bytes"), and
+        # those downloaded by another process or greenlet while we
+        # were waiting for them ("waits").
+        self.stats = {"hits": 0, "misses": 0, "waits": 0,
+                      "downloaded_bytes": 0}
+
+    def get_stats(self):
+        """Return the statistics on the files requested so far.
+
+        return (dict): see the stats attribute; "evictions" is the
+            number of files this process deleted from the cache.
+
+        """
+        stats = dict(self.stats)
+        stats["evictions"] = self.index.evictions
+        return stats
+
+    @contextmanager
+    def _load_lock(self, digest):
+        """Hold the exclusive right to load a file into the cache.
+
+        The lock is a file locked with flock, so it works among the
+        greenlets of a process as well as among the services sharing
+        the cache. The lock file is deleted on release; whoever was
+        waiting on it retries on a new one.
+
+        digest (unicode): the digest of the file.
+
+        """
+        lock_path = os.path.join(self.lock_dir, digest)
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+            try:
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except IOError as error:
+                        if error.errno not in [errno.EAGAIN, errno.EACCES]:
+                            raise
+                    gevent.sleep(FileCacher.LOCK_POLL_INTERVAL)
+                # The lock file may have been deleted by its previous
+                # holder while we were waiting.
+                try:
+                    acquired = \
+                        os.fstat(fd).st_ino == os.stat(lock_path).st_ino
+                except OSError:
+                    acquired = False
+            except:
+                os.close(fd)
+                raise
+            if acquired:
+                break
+            os.close(fd)
+        try:
+            yield
+        finally:
+            try:
+                os.unlink(lock_path)
+            except OSError:
+                pass
+            os.close(fd)
+
     def load(self, digest, if_needed=False):
         """Load the file with the given digest into the cache.
 
@@ -457,24 +1036,48 @@ class FileCacher(object):
             raise TombstoneError()
         cache_file_path = os.path.join(self.file_dir, digest)
         if if_needed and os.path.exists(cache_file_path):
+            self.index.touch(digest)
+            self.stats["hits"] += 1
             return
 
-        ftmp_handle, temp_file_path = tempfile.mkstemp(dir=self.temp_dir,
-                                                       text=False)
-        ftmp = os.fdopen(ftmp_handle, 'w')
+        # Only one among the greenlets and the services sharing the
+        # cache downloads the file, the others wait for it.
+        with self._load_lock(digest):
+            if if_needed and os.path.exists(cache_file_path):
+                self.index.touch(digest)
+                self.stats["waits"] += 1
+                return
 
-        fobj = self.backend.get_file(digest)
+            logger.debug("File %s not in cache, downloading "
+                         "from backend.", digest)
+            ftmp_handle, temp_file_path = tempfile.mkstemp(
+                dir=self.temp_dir, text=False)
+            ftmp = os.fdopen(ftmp_handle, 'w')
 
-        # Copy the file to a temporary position
-        try:
-            copyfileobj(fobj, ftmp, self.CHUNK_SIZE)
-        finally:
-            ftmp.close()
-            fobj.close()
+            try:
+                fobj = self.backend.get_file(digest)
+            except:
+                ftmp.close()
+                os.unlink(temp_file_path)
+                raise
 
-        # Then move it to its real location (this operation is atomic
-        # by POSIX requirement)
-        os.rename(temp_file_path, cache_file_path)
+            # Copy the file to a temporary position
+            try:
+                copyfileobj(fobj, ftmp, self.CHUNK_SIZE,
+                            self.MAX_CHUNK_SIZE)
+            finally:
+                ftmp.close()
+                fobj.close()
+            os.chmod(temp_file_path, FileCacher.CACHE_FILE_MODE)
+            self.stats["misses"] += 1
+            self.stats["downloaded_bytes"] += \
+                os.path.getsize(temp_file_path)
+
+            # Then move it to its real location (this operation is
+            # atomic by POSIX requirement, so other processes see
+            # either nothing or the whole file)
+            os.rename(temp_file_path, cache_file_path)
+            self.index.add(digest)
 
     def get_file(self, digest):
         """Retrieve a file from the storage.
@@ -502,15 +1105,47 @@ class FileCacher(object):
 
         logger.debug("Getting file %s.", digest)
 
-        if not os.path.exists(cache_file_path):
-            logger.debug("File %s not in cache, downloading "
-                         "from database.", digest)
+        self.load(digest, if_needed=True)
+        try:
+            return io.open(cache_file_path, 'rb')
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            # Evicted by another process sharing the cache.
+            self.load(digest, if_needed=True)
+            return io.open(cache_file_path, 'rb')
+
+    def is_cached(self, digest):
+        """Return whether a file is in the local cache.
+
+        digest (unicode): the digest of the file.
 
-            self.load(digest)
+        return (bool): True if the file can be read without asking
+            the backend.
 
-            logger.debug("File %s downloaded.", digest)
+        """
+        return os.path.exists(os.path.join(self.file_dir, digest))
+
+    def get_file_cache_path(self, digest):
+        """Return the path of a file in the local cache.
 
-        return io.open(cache_file_path, 'rb')
+        The file is loaded in the cache if needed. The caller can read
+        it or link it elsewhere, but must not modify it (the file is
+        read-only, hence it cannot be modified by other users).
+
+        digest (unicode): the digest of the file to get.
+
+        return (string): the path of the file in the cache.
+
+        raise (KeyError): if the file cannot be found.
+        raise (TombstoneError): if the digest is the tombstone
+
+        """
+        if digest == FileCacher.TOMBSTONE_DIGEST:
+            raise TombstoneError()
+        cache_file_path = os.path.join(self.file_dir, digest)
+        self.load(digest, if_needed=True)
+        return cache_file_path
 
     def get_file_content(self, digest):
         """Retrieve a file from the storage.
@@ -593,7 +1228,8 @@ class FileCacher(object):
 
         try:
             with io.open(cache_file_path, 'rb') as src:
-                copyfileobj(src, fobj, self.CHUNK_SIZE)
+                copyfileobj(src, fobj, self.CHUNK_SIZE,
+                            self.MAX_CHUNK_SIZE)
         finally:
             fobj.close()
 
@@ -619,13 +1255,13 @@ class FileCacher(object):
 
         # Unfortunately, we have to read the whole file-obj to compute
         # the digest but we take that chance to save it to a temporary
-        # path so that we then just need to move it. Hoping that both
-        # locations will be on the same filesystem, that should be way
-        # faster than reading the whole file-obj again (as it could be
-        # compressed or require network communication).
+        # path so that we then just need to move it. Being in the same
+        # directory as the cache, the move is an atomic rename, and it
+        # is way faster than reading the whole file-obj again (as it
+        # could be compressed or require network communication).
         # XXX We're *almost* reimplementing copyfileobj.
         with tempfile.NamedTemporaryFile('wb', delete=False,
-                                         dir=config.temp_dir) as dst:
+                                         dir=self.temp_dir) as dst:
             hasher = hashlib.sha1()
             buf = src.read(self.CHUNK_SIZE)
             while len(buf) > 0:
@@ -646,9 +1282,12 @@ class FileCacher(object):
             cache_file_path = os.path.join(self.file_dir, digest)
 
             if not os.path.exists(cache_file_path):
-                move(dst.name, cache_file_path)
+                os.chmod(dst.name, FileCacher.CACHE_FILE_MODE)
+                os.rename(dst.name, cache_file_path)
+                self.index.add(digest)
             else:
                 os.unlink(dst.name)
+                self.index.touch(digest)
 
         # Store the file in the backend. We do that even if the file
         # was already in the cache (that is, we ignore the check above)
@@ -746,13 +1385,15 @@ class FileCacher(object):
             os.unlink(cache_file_path)
         except OSError:
             pass
+        self.index.remove(digest)
 
     def purge_cache(self):
         """Empty the local cache.
 
         """
         self.destroy_cache()
-        if not mkdir(config.cache_dir) or not mkdir(self.file_dir):
+        if not mkdir(config.cache_dir) or not mkdir(self.file_dir) \
+                or not mkdir(self.temp_dir) or not mkdir(self.lock_dir):
             logger.error("Cannot create necessary directories.")
             raise RuntimeError("Cannot create necessary directories.")
 
@@ -764,6 +1405,7 @@ class FileCacher(object):
 
         """
         rmtree(self.file_dir)
+        self.index.clear()
 
     def list(self):
         """List the files available in the storage.
@@ -793,10 +1435,16 @@ class FileCacher(object):
             fobj = self.backend.get_file(digest)
             hasher = hashlib.sha1()
             try:
-                buf = fobj.read(self.CHUNK_SIZE)
+                size = self.CHUNK_SIZE
+                buf = fobj.read(size)
                 while len(buf) > 0:
                     hasher.update(buf)
-                    buf = fobj.read(self.CHUNK_SIZE)
+                    size = min(size * 2, self.MAX_CHUNK_SIZE)
+                    buf = fobj.read(size)
+            except CorruptedFileError:
+                # Raised by the backend after returning all the
+                # content, which we check below.
+                pass
             finally:
                 fobj.close()
             computed_digest = hasher.hexdigest().decode("ascii")
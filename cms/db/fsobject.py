@@ -75,6 +75,12 @@ class LargeObject(io.RawIOBase):
     INV_READ = 0x40000
     INV_WRITE = 0x20000
 
+    # The largest amount of data readall() transfers with a single
+    # query; it starts from io.DEFAULT_BUFFER_SIZE and doubles at each
+    # query, so that small objects are read with few short queries
+    # and large ones with few long ones.
+    MAX_CHUNK_SIZE = 2 ** 22
+
     def __init__(self, loid, mode='rb'):
         """Open a large object, creating it if required.
 
@@ -101,7 +107,9 @@ class LargeObject(io.RawIOBase):
         self._writable = 'w' in mode
 
         self._conn = custom_psycopg2_connection()
-        cursor = self._conn.cursor()
+        # All queries use the same cursor.
+        self._cursor = self._conn.cursor()
+        cursor = self._cursor
 
         # If the loid is 0, create the large object.
         if self.loid == 0:
@@ -120,8 +128,6 @@ class LargeObject(io.RawIOBase):
                                  "Couldn't open large object with LOID "
                                  "%s." % (self.loid), cursor)
 
-        cursor.close()
-
     def _execute(self, operation, parameters, message, cursor=None):
         """Run the given query making many success checks.
 
@@ -137,14 +143,11 @@ class LargeObject(io.RawIOBase):
         message (unicode): a description to tell humans what we were
             doing in case something went wrong.
         cursor (cursor|None): the cursor to use to execute the
-            statement (create and use a temporary one if not given).
+            statement (the one of the object if not given).
 
         """
         if cursor is None:
-            cursor = self._conn.cursor()
-            res = self._execute(operation, parameters, message, cursor)
-            cursor.close()
-            return res
+            cursor = self._cursor
 
         try:
             assert self._conn.status in (
@@ -207,6 +210,59 @@ class LargeObject(io.RawIOBase):
 
         return (int): the number of bytes read.
 
+        raise (io.UnsopportedOperation): when the file is closed or
+            not open for reads.
+
+        """
+        data = self._loread(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        """Read and return at most size bytes.
+
+        Unlike RawIOBase.read, return the data received from the
+        server without copying it in an intermediate buffer.
+
+        size (int): the maximum number of bytes to read; if negative,
+            read until the end.
+
+        return (bytes): the data read, empty at the end of the object.
+
+        raise (io.UnsopportedOperation): when the file is closed or
+            not open for reads.
+
+        """
+        if size is None or size < 0:
+            return self.readall()
+        return bytes(self._loread(size))
+
+    def readall(self):
+        """Read and return all the bytes until the end of the object.
+
+        return (bytes): the data read.
+
+        raise (io.UnsopportedOperation): when the file is closed or
+            not open for reads.
+
+        """
+        chunks = []
+        size = io.DEFAULT_BUFFER_SIZE
+        while True:
+            data = self._loread(size)
+            if len(data) == 0:
+                break
+            chunks.append(bytes(data))
+            size = min(size * 2, LargeObject.MAX_CHUNK_SIZE)
+        return b"".join(chunks)
+
+    def _loread(self, size):
+        """Read at most size bytes with a single query.
+
+        size (int): the maximum number of bytes to read.
+
+        return (buffer): the data read.
+
         raise (io.UnsopportedOperation): when the file is closed or
             not open for reads.
 
@@ -218,11 +274,9 @@ class LargeObject(io.RawIOBase):
             raise io.UnsupportedOperation("Large object hasn't been "
                                           "opened in 'read' mode.")
 
-        data = self._execute("SELECT loread(%(fd)s, %(len)s);",
-                             {'fd': self._fd, 'len': len(buf)},
-                             "Couldn't write to large object.")
-        buf[:len(data)] = data
-        return len(data)
+        return self._execute("SELECT loread(%(fd)s, %(len)s);",
+                             {'fd': self._fd, 'len': size},
+                             "Couldn't read from large object.")
 
     def write(self, buf):
         """Write to the large object, reading from the given buffer.
@@ -281,9 +335,9 @@ class LargeObject(io.RawIOBase):
         if self._fd is None:
             raise io.UnsupportedOperation("Large object is closed.")
 
-        pos = self._.execute("SELECT lo_tell(%(fd)s);",
-                             {'fd': self._fd},
-                             "Couldn't tell large object.")
+        pos = self._execute("SELECT lo_tell(%(fd)s);",
+                            {'fd': self._fd},
+                            "Couldn't tell large object.")
         return pos
 
     def truncate(self, size=None):
@@ -333,6 +387,9 @@ class LargeObject(io.RawIOBase):
         # mistake
         self._fd = None
 
+        self._cursor.close()
+        self._conn.close()
+
     @staticmethod
     def unlink(loid, conn=None):
         """Delete the large object, removing its content.
@@ -368,7 +425,8 @@ class FSObject(Base):
         primary_key=True,
         nullable=False)
 
-    # OID of the large object in the database
+    # OID of the large object in the database, or 0 if the content
+    # is in the store of the files (see HybridBackend).
     loid = Column(
         Integer,
         nullable=False,
@@ -405,7 +463,8 @@ class FSObject(Base):
         """Delete this file.
 
         """
-        LargeObject.unlink(self.loid)
+        if self.loid != 0:
+            LargeObject.unlink(self.loid)
         self.sa_session.delete(self)
 
     @classmethod
@@ -67,7 +67,7 @@ class Job(object):
     """Base class for all jobs.
 
     Input data (usually filled by ES): task_type,
-    task_type_parameters. Metadata: shard, sandboxes, info.
+    task_type_parameters. Metadata: shard, sandboxes, info, timings.
 
     """
 
@@ -76,7 +76,8 @@ class Job(object):
                  language=None, multithreaded_sandbox=False,
                  shard=None, sandboxes=None, info=None,
                  success=None, text=None,
-                 files=None, managers=None, executables=None):
+                 files=None, managers=None, executables=None,
+                 timings=None):
         """Initialization.
 
         operation (dict|None): the operation, in the format that
@@ -102,6 +103,8 @@ class Job(object):
             admins.
         executables ({string: Executable}|None): executables created
             in the compilation.
+        timings ({string: float}|None): the seconds spent by the
+            Worker in each phase of the job (see PhaseTimer).
 
         """
         if operation is None:
@@ -120,6 +123,8 @@ class Job(object):
             managers = {}
         if executables is None:
             executables = {}
+        if timings is None:
+            timings = {}
 
         self.operation = operation
         self.task_type = task_type
@@ -137,6 +142,8 @@ class Job(object):
         self.managers = managers
         self.executables = executables
 
+        self.timings = timings
+
     def export_to_dict(self):
         """Return a dict representing the job."""
         res = {
@@ -156,9 +163,23 @@ class Job(object):
                              for k, v in self.managers.iteritems()),
             'executables': dict((k, v.digest)
                                 for k, v in self.executables.iteritems()),
+            'timings': self.timings,
             }
         return res
 
+    def get_digests(self):
+        """Return the digests of the files needed to perform the job.
+
+        return ({unicode}): the digests of the files, managers and
+            executables of the job.
+
+        """
+        digests = set()
+        for files in (self.files, self.managers, self.executables):
+            for file_ in files.itervalues():
+                digests.add(file_.digest)
+        return digests
+
     @staticmethod
     def import_from_dict_with_type(data):
         """Create a Job from a dict having a type information.
@@ -245,7 +266,7 @@ class CompilationJob(Job):
                  language=None, multithreaded_sandbox=False,
                  files=None, managers=None,
                  success=None, compilation_success=None,
-                 executables=None, text=None, plus=None):
+                 executables=None, text=None, plus=None, timings=None):
         """Initialization.
 
         See base class for the remaining arguments.
@@ -259,7 +280,7 @@ class CompilationJob(Job):
         Job.__init__(self, operation, task_type, task_type_parameters,
                      language, multithreaded_sandbox,
                      shard, sandboxes, info, success, text,
-                     files, managers, executables)
+                     files, managers, executables, timings)
         self.compilation_success = compilation_success
         self.plus = plus
 
@@ -440,7 +461,7 @@ class EvaluationJob(Job):
                  time_limit=None, memory_limit=None,
                  success=None, outcome=None, text=None,
                  user_output=None, plus=None,
-                 only_execution=False, get_output=False):
+                 only_execution=False, get_output=False, timings=None):
         """Initialization.
 
         See base class for the remaining arguments.
@@ -466,7 +487,7 @@ class EvaluationJob(Job):
         Job.__init__(self, operation, task_type, task_type_parameters,
                      language, multithreaded_sandbox,
                      shard, sandboxes, info, success, text,
-                     files, managers, executables)
+                     files, managers, executables, timings)
         self.input = input
         self.output = output
         self.time_limit = time_limit
@@ -493,6 +514,16 @@ class EvaluationJob(Job):
             })
         return res
 
+    def get_digests(self):
+        """See Job.get_digests; this adds the testcase files.
+
+        """
+        digests = Job.get_digests(self)
+        for digest in (self.input, self.output):
+            if digest is not None:
+                digests.add(digest)
+        return digests
+
     @classmethod
     def import_from_dict(cls, data):
         data['files'] = dict(
@@ -560,16 +591,45 @@ class EvaluationJob(Job):
         # only if it is True.
 
         sr.evaluations += [Evaluation(
-            text=json.dumps(self.text, encoding='utf-8'),
-            outcome=self.outcome,
-            execution_time=self.plus.get('execution_time'),
-            execution_wall_clock_time=self.plus.get(
-                'execution_wall_clock_time'),
-            execution_memory=self.plus.get('execution_memory'),
-            evaluation_shard=self.shard,
-            evaluation_sandbox=":".join(self.sandboxes),
             testcase=sr.dataset.testcases[
-                self.operation["testcase_codename"]])]
+                self.operation["testcase_codename"]],
+            **self._get_evaluation_values())]
+
+    def to_evaluation_row(self, sr):
+        """Return the row of the evaluation table for the job result.
+
+        This is an alternative to to_submission, to insert many
+        evaluations at once without going through the ORM.
+
+        sr (SubmissionResult): the DB object the evaluation belongs to.
+
+        return (dict): the values of the columns of the evaluation.
+
+        """
+        values = self._get_evaluation_values()
+        values["submission_id"] = sr.submission_id
+        values["dataset_id"] = sr.dataset_id
+        values["testcase_id"] = sr.dataset.testcases[
+            self.operation["testcase_codename"]].id
+        return values
+
+    def _get_evaluation_values(self):
+        """Return the fields of the evaluation given by the job result.
+
+        return (dict): the values of the fields of the Evaluation,
+            except those identifying it.
+
+        """
+        return {
+            "text": json.dumps(self.text, encoding='utf-8'),
+            "outcome": self.outcome,
+            "execution_time": self.plus.get('execution_time'),
+            "execution_wall_clock_time": self.plus.get(
+                'execution_wall_clock_time'),
+            "execution_memory": self.plus.get('execution_memory'),
+            "evaluation_shard": self.shard,
+            "evaluation_sandbox": ":".join(self.sandboxes),
+        }
 
     @staticmethod
     def from_user_test(operation, user_test, dataset):
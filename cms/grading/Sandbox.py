@@ -24,6 +24,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import fcntl
 import io
 import logging
 import os
@@ -35,11 +36,13 @@ import tempfile
 from functools import wraps, partial
 
 import gevent
+import psutil
 from gevent import subprocess
 #import gevent_subprocess as subprocess
 
 from cms import config
-from cms.io.GeventUtils import copyfileobj, rmtree
+from cms.grading.phasetimer import PhaseTimer, timed_phase
+from cms.io.GeventUtils import copyfile, copyfileobj, rmtree
 from cmscommon.commands import pretty_print_cmdline
 from cmscommon.datetime import monotonic_time
 
@@ -113,6 +116,30 @@ def wait_without_std(procs):
     return [process.wait() for process in procs]
 
 
+# The ioctl asking Linux to make a file share the content of another
+# (copy-on-write), on the file systems supporting it.
+FICLONE = 0x40049409
+
+
+def clone_file(src_path, dst):
+    """Make a file a copy-on-write clone of another file.
+
+    src_path (string): the path of the file to clone.
+    dst (file): an empty file open for writing.
+
+    return (bool): True if the file system supports cloning and the
+        clone succeeded, False otherwise (in which case dst is left
+        empty).
+
+    """
+    try:
+        with io.open(src_path, "rb") as src:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
 class Truncator(io.RawIOBase):
     """Wrap a file-like object to simulate truncation.
 
@@ -215,6 +242,7 @@ class SandboxBase(object):
         # These are not necessarily used, but are here for API compatibility
         # TODO: move all other common properties here.
         self.box_id = 0
+        self.cpus = None
         self.fsize = None
         self.cgroup = False
         self.dirs = []
@@ -223,16 +251,34 @@ class SandboxBase(object):
         self.set_env = {}
         self.verbosity = 0
 
-        self.max_processes = 1
-        if multithreaded:
-            # Max processes is set to 1000 to limit the effect of fork bombs.
-            self.max_processes = 1000
+        self.set_multithreaded(multithreaded)
+
+        # The SandboxPool this sandbox must be given back to when not
+        # needed anymore, if any.
+        self.pool = None
+        # Relative paths of the files kept by the last reset, placed
+        # in the sandbox by a previous job (see SandboxSession).
+        # Type: {string}
+        self.kept_files = set()
 
         # Set common environment variables.
         # Specifically needed by Python, that searches the home for
         # packages.
         self.set_env["HOME"] = "./"
 
+    def set_multithreaded(self, multithreaded):
+        """Set whether the sandbox allows multithreading.
+
+        multithreaded (boolean): whether the sandbox should allow
+            multithreading.
+
+        """
+        self.multithreaded = multithreaded
+        self.max_processes = 1
+        if multithreaded:
+            # Max processes is set to 1000 to limit the effect of fork bombs.
+            self.max_processes = 1000
+
     def get_stats(self):
         """Return a human-readable string representing execution time
         and memory usage.
@@ -329,14 +375,47 @@ class SandboxBase(object):
     def create_file_from_storage(self, path, digest, executable=False):
         """Write a file taken from FS in the sandbox.
 
+        If config.sandbox_link_files is true, the file is hard linked
+        to or cloned from the copy in the cache of FS when possible,
+        instead of copying its content.
+
         path (string): relative path of the file inside the sandbox.
         digest (string): digest of the file in FS.
         executable (bool): to set permissions.
 
         """
-        file_ = self.create_file(path, executable)
-        self.file_cacher.get_file_to_fobj(digest, file_)
-        file_.close()
+        if self.file_cacher.is_cached(digest):
+            phase = PhaseTimer.FILE_FETCH_HIT
+        else:
+            phase = PhaseTimer.FILE_FETCH_MISS
+        with timed_phase(self.file_cacher, phase):
+            cache_path = None
+            if config.sandbox_link_files:
+                cache_path = self.file_cacher.get_file_cache_path(digest)
+                if self.link_file(path, cache_path, executable):
+                    return
+
+            file_ = self.create_file(path, executable)
+            try:
+                if cache_path is None or not clone_file(cache_path, file_):
+                    self.file_cacher.get_file_to_fobj(digest, file_)
+            finally:
+                file_.close()
+
+    def link_file(self, path, cache_path, executable=False):
+        """Try to place a file of the cache in the sandbox as a link.
+
+        This is only safe if the sandboxed programs cannot modify the
+        linked file, hence the base implementation never links.
+
+        path (string): relative path of the file inside the sandbox.
+        cache_path (string): path of the file in the cache.
+        executable (bool): whether the file should be executable.
+
+        return (bool): True if the file was linked.
+
+        """
+        return False
 
     def create_file_from_string(self, path, content, executable=False):
         """Write some data to a file in the sandbox.
@@ -415,9 +494,10 @@ class SandboxBase(object):
         return (string): the digest of the file.
 
         """
-        file_ = self.get_file(path, trunc_len=trunc_len)
-        digest = self.file_cacher.put_file_from_fobj(file_, description)
-        file_.close()
+        with timed_phase(self.file_cacher, PhaseTimer.OUTPUT_UPLOAD):
+            file_ = self.get_file(path, trunc_len=trunc_len)
+            digest = self.file_cacher.put_file_from_fobj(file_, description)
+            file_.close()
         return digest
 
     def stat_file(self, path):
@@ -762,11 +842,27 @@ class IsolateSandbox(SandboxBase):
     """
     next_id = 0
 
+    # The box ids of the sandboxes of this process not yet deleted.
+    box_ids_in_use = set()
+
     # If the command line starts with this command name, we are just
     # going to execute it without sandboxing, and with all permissions
     # on the current directory.
     SECURE_COMMANDS = ["/bin/cp", "/bin/mv", "/usr/bin/zip", "/usr/bin/unzip"]
 
+    @staticmethod
+    def get_needed_box_ids(worker_shards):
+        """Return how many box ids the Workers need.
+
+        worker_shards (int): the number of Workers.
+
+        return (int): the minimum value of config.isolate_num_boxes
+            giving a distinct range of ids to each slot of each
+            Worker (see __init__).
+
+        """
+        return 10 + 10 * worker_shards * config.worker_slots
+
     def __init__(self, multithreaded, file_cacher, temp_dir=None):
         """Initialization.
 
@@ -775,19 +871,35 @@ class IsolateSandbox(SandboxBase):
         """
         SandboxBase.__init__(self, multithreaded, file_cacher, temp_dir)
 
-        # Isolate only accepts ids between 0 and 99. We assign the
-        # range [(shard+1)*10, (shard+2)*10) to each Worker and keep
-        # the range [0, 10) for other uses (command-line scripts like
-        # cmsMake or direct console users of isolate). Inside each
-        # range ids are assigned sequentially, with a wrap-around.
+        # Isolate only accepts ids between 0 and num_boxes - 1
+        # (usually 99). We assign a range of 10 ids to each Worker
+        # slot (which is the whole Worker, unless it has more than a
+        # slot), starting from 10, and keep the range [0, 10) for
+        # other uses (command-line scripts like cmsMake or direct
+        # console users of isolate). Worker checks that the ranges of
+        # all slots fit (see get_needed_box_ids). Inside each range
+        # ids are assigned sequentially, with a wrap-around.
         # FIXME This is the only use of FileCacher.service, and it's an
         # improper use! Avoid it!
-        if file_cacher is not None and file_cacher.service is not None:
-            box_id = ((file_cacher.service.shard + 1) * 10
-                      + (IsolateSandbox.next_id % 10)) % 100
+        # Ids of sandboxes still alive (e.g., in a SandboxPool) are
+        # skipped; another process of the same slot might be using
+        # them.
+        cpus = None
+        for unused_i in xrange(10):
+            if file_cacher is not None and file_cacher.service is not None:
+                service = file_cacher.service
+                slot = getattr(service, "slot", 0)
+                cpus = getattr(service, "cpus", None)
+                unit = service.shard * config.worker_slots + slot
+                box_id = 10 + unit * 10 + IsolateSandbox.next_id % 10
+            else:
+                box_id = IsolateSandbox.next_id % 10
+            IsolateSandbox.next_id += 1
+            if box_id not in IsolateSandbox.box_ids_in_use:
+                break
         else:
-            box_id = IsolateSandbox.next_id % 10
-        IsolateSandbox.next_id += 1
+            raise SandboxInterfaceException(
+                "All the ids of the range of box %d are in use." % box_id)
 
         # We create a directory "tmp" inside the outer temporary directory,
         # because the sandbox will bind-mount the inner one. The sandbox also
@@ -808,12 +920,25 @@ class IsolateSandbox(SandboxBase):
         self.info_basename = "run.log"   # Used for -M
         self.log = None
         self.exec_num = -1
+        # Relative paths of the files hard linked from the cache.
+        # Type: {string}
+        self.linked_files = set()
         logger.debug("Sandbox in `%s' created, using box `%s'.",
                      self.path, self.box_exec)
 
-        # Default parameters for isolate
         self.box_id = box_id           # -b
+        self.cpus = cpus               # (CPU affinity of isolate)
         self.cgroup = config.use_cgroups  # --cg
+        self._set_default_options()
+
+        # Tell isolate to get the sandbox ready.
+        self._init_box()
+        IsolateSandbox.box_ids_in_use.add(self.box_id)
+
+    def _set_default_options(self):
+        """Set the default parameters for isolate.
+
+        """
         self.chdir = self.inner_temp_dir  # -c
         self.dirs = []                 # -d
         self.dirs += [(self.inner_temp_dir, self.path, "rw")]
@@ -842,7 +967,12 @@ class IsolateSandbox(SandboxBase):
         if os.path.isdir("/etc/alternatives"):
             self.add_mapped_directories(["/etc/alternatives"])
 
-        # Tell isolate to get the sandbox ready.
+    def _init_box(self):
+        """Tell isolate to get the box ready.
+
+        raise (SandboxInterfaceException): if isolate fails.
+
+        """
         box_cmd = [self.box_exec] + (["--cg"] if self.cgroup else []) \
             + ["--box-id=%d" % self.box_id] + ["--init"]
         ret = subprocess.call(box_cmd)
@@ -851,6 +981,59 @@ class IsolateSandbox(SandboxBase):
                 "Failed to initialize sandbox with command: %s "
                 "(error %d)" % (pretty_print_cmdline(box_cmd), ret))
 
+    def _cleanup_box(self):
+        """Tell isolate to cleanup the box.
+
+        """
+        box_cmd = [self.box_exec] + (["--cg"] if self.cgroup else []) \
+            + ["--box-id=%d" % self.box_id]
+        subprocess.call(box_cmd + ["--cleanup"])
+
+    def reset(self, keep=None):
+        """Bring the sandbox back to the state it had when created.
+
+        This is cheaper than deleting the sandbox and creating a new
+        one, as the temporary directory is kept (only its content is
+        removed); isolate's box is re-initialized anyway, so that
+        nothing left by previous executions is visible.
+
+        keep ([string]|None): names of files in the root of the
+            sandbox that must not be removed (they will be listed in
+            kept_files); the sandboxed programs cannot modify them
+            if they were not made writable.
+
+        raise (OSError|IOError): if the content cannot be removed.
+        raise (SandboxInterfaceException): if isolate fails.
+
+        """
+        logger.debug("Resetting sandbox in %s.", self.path)
+        keep = set(keep) if keep is not None else set()
+        self._cleanup_box()
+        # Not allow_writing_all, that would copy the linked files just
+        # to delete them; removing a link needs only the permissions
+        # of the directory, and never touches the file of the cache.
+        # The kept files are left as they are, links included.
+        os.chmod(self.path, 0777)
+        kept_files = set()
+        for filename in os.listdir(self.path):
+            if filename in keep:
+                kept_files.add(filename)
+                continue
+            path = os.path.join(self.path, filename)
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.chmod(path, 0777)
+                rmtree(path)
+            else:
+                os.remove(path)
+
+        self.log = None
+        self.exec_num = -1
+        self.linked_files &= kept_files
+        self.kept_files = kept_files
+        self.set_multithreaded(False)
+        self._set_default_options()
+        self._init_box()
+
     def add_mapped_directories(self, dirs):
         """Add dirs to the external dirs visible to the sandboxed command.
 
@@ -860,12 +1043,59 @@ class IsolateSandbox(SandboxBase):
         for directory in dirs:
             self.dirs.append((directory, None, "rw"))
 
+    def link_file(self, path, cache_path, executable=False):
+        """Try to place a file of the cache in the sandbox as a link.
+
+        The sandboxed programs run as a different user, hence they
+        cannot modify the read-only files of the cache; the
+        permissions of linked files are never changed (see
+        allow_writing_all and allow_writing_only). Executables are
+        not linked, as their permissions would differ from the cache.
+
+        See SandboxBase.link_file for the arguments.
+
+        """
+        if executable:
+            return False
+        try:
+            os.link(cache_path, self.relative_path(path))
+        except OSError:
+            # For example, the cache is on another file system.
+            return False
+        logger.debug("Linked file %s in sandbox.", path)
+        self.linked_files.add(os.path.normpath(path))
+        return True
+
+    def unlink_file(self, path):
+        """Replace a linked file with a copy, that can be modified.
+
+        path (string): relative path of the file inside the sandbox.
+
+        """
+        path = os.path.normpath(path)
+        if path in self.linked_files:
+            real_path = self.relative_path(path)
+            temp_path = "%s.copy" % real_path
+            copyfile(real_path, temp_path)
+            os.rename(temp_path, real_path)
+            self.linked_files.discard(path)
+
+    def remove_file(self, path):
+        """Delete a file in the sandbox.
+
+        path (string): relative path of the file inside the sandbox.
+
+        """
+        SandboxBase.remove_file(self, path)
+        self.linked_files.discard(os.path.normpath(path))
+
     def allow_writing_all(self):
         """Set permissions in such a way that any operation is allowed.
 
         """
         os.chmod(self.path, 0777)
         for filename in os.listdir(self.path):
+            self.unlink_file(filename)
             os.chmod(os.path.join(self.path, filename), 0777)
 
     def allow_writing_none(self):
@@ -874,7 +1104,8 @@ class IsolateSandbox(SandboxBase):
         """
         os.chmod(self.path, 0755)
         for filename in os.listdir(self.path):
-            os.chmod(os.path.join(self.path, filename), 0755)
+            if filename not in self.linked_files:
+                os.chmod(os.path.join(self.path, filename), 0755)
 
     def allow_writing_only(self, paths):
         """Set permissions in so that the user can write only some paths.
@@ -884,7 +1115,10 @@ class IsolateSandbox(SandboxBase):
 
         """
         # If one of the specified file do not exists, we touch it to
-        # assign the correct permissions.
+        # assign the correct permissions; linked files are replaced
+        # with copies, not to make the cache writable.
+        for path in paths:
+            self.unlink_file(path)
         for path in (os.path.join(self.path, path) for path in paths):
             if not os.path.exists(path):
                 open(path, "w").close()
@@ -1247,6 +1481,7 @@ class IsolateSandbox(SandboxBase):
         try:
             p = subprocess.Popen(args,
                                  stdin=stdin, stdout=stdout, stderr=stderr,
+                                 preexec_fn=self._set_cpu_affinity,
                                  close_fds=close_fds)
         except OSError:
             logger.critical("Failed to execute program in sandbox "
@@ -1256,6 +1491,17 @@ class IsolateSandbox(SandboxBase):
 
         return p
 
+    def _set_cpu_affinity(self):
+        """Restrict the current process to the sandbox CPUs, if any.
+
+        To be called in the child process just before running isolate,
+        as the affinity is inherited by the sandboxed program (and
+        cannot be changed anymore once isolate becomes root).
+
+        """
+        if self.cpus is not None:
+            psutil.Process().cpu_affinity(self.cpus)
+
     def _write_empty_run_log(self, index):
         """Write a fake run.log file with no information."""
         with open(os.path.join(self.path, "run.log.%s" % index), "w") as f:
@@ -1321,9 +1567,8 @@ class IsolateSandbox(SandboxBase):
         logger.debug("Deleting sandbox in %s.", self.path)
 
         # Tell isolate to cleanup the sandbox.
-        box_cmd = [self.box_exec] + (["--cg"] if self.cgroup else []) \
-            + ["--box-id=%d" % self.box_id]
-        subprocess.call(box_cmd + ["--cleanup"])
+        self._cleanup_box()
+        IsolateSandbox.box_ids_in_use.discard(self.box_id)
 
         # Delete the working directory.
         rmtree(self.outer_temp_dir)
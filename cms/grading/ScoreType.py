@@ -41,6 +41,8 @@ import re
 
 from tornado.template import Template
 
+from cms.grading import is_evaluation_skipped
+
 
 logger = logging.getLogger(__name__)
 
@@ -154,6 +156,23 @@ class ScoreType(object):
         logger.error("Unimplemented method compute_score.")
         raise NotImplementedError("Please subclass this class.")
 
+    def get_irrelevant_testcases(self, unused_outcomes):
+        """Return the testcases whose outcome cannot change the score.
+
+        This allows ES to avoid evaluating a submission on testcases
+        that do not matter anymore given the outcomes known so far
+        (see the lazy_evaluation configuration option). By default,
+        all testcases are relevant.
+
+        unused_outcomes ({unicode: float}): the outcomes of the
+            testcases evaluated so far, indexed by codename.
+
+        return ({unicode}): the codenames of the testcases that can be
+            skipped (possibly including evaluated ones).
+
+        """
+        return set()
+
 
 class ScoreTypeAlone(ScoreType):
     """Intermediate class to manage tasks where the score of a
@@ -178,7 +197,8 @@ class ScoreTypeGroup(ScoreTypeAlone):
     expression of the names of target testcases. All t must have the same type.
 
     A subclass must implement the method 'get_public_outcome' and
-    'reduce'.
+    'reduce', and can implement 'is_reduce_determined' to allow ES to
+    skip the testcases of the subtasks whose score is already known.
 
     """
     # Mark strings for localization.
@@ -237,6 +257,8 @@ class ScoreTypeGroup(ScoreTypeAlone):
                 <tr class="correct">
             {% elif tc["outcome"] == "Not correct" %}
                 <tr class="notcorrect">
+            {% elif tc["outcome"] == "Not evaluated" %}
+                <tr class="undefined">
             {% else %}
                 <tr class="partiallycorrect">
             {% end %}
@@ -359,7 +381,9 @@ class ScoreTypeGroup(ScoreTypeAlone):
             st_public = all(self.public_testcases[idx] for idx in target)
             tc_outcomes = dict((
                 idx,
-                self.get_public_outcome(
+                N_("Not evaluated")
+                if is_evaluation_skipped(evaluations[idx].text)
+                else self.get_public_outcome(
                     float(evaluations[idx].outcome), parameter)
                 ) for idx in target)
 
@@ -432,3 +456,38 @@ class ScoreTypeGroup(ScoreTypeAlone):
         """
         logger.error("Unimplemented method reduce.")
         raise NotImplementedError("Please subclass this class.")
+
+    def is_reduce_determined(self, unused_outcomes, unused_parameter):
+        """Return whether the score of a subtask is already known.
+
+        unused_outcomes ([float]): the outcomes of the submission in
+            some of the testcases of the group.
+        unused_parameter (list): the parameters of the group.
+
+        return (bool): True if reduce gives the same result for any
+            outcomes of the other testcases of the group.
+
+        """
+        return False
+
+    def get_irrelevant_testcases(self, outcomes):
+        """See ScoreType.get_irrelevant_testcases.
+
+        A testcase is irrelevant if the score of all the subtasks it
+        belongs to is determined. Subtasks worth nothing are never
+        skipped, as their only purpose is to give feedback.
+
+        """
+        determined = set()
+        undetermined = set()
+        targets = self.retrieve_target_testcases()
+        for st_idx, parameter in enumerate(self.parameters):
+            target = targets[st_idx]
+            known_outcomes = [outcomes[idx] for idx in target
+                              if idx in outcomes]
+            if parameter[0] > 0 and \
+                    self.is_reduce_determined(known_outcomes, parameter):
+                determined.update(target)
+            else:
+                undetermined.update(target)
+        return determined - undetermined
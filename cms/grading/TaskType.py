@@ -41,6 +41,7 @@ from cms import config
 from cms.grading import JobException
 from cms.grading.Sandbox import Sandbox
 from cms.grading.Job import CompilationJob, EvaluationJob
+from cms.grading.phasetimer import PhaseTimer, timed_phase
 
 
 logger = logging.getLogger(__name__)
@@ -48,43 +49,95 @@ logger = logging.getLogger(__name__)
 
 ## Sandbox lifecycle. ##
 
-def create_sandbox(file_cacher, multithreaded=False):
+def _get_slot_attribute(file_cacher, name):
+    """Return an attribute of the service using the file cacher.
+
+    file_cacher (FileCacher|None): a file cacher instance.
+    name (string): the name of the attribute.
+
+    return (object|None): the attribute of the service (i.e., of a
+        Worker slot), or None if there is no such attribute.
+
+    """
+    if file_cacher is None or file_cacher.service is None:
+        return None
+    return getattr(file_cacher.service, name, None)
+
+
+def create_sandbox(file_cacher, multithreaded=False, reuse_key=None):
     """Create a sandbox, and return it.
 
+    If the service using the file cacher (i.e., a Worker slot) has a
+    SandboxSession with a sandbox kept with the given key, that
+    sandbox is returned; otherwise, if it has a SandboxPool, the
+    sandbox is taken from there if possible.
+
     file_cacher (FileCacher): a file cacher instance.
     multithreaded (boolean): whether the sandbox should allow multithreading.
+    reuse_key (object|None): the key given to delete_sandbox by a
+        previous job, whose sandbox (and the files in its kept_files)
+        can be used again.
 
     return (Sandbox): a sandbox.
 
     raise (JobException): if the sandbox cannot be created.
 
     """
-    try:
-        sandbox = Sandbox(multithreaded, file_cacher)
-    except (OSError, IOError):
-        err_msg = "Couldn't create sandbox."
-        logger.error(err_msg, exc_info=True)
-        raise JobException(err_msg)
-    return sandbox
+    with timed_phase(file_cacher, PhaseTimer.SANDBOX_CREATION):
+        session = _get_slot_attribute(file_cacher, "sandbox_session")
+        if session is not None and reuse_key is not None:
+            sandbox = session.get(reuse_key, multithreaded)
+            if sandbox is not None:
+                return sandbox
+
+        pool = _get_slot_attribute(file_cacher, "sandbox_pool")
+        if pool is not None:
+            sandbox = pool.get(multithreaded)
+            if sandbox is not None:
+                return sandbox
+
+        try:
+            sandbox = Sandbox(multithreaded, file_cacher)
+        except (OSError, IOError):
+            err_msg = "Couldn't create sandbox."
+            logger.error(err_msg, exc_info=True)
+            raise JobException(err_msg)
+        return sandbox
 
 
-def delete_sandbox(sandbox, success=True):
+def delete_sandbox(sandbox, success=True, reuse_key=None, keep=None):
     """Delete the sandbox, if the configuration and job was ok.
 
     sandbox (Sandbox): the sandbox to delete.
     success (boolean): if the job succeeded (no system errors).
+    reuse_key (object|None): if not None, and the service has a
+        SandboxSession, the sandbox is kept there for the next job
+        calling create_sandbox with the same key.
+    keep ([string]|None): the files to keep in the sandbox when it
+        is kept for another job.
 
     """
-    # If the job was not successful, we keep the sandbox around.
-    if not success:
-        logger.warning("Sandbox %s kept around because job did not succeeded.",
-                       sandbox.outer_temp_dir)
-    elif not config.keep_sandbox:
-        try:
-            sandbox.delete()
-        except (IOError, OSError):
-            err_msg = "Couldn't delete sandbox."
-            logger.warning(err_msg, exc_info=True)
+    with timed_phase(sandbox.file_cacher, PhaseTimer.SANDBOX_DELETION):
+        # If the job was not successful, we keep the sandbox around.
+        if not success:
+            logger.warning("Sandbox %s kept around because job did not "
+                           "succeeded.", sandbox.outer_temp_dir)
+            if sandbox.pool is not None:
+                sandbox.pool.discard(sandbox)
+        elif not config.keep_sandbox:
+            session = _get_slot_attribute(sandbox.file_cacher,
+                                          "sandbox_session")
+            if session is not None and reuse_key is not None:
+                session.put(reuse_key, sandbox, keep or [])
+                return
+            if sandbox.pool is not None:
+                sandbox.pool.put(sandbox)
+                return
+            try:
+                sandbox.delete()
+            except (IOError, OSError):
+                err_msg = "Couldn't delete sandbox."
+                logger.warning(err_msg, exc_info=True)
 
 
 class TaskType(object):
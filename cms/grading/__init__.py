@@ -31,6 +31,7 @@ import io
 import json
 import logging
 import os
+import signal
 import six
 
 from collections import namedtuple
@@ -39,7 +40,9 @@ from sqlalchemy.orm import joinedload
 
 from cms import SCORE_MODE_MAX, config
 from cms.db import Submission
+from cms.db.filecacher import TombstoneError
 from cms.grading.Sandbox import Sandbox
+from cms.grading.phasetimer import PhaseTimer, timed_phase
 
 from .language import Language, CompiledLanguage
 
@@ -48,10 +51,11 @@ __all__ = [
     # __init__.py
     "JobException",
     "COMPILATION_MESSAGES", "EVALUATION_MESSAGES",
-    "format_status_text",
+    "format_status_text", "skipped_evaluation_text", "is_evaluation_skipped",
     "compilation_step", "evaluation_step",
     "evaluation_step_before_run", "evaluation_step_after_run",
     "human_evaluation_message", "is_evaluation_passed",
+    "get_output_size_limit", "is_output_too_large",
     "filter_ansi_escape", "extract_outcome_and_text",
     "white_diff_step",
     "compute_changes_for_dataset", "task_score",
@@ -191,10 +195,20 @@ EVALUATION_MESSAGES = MessageCollection([
                  N_("Execution killed because of forbidden file access"),
                  N_("Your submission was killed because it tried to read "
                     "or write a forbidden file.")),
+    HumanMessage("outputlimit",
+                 N_("Output too large"),
+                 N_("Your submission wrote an output much larger than the "
+                    "correct one, and was stopped or not checked.")),
     HumanMessage("returncode",
                  N_("Execution failed because the return code was nonzero"),
                  N_("Your submission failed because it exited with a return "
                     "code different from 0.")),
+    HumanMessage("skipped",
+                 N_("Not evaluated"),
+                 N_("Your submission was not evaluated on this testcase, "
+                    "as its outcome cannot change the score (for "
+                    "example, the submission already failed another "
+                    "testcase of the same subtask).")),
 ])
 
 
@@ -212,6 +226,34 @@ class JobException(Exception):
         return "JobException(\"%s\")" % (repr(self.msg))
 
 
+def skipped_evaluation_text():
+    """Return the text of the evaluations that were skipped.
+
+    return (unicode): the JSON-encoded status text (see
+        format_status_text) given to the evaluations that ES decided
+        not to run, as they could not change the score.
+
+    """
+    return json.dumps([EVALUATION_MESSAGES.get("skipped").message])
+
+
+def is_evaluation_skipped(status):
+    """Return whether an evaluation was skipped.
+
+    status ([unicode]|unicode): the status text of the evaluation.
+
+    return (bool): whether the evaluation was not run, as it could not
+        change the score.
+
+    """
+    try:
+        if isinstance(status, six.string_types):
+            status = json.loads(status)
+        return status[0] == EVALUATION_MESSAGES.get("skipped").message
+    except (ValueError, TypeError, IndexError):
+        return False
+
+
 def format_status_text(status, translator=None):
     """Format the given status text in the given locale.
 
@@ -287,7 +329,8 @@ def compilation_step(sandbox, commands):
         sandbox.stdout_file = "compiler_stdout_%d.txt" % step
         sandbox.stderr_file = "compiler_stderr_%d.txt" % step
 
-        box_success = sandbox.execute_without_std(command, wait=True)
+        with timed_phase(sandbox.file_cacher, PhaseTimer.COMPILATION):
+            box_success = sandbox.execute_without_std(command, wait=True)
         if not box_success:
             logger.error("Compilation aborted because of "
                          "sandbox error in `%s'.", sandbox.path)
@@ -395,7 +438,8 @@ def compilation_step(sandbox, commands):
 def evaluation_step(sandbox, commands,
                     time_limit=0.0, memory_limit=0,
                     allow_dirs=None, writable_files=None,
-                    stdin_redirect=None, stdout_redirect=None):
+                    stdin_redirect=None, stdout_redirect=None,
+                    max_output_size=None):
     """Execute some evaluation commands in the sandbox. Note that in
     some task types, there may be more than one evaluation commands
     (per testcase) (in others there can be none, of course).
@@ -411,6 +455,9 @@ def evaluation_step(sandbox, commands,
         allow to write; if None, all files are read-only. The
         redirected output and the standard error are implicitly added
         to the files allowed, in any case.
+    max_output_size (int|None): if not None, the maximum size (in
+        KB) of the files written, if lower than config.max_file_size
+        (see get_output_size_limit).
 
     return ((bool, dict)): True if the evaluation was successful, or
         False; and additional data.
@@ -420,7 +467,8 @@ def evaluation_step(sandbox, commands,
         success = evaluation_step_before_run(
             sandbox, command, time_limit, memory_limit,
             allow_dirs, writable_files,
-            stdin_redirect, stdout_redirect, wait=True)
+            stdin_redirect, stdout_redirect, wait=True,
+            max_output_size=max_output_size)
         if not success:
             logger.debug("Job failed in evaluation_step_before_run.")
             return False, None
@@ -436,7 +484,7 @@ def evaluation_step_before_run(sandbox, command,
                                time_limit=0, memory_limit=0,
                                allow_dirs=None, writable_files=None,
                                stdin_redirect=None, stdout_redirect=None,
-                               wait=False):
+                               wait=False, max_output_size=None):
     """First part of an evaluation step, until the running.
 
     return: exit code already translated if wait is True, the
@@ -456,6 +504,8 @@ def evaluation_step_before_run(sandbox, command,
         sandbox.wallclock_timeout = 0
     sandbox.address_space = memory_limit * 1024
     sandbox.fsize = config.max_file_size
+    if max_output_size is not None:
+        sandbox.fsize = min(sandbox.fsize, max_output_size)
 
     if stdin_redirect is not None:
         sandbox.stdin_file = stdin_redirect
@@ -595,6 +645,9 @@ def human_evaluation_message(plus):
     elif exit_status == Sandbox.EXIT_TIMEOUT_WALL:
         return [EVALUATION_MESSAGES.get("walltimeout").message]
     elif exit_status == Sandbox.EXIT_SIGNAL:
+        # Killed for writing more than the maximum file size.
+        if plus['signal'] == signal.SIGXFSZ:
+            return [EVALUATION_MESSAGES.get("outputlimit").message]
         return [EVALUATION_MESSAGES.get("signal").message, plus['signal']]
     elif exit_status == Sandbox.EXIT_SANDBOX_ERROR:
         return None
@@ -616,6 +669,53 @@ def is_evaluation_passed(plus):
     return plus['exit_status'] == Sandbox.EXIT_OK
 
 
+def get_output_size_limit(file_cacher, output_digest):
+    """Return the maximum size of an output, given the correct one.
+
+    Outputs much larger than the correct one cannot be correct, and
+    writing and comparing them wastes the resources of the Worker;
+    the limit is config.max_output_size_factor times the size of the
+    correct output, plus config.max_output_size_slack. Task types
+    should ask for it only when comparing the outputs with white diff,
+    as a checker may accept outputs much larger than the correct one.
+
+    file_cacher (FileCacher): the file cacher with the correct output.
+    output_digest (unicode|None): the digest of the correct output.
+
+    return (int|None): the maximum size in KB (the unit of
+        Sandbox.fsize), or None if there is no limit (because it is
+        disabled or the correct output is not known).
+
+    """
+    if config.max_output_size_factor <= 0 or output_digest is None:
+        return None
+    # The correct output is needed in the cache anyway to check the
+    # output, and its size is known there without asking the backend.
+    try:
+        size = os.stat(file_cacher.get_file_cache_path(output_digest))\
+            .st_size
+    except (KeyError, TombstoneError):
+        return None
+    return int(config.max_output_size_factor * size // 1024) + \
+        config.max_output_size_slack
+
+
+def is_output_too_large(sandbox, filename, max_output_size):
+    """Return whether an output is larger than its maximum size.
+
+    sandbox (Sandbox): the sandbox containing the output.
+    filename (string): the name of the output in the sandbox.
+    max_output_size (int|None): the maximum size in KB, as returned
+        by get_output_size_limit.
+
+    return (bool): True if the output is too large, and hence wrong.
+
+    """
+    if max_output_size is None:
+        return False
+    return sandbox.stat_file(filename).st_size > max_output_size * 1024
+
+
 def filter_ansi_escape(string):
     """Filter out ANSI commands from the given string.
 
@@ -723,6 +823,132 @@ def white_diff_canonicalize(string):
     return string
 
 
+# Number of bytes read at once from the files compared by white_diff.
+WHITE_DIFF_CHUNK_SIZE = 2 ** 20
+
+
+def _common_prefix_length(string1, string2):
+    """Return the length of the longest common prefix of two strings.
+
+    string1 (bytes): the first string.
+    string2 (bytes): the second string.
+    return (int): the length of the common prefix.
+
+    """
+    # Bisect on slices, so that the comparisons are done in C; the
+    # total length of the slices is linear in that of the strings.
+    low, high = 0, min(len(string1), len(string2))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if string1[low:middle] == string2[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _white_diff_skip_equal_lines(output, res):
+    """Read the two files while they are identical.
+
+    output (file): the first file to read.
+    res (file): the second file to read.
+    return (int|None): None if the two files are identical; otherwise
+        the number of bytes of the longest common prefix made of
+        complete lines (i.e., ending with \n).
+
+    """
+    offset = 0
+    lines_offset = 0
+    while True:
+        chunk_out = output.read(WHITE_DIFF_CHUNK_SIZE)
+        chunk_res = res.read(WHITE_DIFF_CHUNK_SIZE)
+        if chunk_out == chunk_res:
+            if chunk_out == b'':
+                return None
+            common = len(chunk_out)
+        else:
+            common = _common_prefix_length(chunk_out, chunk_res)
+        newline = chunk_out.rfind(b'\n', 0, common)
+        if newline != -1:
+            lines_offset = offset + newline + 1
+        if common < len(chunk_out) or common < len(chunk_res):
+            return lines_offset
+        offset += common
+
+
+def _white_diff_canonical_chunks(file_):
+    """Yield the canonical form of a file for the white diff, in chunks.
+
+    The canonical form is the concatenation of the lines of the file,
+    canonicalized as in white_diff_canonicalize() and separated by
+    \n, without the trailing empty lines: two files are equal for
+    white_diff() if and only if their canonical forms are.
+
+    file_ (file): the file to read, in binary mode.
+    yield (bytes): consecutive non-empty chunks of the canonical form.
+
+    """
+    # Pieces of the line not yet terminated by \n at the end of the
+    # last chunk.
+    partial = []
+    # Empty lines seen but not yet yielded, since they could be the
+    # trailing ones.
+    empty_lines = 0
+    while True:
+        chunk = file_.read(WHITE_DIFF_CHUNK_SIZE)
+        if chunk == b'':
+            # Last line, without the final \n.
+            lines = [b''.join(partial)]
+        else:
+            newline = chunk.rfind(b'\n')
+            if newline == -1:
+                partial.append(chunk)
+                continue
+            partial.append(chunk[:newline])
+            lines = b''.join(partial).split(b'\n')
+            partial = [chunk[newline + 1:]]
+
+        # The whitespaces other than \n for str.split() are exactly
+        # those in WHITES.
+        canonical = b'\n'.join(b' '.join(line.split()) for line in lines)
+        stripped = canonical.rstrip(b'\n')
+        if stripped != b'':
+            if empty_lines > 0:
+                yield b'\n' * empty_lines
+            yield stripped
+            empty_lines = 0
+        if chunk == b'':
+            return
+        # The \n terminating the last line in this chunk.
+        empty_lines += len(canonical) - len(stripped) + 1
+
+
+def _equal_chunks(chunks1, chunks2):
+    """Compare two sequences of strings by their concatenation.
+
+    chunks1 (iterable of bytes): the first sequence.
+    chunks2 (iterable of bytes): the second sequence.
+    return (bool): whether the concatenations of the two sequences
+        are equal; the comparison stops at the first difference.
+
+    """
+    chunks1 = iter(chunks1)
+    chunks2 = iter(chunks2)
+    buffer1 = buffer2 = b''
+    while True:
+        if buffer1 == b'':
+            buffer1 = next(chunks1, None)
+        if buffer2 == b'':
+            buffer2 = next(chunks2, None)
+        if buffer1 is None or buffer2 is None:
+            return buffer1 is None and buffer2 is None
+        length = min(len(buffer1), len(buffer2))
+        if buffer1[:length] != buffer2[:length]:
+            return False
+        buffer1 = buffer1[length:]
+        buffer2 = buffer2[length:]
+
+
 def white_diff(output, res):
     """Compare the two output files. Two files are equal if for every
     integer i, line i of first file is equal to line i of second
@@ -734,34 +960,27 @@ def white_diff(output, res):
     'sequence of characters ending with \n or EOF and beginning right
     after BOF or \n'. In particular, every line has *at most* one \n.
 
-    output (file): the first file to compare.
-    res (file): the second file to compare.
+    The files are first compared byte by byte, as most correct outputs
+    are identical to the reference; only from the first line that
+    differs they are compared, in chunks, through their canonical
+    forms, stopping at the first difference.
+
+    output (file): the first file to compare, opened in binary mode.
+    res (file): the second file to compare, opened in binary mode.
     return (bool): True if the two file are equal as explained above.
 
     """
+    start_output = output.tell()
+    start_res = res.tell()
+    offset = _white_diff_skip_equal_lines(output, res)
+    if offset is None:
+        return True
 
-    while True:
-        lout = output.readline()
-        lres = res.readline()
-
-        # Both files finished: comparison succeded
-        if lres == '' and lout == '':
-            return True
-
-        # Only one file finished: ok if the other contains only blanks
-        elif lres == '' or lout == '':
-            lout = lout.strip(WHITES)
-            lres = lres.strip(WHITES)
-            if lout != '' or lres != '':
-                return False
-
-        # Both file still have lines to go: ok if they agree except
-        # for the number of whitespaces
-        else:
-            lout = white_diff_canonicalize(lout)
-            lres = white_diff_canonicalize(lres)
-            if lout != lres:
-                return False
+    # The lines before offset are identical, hence equal.
+    output.seek(start_output + offset)
+    res.seek(start_res + offset)
+    return _equal_chunks(_white_diff_canonical_chunks(output),
+                         _white_diff_canonical_chunks(res))
 
 
 def white_diff_step(sandbox, output_filename,
@@ -782,9 +1001,11 @@ def white_diff_step(sandbox, output_filename,
 
     """
     if sandbox.file_exists(output_filename):
-        out_file = sandbox.get_file(output_filename)
-        res_file = sandbox.get_file(correct_output_filename)
-        if white_diff(out_file, res_file):
+        with timed_phase(sandbox.file_cacher, PhaseTimer.CHECKING), \
+                sandbox.get_file(output_filename) as out_file, \
+                sandbox.get_file(correct_output_filename) as res_file:
+            equal = white_diff(out_file, res_file)
+        if equal:
             outcome = 1.0
             text = [EVALUATION_MESSAGES.get("success").message]
         else:
@@ -0,0 +1,270 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A cache of the results of compilations.
+
+Compiling the same files with the same commands gives the same
+executables: this happens when a submission is compiled for each
+dataset of its task, when it is recompiled after an invalidation,
+and when a contestant submits the same code twice. The results of
+the compilations are remembered in a directory of the cache, shared
+by all the Workers of the host; their executables are in the storage
+of the FileCacher, hence available to all Workers.
+
+The results are not shared among hosts, hence each host compiles a
+given submission at least once: sharing them would need an index of
+the compilations by key in the database, that FileCacher does not
+provide (FSObjects can be found only by their digest).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+
+from cms import config, mkdir
+from cms.db import Executable
+from cms.grading.Sandbox import Sandbox
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_executable_identity(path):
+    """Return what identifies the version of a program.
+
+    path (string): the path of the program, as in a command.
+
+    return ([unicode, int, int]|None): the path of the program after
+        resolving symbolic links (which usually contains the version
+        of the compilers), its size and its modification time (which
+        change when it is upgraded), or None if it cannot be found.
+
+    """
+    if not os.path.isabs(path):
+        return None
+    try:
+        real_path = os.path.realpath(path)
+        file_stat = os.stat(real_path)
+    except OSError:
+        return None
+    return [real_path, file_stat.st_size, int(file_stat.st_mtime)]
+
+
+def get_compilation_key(language, files, commands):
+    """Return the key of a compilation in the cache.
+
+    language (Language): the language of the compilation.
+    files ({string: string}): the digests of the files placed in the
+        sandbox, indexed by their names.
+    commands ([[string]]): the compilation commands.
+
+    return (string): the key, which is the same for compilations
+        that must give the same results, including the version of
+        the programs running the commands (so that upgrading the
+        compiler does not reuse old results).
+
+    """
+    description = json.dumps([language.name,
+                              sorted(files.iteritems()),
+                              commands,
+                              [get_executable_identity(command[0])
+                               for command in commands]],
+                             separators=(",", ":"))
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+class CompilationCache(object):
+    """The results of the last compilations, stored in a directory.
+
+    Each result is a JSON file, whose name is the key of the
+    compilation; when there are more than a given number of them, the
+    ones least recently used are deleted.
+
+    """
+
+    def __init__(self, path, size):
+        """Use the cache in the given directory.
+
+        path (string): the directory of the cache, created if needed.
+        size (int): the maximum number of results to keep.
+
+        """
+        self.path = path
+        self.size = size
+        if not mkdir(os.path.dirname(self.path)) or not mkdir(self.path):
+            logger.error("Cannot create necessary directories.")
+            raise RuntimeError("Cannot create necessary directories.")
+
+    def get(self, key):
+        """Return the result of a compilation, if known.
+
+        key (string): the key of the compilation.
+
+        return (dict|None): the result given to put(), or None.
+
+        """
+        path = os.path.join(self.path, key)
+        try:
+            with io.open(path, "rb") as f:
+                entry = json.load(f)
+            # Mark the result as recently used.
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        """Remember the result of a compilation.
+
+        key (string): the key of the compilation.
+        entry (dict): the result, which must be serializable to JSON.
+
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            json.dump(entry, f)
+        # Atomic, hence other Workers see either nothing or the
+        # whole result.
+        os.rename(temp_path, os.path.join(self.path, key))
+        self._evict()
+
+    def _evict(self):
+        """Delete the least recently used results exceeding the size.
+
+        """
+        filenames = [filename for filename in os.listdir(self.path)
+                     if not filename.startswith(".")]
+        if len(filenames) <= self.size:
+            return
+        entries = []
+        for filename in filenames:
+            path = os.path.join(self.path, filename)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                # Deleted by another Worker.
+                pass
+        entries.sort()
+        for unused_mtime, path in entries[:len(entries) - self.size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_compilation_cache = None
+
+
+def get_compilation_cache():
+    """Return the compilation cache of this host.
+
+    return (CompilationCache|None): the cache, or None if disabled in
+        the configuration.
+
+    """
+    global _compilation_cache
+    if config.compilation_cache_size <= 0:
+        return None
+    if _compilation_cache is None:
+        _compilation_cache = CompilationCache(
+            os.path.join(config.cache_dir, "compilations"),
+            config.compilation_cache_size)
+    return _compilation_cache
+
+
+def load_compilation(job, file_cacher, key):
+    """Fill a compilation job with a result from the cache.
+
+    job (CompilationJob): the job to fill.
+    file_cacher (FileCacher): the file cacher used by the job, to
+        check that the executables are still available.
+    key (string): the key of the compilation (see
+        get_compilation_key).
+
+    return (bool): whether the result was in the cache; if not, the
+        job is left untouched.
+
+    """
+    cache = get_compilation_cache()
+    if cache is None:
+        return False
+    entry = cache.get(key)
+    if entry is None:
+        return False
+
+    for digest in entry["executables"].itervalues():
+        try:
+            file_cacher.load(digest, if_needed=True)
+        except KeyError:
+            logger.info("Executable %s of a cached compilation not "
+                        "found, compiling again.", digest,
+                        extra={"operation": job.info})
+            return False
+
+    logger.info("Compilation found in the cache.",
+                extra={"operation": job.info})
+    job.success = True
+    job.compilation_success = entry["compilation_success"]
+    job.text = entry["text"]
+    job.plus = entry["plus"]
+    for filename, digest in entry["executables"].iteritems():
+        job.executables[filename] = Executable(filename, digest)
+    return True
+
+
+def store_compilation(job, key):
+    """Remember the result of a compilation job, if possible.
+
+    Only results that do not depend on the load of the Worker are
+    remembered: successful compilations, and failed ones that
+    terminated normally (i.e., not because of timeouts or signals).
+
+    job (CompilationJob): the job, already executed.
+    key (string): the key of the compilation (see
+        get_compilation_key).
+
+    """
+    cache = get_compilation_cache()
+    if cache is None or not job.success:
+        return
+    if not job.compilation_success and job.plus.get("exit_status") not in \
+            [Sandbox.EXIT_OK, Sandbox.EXIT_NONZERO_RETURN]:
+        return
+
+    entry = {
+        "compilation_success": job.compilation_success,
+        "text": job.text,
+        "plus": job.plus,
+        "executables": dict((filename, executable.digest)
+                            for filename, executable
+                            in job.executables.iteritems()),
+        }
+    try:
+        cache.put(key, entry)
+    except (IOError, OSError):
+        logger.warning("Couldn't store compilation in the cache.",
+                       exc_info=True)
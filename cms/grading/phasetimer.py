@@ -0,0 +1,130 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measurement of the time spent by the jobs in each of their phases.
+
+A Worker slot has a PhaseTimer, reset at the start of each job; the
+code executing the job (sandbox lifecycle, file placement, running
+the commands, checking) marks its phases with timed_phase(), which
+finds the timer through the file cacher, as create_sandbox does for
+the sandbox pool.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+
+from cmscommon.datetime import monotonic_time
+
+
+class PhaseTimer(object):
+    """Accumulate the time spent in each phase of a job.
+
+    Phases can be nested: the time is attributed only to the
+    innermost one (for example, placing the correct output in the
+    sandbox while checking counts as a file fetch, not as checking),
+    so that the times of the phases of a job add up to at most the
+    time of the job.
+
+    """
+
+    SANDBOX_CREATION = "sandbox_creation"
+    FILE_FETCH_HIT = "file_fetch_hit"
+    FILE_FETCH_MISS = "file_fetch_miss"
+    COMPILATION = "compilation"
+    EXECUTION = "execution"
+    CHECKING = "checking"
+    OUTPUT_UPLOAD = "output_upload"
+    SANDBOX_DELETION = "sandbox_deletion"
+
+    PHASES = [SANDBOX_CREATION, FILE_FETCH_HIT, FILE_FETCH_MISS,
+              COMPILATION, EXECUTION, CHECKING, OUTPUT_UPLOAD,
+              SANDBOX_DELETION]
+
+    def __init__(self):
+        # Seconds spent and times entered in each phase, since the
+        # last reset.
+        # Type: {unicode: float}
+        self.times = {}
+        # Type: {unicode: int}
+        self.counts = {}
+        # Phases entered and not exited, the innermost last.
+        self._active = []
+        # When the innermost active phase was last entered or resumed.
+        self._since = None
+
+    def reset(self):
+        """Forget the times measured so far."""
+        self.times = {}
+        self.counts = {}
+
+    def _account(self, now):
+        """Attribute the time since the last event to the innermost
+        active phase, if any.
+
+        now (float): the current time.
+
+        """
+        if len(self._active) > 0:
+            phase = self._active[-1]
+            self.times[phase] = \
+                self.times.get(phase, 0.0) + now - self._since
+        self._since = now
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the time spent in the with-block as a phase.
+
+        name (unicode): the phase, one of PHASES.
+
+        """
+        self._account(monotonic_time())
+        self._active.append(name)
+        self.counts[name] = self.counts.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            self._account(monotonic_time())
+            self._active.pop()
+
+
+@contextmanager
+def _no_phase():
+    yield
+
+
+def timed_phase(file_cacher, name):
+    """Measure a phase of the job executed with the given file cacher.
+
+    file_cacher (FileCacher|None): the file cacher used by the job;
+        if its service (i.e., a Worker slot) has a PhaseTimer in its
+        phase_timer attribute, the phase is measured by it.
+    name (unicode): the phase, one of PhaseTimer.PHASES.
+
+    return (context manager): measures the time spent in its block.
+
+    """
+    timer = getattr(getattr(file_cacher, "service", None),
+                    "phase_timer", None)
+    if not isinstance(timer, PhaseTimer):
+        return _no_phase()
+    return timer.phase(name)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A pool of sandboxes initialized in advance, and sandboxes kept
+between the jobs of a job group.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import weakref
+
+from collections import OrderedDict
+
+import gevent
+
+from cms.grading.Sandbox import Sandbox, SandboxInterfaceException
+
+
+logger = logging.getLogger(__name__)
+
+
+class SandboxPool(object):
+    """Keep some sandboxes ready to be used.
+
+    Creating a sandbox requires creating its directories and
+    initializing isolate's box, and deleting it requires the opposite;
+    doing so for each testcase is expensive when the testcases are
+    small. The pool keeps a fixed number of sandboxes, either ready or
+    in use: they are handed out by get(), and when given back with
+    put() they are reset and made ready again. Both the creation of
+    new sandboxes and the reset of old ones happen in the background.
+
+    """
+
+    def __init__(self, file_cacher, size):
+        """Create an empty pool.
+
+        file_cacher (FileCacher): the file cacher to give to the
+            sandboxes (which also determines their box ids).
+        size (int): the number of sandboxes to keep.
+
+        """
+        self.file_cacher = file_cacher
+        self.size = size
+
+        # Type: [Sandbox]
+        self._ready = []
+        # Number of sandboxes being created or reset.
+        self._preparing = 0
+        # The sandboxes handed out and not given back yet; weak
+        # references, as a job failing badly may just forget them.
+        # Type: WeakSet(Sandbox)
+        self._in_use = weakref.WeakSet()
+
+    def __len__(self):
+        return len(self._ready)
+
+    def _missing(self):
+        """Return the number of sandboxes the pool should add.
+
+        return (int): how many sandboxes are needed to reach the
+            size of the pool.
+
+        """
+        return self.size - len(self._ready) - self._preparing \
+            - len(self._in_use)
+
+    def fill(self):
+        """Start preparing the sandboxes missing from the pool.
+
+        """
+        while self._missing() > 0:
+            self._preparing += 1
+            gevent.spawn(self._prepare, None)
+
+    def _prepare(self, sandbox):
+        """Make a sandbox ready and add it to the pool.
+
+        sandbox (Sandbox|None): the sandbox to reset, or None to
+            create a new one.
+
+        """
+        try:
+            if sandbox is None:
+                sandbox = Sandbox(False, self.file_cacher)
+            else:
+                sandbox.reset()
+        except (OSError, IOError, SandboxInterfaceException):
+            logger.warning("Couldn't prepare a sandbox for the pool.",
+                           exc_info=True)
+            if sandbox is not None:
+                self._delete(sandbox)
+            return
+        finally:
+            self._preparing -= 1
+
+        if self._missing() >= 0:
+            self._ready.append(sandbox)
+        else:
+            self._delete(sandbox)
+
+    @staticmethod
+    def _delete(sandbox):
+        """Delete a sandbox not needed anymore.
+
+        sandbox (Sandbox): the sandbox to delete.
+
+        """
+        try:
+            sandbox.delete()
+        except (OSError, IOError):
+            logger.warning("Couldn't delete sandbox.", exc_info=True)
+
+    def get(self, multithreaded):
+        """Return a ready sandbox, if any.
+
+        multithreaded (boolean): whether the sandbox should allow
+            multithreading.
+
+        return (Sandbox|None): a sandbox, to be given back with put(),
+            or None if no sandbox is ready yet.
+
+        """
+        sandbox = None
+        if len(self._ready) > 0:
+            sandbox = self._ready.pop()
+            sandbox.set_multithreaded(multithreaded)
+            sandbox.pool = self
+            self._in_use.add(sandbox)
+        self.fill()
+        return sandbox
+
+    def put(self, sandbox):
+        """Give back to the pool a sandbox not needed anymore.
+
+        sandbox (Sandbox): a sandbox obtained with get().
+
+        """
+        sandbox.pool = None
+        self._in_use.discard(sandbox)
+        if self._missing() > 0:
+            self._preparing += 1
+            gevent.spawn(self._prepare, sandbox)
+        else:
+            gevent.spawn(self._delete, sandbox)
+
+    def discard(self, sandbox):
+        """Forget a sandbox obtained with get() which will be kept.
+
+        sandbox (Sandbox): the sandbox.
+
+        """
+        sandbox.pool = None
+        self._in_use.discard(sandbox)
+        self.fill()
+
+    def clear(self):
+        """Delete the sandboxes ready in the pool.
+
+        """
+        ready = self._ready
+        self._ready = []
+        for sandbox in ready:
+            self._delete(sandbox)
+
+
+class SandboxSession(object):
+    """Keep some sandboxes between the jobs of a job group.
+
+    The evaluations of a submission on the testcases of a job group
+    all place the same executables in a sandbox. A task type can give
+    a sandbox to the session, together with a key describing its
+    content and the files to keep, and the next job with the same key
+    receives it with those files already in place. The sandbox is
+    reset in the meantime: isolate's box is re-initialized and all
+    other files are removed, so that the executions are as isolated
+    as in different sandboxes, and each has its own logs.
+
+    """
+
+    def __init__(self, size=2):
+        """Create an empty session.
+
+        size (int): the maximum number of sandboxes to keep; when
+            more are given, the oldest are deleted.
+
+        """
+        self.size = size
+
+        # Type: {object: Sandbox}
+        self._sandboxes = OrderedDict()
+
+    def __len__(self):
+        return len(self._sandboxes)
+
+    def get(self, key, multithreaded):
+        """Return the sandbox kept with the given key, if any.
+
+        key (object): the key the sandbox was given with.
+        multithreaded (boolean): whether the sandbox should allow
+            multithreading.
+
+        return (Sandbox|None): a sandbox containing the files in its
+            kept_files, or None.
+
+        """
+        sandbox = self._sandboxes.pop(key, None)
+        if sandbox is not None:
+            sandbox.set_multithreaded(multithreaded)
+        return sandbox
+
+    def put(self, key, sandbox, keep):
+        """Reset a sandbox and keep it for the next jobs.
+
+        key (object): a hashable description of the kept files (for
+            example, including their digests).
+        sandbox (Sandbox): the sandbox, not needed anymore by its job.
+        keep ([string]): names of the files in the root of the
+            sandbox to keep.
+
+        """
+        try:
+            sandbox.reset(keep)
+        except (OSError, IOError, SandboxInterfaceException):
+            logger.warning("Couldn't reset sandbox.", exc_info=True)
+            self._delete(sandbox)
+            return
+
+        old_sandbox = self._sandboxes.pop(key, None)
+        if old_sandbox is not None:
+            self._delete(old_sandbox)
+        self._sandboxes[key] = sandbox
+        while len(self._sandboxes) > self.size:
+            self._delete(self._sandboxes.popitem(last=False)[1])
+
+    @staticmethod
+    def _delete(sandbox):
+        """Delete a sandbox, or give it back to its pool.
+
+        sandbox (Sandbox): the sandbox to delete.
+
+        """
+        if sandbox.pool is not None:
+            sandbox.pool.put(sandbox)
+        else:
+            SandboxPool._delete(sandbox)
+
+    def close(self):
+        """Delete all the sandboxes kept.
+
+        """
+        sandboxes = self._sandboxes.values()
+        self._sandboxes.clear()
+        for sandbox in sandboxes:
+            self._delete(sandbox)
@@ -51,3 +51,7 @@ class GroupMin(ScoreTypeGroup):
     def reduce(self, outcomes, unused_parameter):
         """See ScoreTypeGroup."""
         return min(outcomes)
+
+    def is_reduce_determined(self, outcomes, unused_parameter):
+        """See ScoreTypeGroup."""
+        return any(outcome <= 0.0 for outcome in outcomes)
@@ -58,3 +58,8 @@ class GroupThreshold(ScoreTypeGroup):
             return 1.0
         else:
             return 0.0
+
+    def is_reduce_determined(self, outcomes, parameter):
+        """See ScoreTypeGroup."""
+        threshold = parameter[2]
+        return not all(0 < outcome <= threshold for outcome in outcomes)
@@ -29,11 +29,15 @@ import logging
 
 from cms.grading import compilation_step, evaluation_step, \
     human_evaluation_message, is_evaluation_passed, extract_outcome_and_text, \
-    white_diff_step
+    white_diff_step, get_output_size_limit, is_output_too_large, \
+    EVALUATION_MESSAGES
 from cms.grading.languagemanager import \
     LANGUAGES, HEADER_EXTS, SOURCE_EXTS, OBJECT_EXTS, get_language
 from cms.grading.ParameterTypes import ParameterTypeCollection, \
     ParameterTypeChoice, ParameterTypeString
+from cms.grading.phasetimer import PhaseTimer, timed_phase
+from cms.grading.compilationcache import get_compilation_key, \
+    load_compilation, store_compilation
 from cms.grading.TaskType import TaskType, \
     create_sandbox, delete_sandbox
 from cms.db import Executable
@@ -154,11 +158,7 @@ class Batch(TaskType):
                          len(job.files), extra={"operation": job.info})
             return True
 
-        # Create the sandbox
-        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
-        job.sandboxes.append(sandbox.path)
-
-        # Prepare the source files in the sandbox
+        # Prepare the source files to put in the sandbox
         files_to_get = {}
         format_filename = job.files.keys()[0]
         source_filenames = []
@@ -185,14 +185,23 @@ class Batch(TaskType):
                 files_to_get[filename] = \
                     job.managers[filename].digest
 
-        for filename, digest in files_to_get.iteritems():
-            sandbox.create_file_from_storage(filename, digest)
-
         # Prepare the compilation command
         executable_filename = format_filename.replace(".%l", "")
         commands = language.get_compilation_commands(
             source_filenames, executable_filename)
 
+        # The same compilation may have been done already
+        cache_key = get_compilation_key(language, files_to_get, commands)
+        if load_compilation(job, file_cacher, cache_key):
+            return
+
+        # Create the sandbox
+        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
+        job.sandboxes.append(sandbox.path)
+
+        for filename, digest in files_to_get.iteritems():
+            sandbox.create_file_from_storage(filename, digest)
+
         # Run the compilation
         operation_success, compilation_success, text, plus = \
             compilation_step(sandbox, commands)
@@ -209,17 +218,29 @@ class Batch(TaskType):
                 (executable_filename, job.info))
             job.executables[executable_filename] = \
                 Executable(executable_filename, digest)
+        store_compilation(job, cache_key)
 
         # Cleanup
         delete_sandbox(sandbox, job.success)
 
     def evaluate(self, job, file_cacher):
         """See TaskType.evaluate."""
+        # The sandbox can be used again by the next testcases of the
+        # job group, without placing the executables again.
+        executable_filename = job.executables.keys()[0]
+        files_to_keep = [executable_filename]
+        reuse_key = ["Batch", executable_filename,
+                     job.executables[executable_filename].digest]
+        if self.parameters[2] == "comparator" and "checker" in job.managers:
+            files_to_keep.append("checker")
+            reuse_key += ["checker", job.managers["checker"].digest]
+        reuse_key = tuple(reuse_key)
+
         # Create the sandbox
-        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
+        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox,
+                                 reuse_key=reuse_key)
 
         # Prepare the execution
-        executable_filename = job.executables.keys()[0]
         language = get_language(job.language)
         commands = language.get_evaluation_commands(
             executable_filename,
@@ -243,22 +264,32 @@ class Batch(TaskType):
         files_to_get = {
             input_filename: job.input
             }
+        # Stop outputs too large to be correct; only with white diff,
+        # as a checker may accept outputs much larger than the
+        # reference one.
+        max_output_size = None
+        if not job.only_execution and self.parameters[2] == "diff":
+            max_output_size = get_output_size_limit(file_cacher, job.output)
 
         # Put the required files into the sandbox
         for filename, digest in executables_to_get.iteritems():
-            sandbox.create_file_from_storage(filename, digest, executable=True)
+            if filename not in sandbox.kept_files:
+                sandbox.create_file_from_storage(filename, digest,
+                                                 executable=True)
         for filename, digest in files_to_get.iteritems():
             sandbox.create_file_from_storage(filename, digest)
 
         # Actually performs the execution
-        success, plus = evaluation_step(
-            sandbox,
-            commands,
-            job.time_limit,
-            job.memory_limit,
-            writable_files=files_allowing_write,
-            stdin_redirect=stdin_redirect,
-            stdout_redirect=stdout_redirect)
+        with timed_phase(file_cacher, PhaseTimer.EXECUTION):
+            success, plus = evaluation_step(
+                sandbox,
+                commands,
+                job.time_limit,
+                job.memory_limit,
+                writable_files=files_allowing_write,
+                stdin_redirect=stdin_redirect,
+                stdout_redirect=stdout_redirect,
+                max_output_size=max_output_size)
 
         job.sandboxes = [sandbox.path]
         job.plus = plus
@@ -302,6 +333,12 @@ class Batch(TaskType):
                     outcome = 0.0
                     text = [N_("Execution completed successfully")]
 
+                # Outputs too large are wrong, without checking them.
+                elif is_output_too_large(sandbox, output_filename,
+                                         max_output_size):
+                    outcome = 0.0
+                    text = [EVALUATION_MESSAGES.get("outputlimit").message]
+
                 # Otherwise evaluate the output file.
                 else:
 
@@ -327,10 +364,11 @@ class Batch(TaskType):
                             success = False
 
                         else:
-                            sandbox.create_file_from_storage(
-                                manager_filename,
-                                job.managers[manager_filename].digest,
-                                executable=True)
+                            if manager_filename not in sandbox.kept_files:
+                                sandbox.create_file_from_storage(
+                                    manager_filename,
+                                    job.managers[manager_filename].digest,
+                                    executable=True)
                             # Rewrite input file. The untrusted
                             # contestant program should not be able to
                             # modify it; however, the grader may
@@ -356,10 +394,13 @@ class Batch(TaskType):
                             # to avoid fork-bombing the worker.
                             sandbox.max_processes = 1000
 
-                            success, _ = evaluation_step(
-                                sandbox,
-                                [["./%s" % manager_filename,
-                                  input_filename, "res.txt", output_filename]])
+                            with timed_phase(file_cacher,
+                                             PhaseTimer.CHECKING):
+                                success, _ = evaluation_step(
+                                    sandbox,
+                                    [["./%s" % manager_filename,
+                                      input_filename, "res.txt",
+                                      output_filename]])
                         if success:
                             try:
                                 outcome, text = \
@@ -380,4 +421,5 @@ class Batch(TaskType):
         job.outcome = "%s" % outcome if outcome is not None else None
         job.text = text
 
-        delete_sandbox(sandbox, job.success)
+        delete_sandbox(sandbox, job.success, reuse_key=reuse_key,
+                       keep=files_to_keep)
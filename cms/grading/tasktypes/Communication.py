@@ -38,6 +38,9 @@ from cms.grading import compilation_step, \
 from cms.grading.languagemanager import \
     LANGUAGES, HEADER_EXTS, SOURCE_EXTS, OBJECT_EXTS, get_language
 from cms.grading.ParameterTypes import ParameterTypeInt
+from cms.grading.compilationcache import get_compilation_key, \
+    load_compilation, store_compilation
+from cms.grading.phasetimer import PhaseTimer, timed_phase
 from cms.grading.TaskType import TaskType, \
     create_sandbox, delete_sandbox
 from cms.db import Executable
@@ -111,11 +114,7 @@ class Communication(TaskType):
         language = get_language(job.language)
         source_ext = language.source_extension
 
-        # Create the sandbox
-        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
-        job.sandboxes.append(sandbox.path)
-
-        # Prepare the source files in the sandbox
+        # Prepare the source files to put in the sandbox
         files_to_get = {}
         source_filenames = []
         # Stub.
@@ -140,9 +139,6 @@ class Communication(TaskType):
                 files_to_get[filename] = \
                     job.managers[filename].digest
 
-        for filename, digest in files_to_get.iteritems():
-            sandbox.create_file_from_storage(filename, digest)
-
         # Prepare the compilation command
         executable_filename = \
             "_".join(pattern.replace(".%l", "")
@@ -150,6 +146,18 @@ class Communication(TaskType):
         commands = language.get_compilation_commands(
             source_filenames, executable_filename)
 
+        # The same compilation may have been done already
+        cache_key = get_compilation_key(language, files_to_get, commands)
+        if load_compilation(job, file_cacher, cache_key):
+            return
+
+        # Create the sandbox
+        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
+        job.sandboxes.append(sandbox.path)
+
+        for filename, digest in files_to_get.iteritems():
+            sandbox.create_file_from_storage(filename, digest)
+
         # Run the compilation
         operation_success, compilation_success, text, plus = \
             compilation_step(sandbox, commands)
@@ -166,6 +174,7 @@ class Communication(TaskType):
                 (executable_filename, job.info))
             job.executables[executable_filename] = \
                 Executable(executable_filename, digest)
+        store_compilation(job, cache_key)
 
         # Cleanup
         delete_sandbox(sandbox, job.success)
@@ -244,7 +253,8 @@ class Communication(TaskType):
             # is the last command in commands, and that the previous
             # are "setup" that doesn't need tight control.
             if len(commands) > 1:
-                evaluation_step(sandbox_user[i], commands[:-1], 10, 256)
+                with timed_phase(file_cacher, PhaseTimer.EXECUTION):
+                    evaluation_step(sandbox_user[i], commands[:-1], 10, 256)
             processes[i] = evaluation_step_before_run(
                 sandbox_user[i],
                 commands[-1],
@@ -253,7 +263,8 @@ class Communication(TaskType):
                 allow_dirs=user_allow_dirs)
 
         # Consume output.
-        wait_without_std(processes + [manager])
+        with timed_phase(file_cacher, PhaseTimer.EXECUTION):
+            wait_without_std(processes + [manager])
         # TODO: check exit codes with translate_box_exitcode.
 
         user_results = [evaluation_step_after_run(s) for s in sandbox_user]
@@ -33,6 +33,7 @@ import logging
 from cms.grading.TaskType import TaskType, \
     create_sandbox, delete_sandbox
 from cms.grading.ParameterTypes import ParameterTypeChoice
+from cms.grading.phasetimer import PhaseTimer, timed_phase
 from cms.grading import white_diff_step, evaluation_step, \
     extract_outcome_and_text
 
@@ -151,10 +152,11 @@ class OutputOnly(TaskType):
                 sandbox.create_file_from_storage(
                     "input.txt",
                     input_digest)
-                success, _ = evaluation_step(
-                    sandbox,
-                    [["./%s" % manager_filename,
-                      "input.txt", "res.txt", "output.txt"]])
+                with timed_phase(file_cacher, PhaseTimer.CHECKING):
+                    success, _ = evaluation_step(
+                        sandbox,
+                        [["./%s" % manager_filename,
+                          "input.txt", "res.txt", "output.txt"]])
                 if success:
                     outcome, text = extract_outcome_and_text(sandbox)
 
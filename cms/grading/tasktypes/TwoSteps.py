@@ -35,8 +35,12 @@ from cms.grading.ParameterTypes import ParameterTypeChoice
 from cms.grading import compilation_step, \
     evaluation_step, evaluation_step_before_run, evaluation_step_after_run, \
     is_evaluation_passed, human_evaluation_message, \
-    extract_outcome_and_text, white_diff_step
+    extract_outcome_and_text, white_diff_step, get_output_size_limit, \
+    is_output_too_large, EVALUATION_MESSAGES
+from cms.grading.phasetimer import PhaseTimer, timed_phase
 from cms.grading.languagemanager import LANGUAGES, get_language
+from cms.grading.compilationcache import get_compilation_key, \
+    load_compilation, store_compilation
 from cms.grading.TaskType import TaskType, \
     create_sandbox, delete_sandbox
 from cms.db import Executable
@@ -141,8 +145,6 @@ class TwoSteps(TaskType):
             return True
 
         # First and only one compilation.
-        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
-        job.sandboxes.append(sandbox.path)
         files_to_get = {}
 
         source_filenames = []
@@ -171,13 +173,21 @@ class TwoSteps(TaskType):
                 files_to_get[header_filename] = \
                     job.managers[header_filename].digest
 
-        for filename, digest in files_to_get.iteritems():
-            sandbox.create_file_from_storage(filename, digest)
-
         # Get compilation command and compile.
         executable_filename = "manager"
         commands = language.get_compilation_commands(
             source_filenames, executable_filename)
+
+        # The same compilation may have been done already
+        cache_key = get_compilation_key(language, files_to_get, commands)
+        if load_compilation(job, file_cacher, cache_key):
+            return
+
+        sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
+        job.sandboxes.append(sandbox.path)
+        for filename, digest in files_to_get.iteritems():
+            sandbox.create_file_from_storage(filename, digest)
+
         operation_success, compilation_success, text, plus = \
             compilation_step(sandbox, commands)
 
@@ -193,15 +203,24 @@ class TwoSteps(TaskType):
                 (executable_filename, job.info))
             job.executables[executable_filename] = \
                 Executable(executable_filename, digest)
+        store_compilation(job, cache_key)
 
         # Cleanup
         delete_sandbox(sandbox, job.success)
 
     def evaluate(self, job, file_cacher):
         """See TaskType.evaluate."""
-        # f stand for first, s for second.
-        first_sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
-        second_sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox)
+        # f stand for first, s for second. Both sandboxes can be used
+        # again by the next testcases of the job group, without
+        # placing the manager again.
+        manager_digest = job.executables["manager"].digest
+        first_reuse_key = ("TwoSteps", "first", manager_digest)
+        second_reuse_key = ("TwoSteps", "second", manager_digest)
+        first_sandbox = create_sandbox(file_cacher, job.multithreaded_sandbox,
+                                       reuse_key=first_reuse_key)
+        second_sandbox = create_sandbox(file_cacher,
+                                        job.multithreaded_sandbox,
+                                        reuse_key=second_reuse_key)
         fifo_dir = tempfile.mkdtemp(dir=config.temp_dir)
         fifo = os.path.join(fifo_dir, "fifo")
         os.mkfifo(fifo)
@@ -222,9 +241,9 @@ class TwoSteps(TaskType):
 
         # Put the required files into the sandbox
         for filename, digest in first_executables_to_get.iteritems():
-            first_sandbox.create_file_from_storage(filename,
-                                                   digest,
-                                                   executable=True)
+            if filename not in first_sandbox.kept_files:
+                first_sandbox.create_file_from_storage(
+                    filename, digest, executable=True)
         for filename, digest in first_files_to_get.iteritems():
             first_sandbox.create_file_from_storage(filename, digest)
 
@@ -249,12 +268,19 @@ class TwoSteps(TaskType):
 
         # Put the required files into the second sandbox
         for filename, digest in second_executables_to_get.iteritems():
-            second_sandbox.create_file_from_storage(filename,
-                                                    digest,
-                                                    executable=True)
+            if filename not in second_sandbox.kept_files:
+                second_sandbox.create_file_from_storage(
+                    filename, digest, executable=True)
         for filename, digest in second_files_to_get.iteritems():
             second_sandbox.create_file_from_storage(filename, digest)
 
+        # Stop outputs too large to be correct; only with white diff,
+        # as a checker may accept outputs much larger than the
+        # reference one.
+        max_output_size = None
+        if not job.only_execution and self.parameters[0] == "diff":
+            max_output_size = get_output_size_limit(file_cacher, job.output)
+
         second = evaluation_step_before_run(
             second_sandbox,
             second_command,
@@ -262,10 +288,12 @@ class TwoSteps(TaskType):
             job.memory_limit,
             second_allow_path,
             stdout_redirect="output.txt",
-            wait=False)
+            wait=False,
+            max_output_size=max_output_size)
 
         # Consume output.
-        wait_without_std([second, first])
+        with timed_phase(file_cacher, PhaseTimer.EXECUTION):
+            wait_without_std([second, first])
         # TODO: check exit codes with translate_box_exitcode.
 
         success_first, first_plus = \
@@ -313,8 +341,14 @@ class TwoSteps(TaskType):
                         "output.txt",
                         "Output file in job %s" % job.info)
 
+                # Outputs too large are wrong, without checking them.
+                if is_output_too_large(second_sandbox, "output.txt",
+                                       max_output_size):
+                    outcome = 0.0
+                    text = [EVALUATION_MESSAGES.get("outputlimit").message]
+
                 # If not asked otherwise, evaluate the output file
-                if not job.only_execution:
+                elif not job.only_execution:
                     # Put the reference solution into the sandbox
                     second_sandbox.create_file_from_storage(
                         "res.txt",
@@ -346,10 +380,13 @@ class TwoSteps(TaskType):
                             second_sandbox.create_file_from_storage(
                                 "input.txt",
                                 job.input)
-                            success, _ = evaluation_step(
-                                second_sandbox,
-                                [["./%s" % TwoSteps.CHECKER_FILENAME,
-                                  "input.txt", "res.txt", "output.txt"]])
+                            with timed_phase(file_cacher,
+                                             PhaseTimer.CHECKING):
+                                success, _ = evaluation_step(
+                                    second_sandbox,
+                                    [["./%s" % TwoSteps.CHECKER_FILENAME,
+                                      "input.txt", "res.txt",
+                                      "output.txt"]])
                             if success:
                                 try:
                                     outcome, text = extract_outcome_and_text(
@@ -369,8 +406,10 @@ class TwoSteps(TaskType):
         job.outcome = str(outcome) if outcome is not None else None
         job.text = text
 
-        delete_sandbox(first_sandbox, job.success)
-        delete_sandbox(second_sandbox, job.success)
+        delete_sandbox(first_sandbox, job.success,
+                       reuse_key=first_reuse_key, keep=[first_filename])
+        delete_sandbox(second_sandbox, job.success,
+                       reuse_key=second_reuse_key, keep=[second_filename])
 
     def get_user_managers(self, unused_submission_format):
         """See TaskType.get_user_managers."""
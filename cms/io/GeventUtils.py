@@ -58,8 +58,16 @@ import gevent
 
 
 # XXX Use buffer_size=io.DEFAULT_BUFFER_SIZE?
-def copyfileobj(fsrc, fdst, buffer_size=16 * 1024):
-    """copy data from file-like object fsrc to file-like object fdst"""
+def copyfileobj(fsrc, fdst, buffer_size=16 * 1024, max_buffer_size=None):
+    """copy data from file-like object fsrc to file-like object fdst
+
+    If max_buffer_size is given, the size of the chunks starts from
+    buffer_size and doubles after each of them, up to max_buffer_size:
+    this reduces the number of round trips when the objects are
+    remote (e.g., large objects in the database), without using large
+    buffers for small files.
+
+    """
     # file.write() behaves differently from io.FileIO.write(): the
     # latter returns the number of bytes written, the former doesn't.
     # This functions tries to support both behaviors by detecting which
@@ -73,6 +81,8 @@ def copyfileobj(fsrc, fdst, buffer_size=16 * 1024):
             if written is None:
                 break
             buf = buf[written:]
+        if max_buffer_size is not None:
+            buffer_size = min(buffer_size * 2, max_buffer_size)
         buf = fsrc.read(buffer_size)
 
 
@@ -43,6 +43,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import heapq
+
 from gevent.event import Event
 
 from cmscommon.datetime import make_datetime, make_timestamp
@@ -56,6 +58,9 @@ class QueueItem(object):
 
     """
 
+    # Subclasses may define __slots__ to save memory.
+    __slots__ = ()
+
     def to_dict(self):
         """Return a dict() representation of the object."""
         return self.__dict__
@@ -67,6 +72,8 @@ class QueueEntry(object):
 
     """
 
+    __slots__ = ("item", "priority", "timestamp", "index")
+
     def __init__(self, item, priority, timestamp, index):
         """Create a QueueEntry object.
 
@@ -76,21 +83,22 @@ class QueueEntry(object):
         index (int): used to enforce strict ordering.
 
         """
-        # TODO: item is not actually necessary, as we store the whole
-        # item in the reverse lookup array.
         self.item = item
         self.priority = priority
         self.timestamp = timestamp
         self.index = index
 
+    def key(self):
+        """Return the key by which entries are ordered.
+
+        return ((int, datetime, int)): priority, timestamp and index.
+
+        """
+        return (self.priority, self.timestamp, self.index)
+
     def __cmp__(self, other):
         """Compare self's and other's priorities."""
-        if self.priority != other.priority:
-            return cmp(self.priority, other.priority)
-        elif self.timestamp != other.timestamp:
-            return cmp(self.timestamp, other.timestamp)
-        else:
-            return cmp(self.index, other.index)
+        return cmp(self.key(), other.key())
 
 
 class PriorityQueue(object):
@@ -100,9 +108,13 @@ class PriorityQueue(object):
     It is greenlet-safe, and offers the ability of changing priorities
     and removing arbitrary items.
 
-    The queue is implemented as a custom min-heap. The priority is a
-    mix of a discrete priority level and of the timestamp. The
-    elements of the queue are QueueItems.
+    The queue is implemented as a min-heap (managed by heapq) of
+    tuples (priority, timestamp, index, entry), so that comparisons
+    never involve Python code. Removed entries and entries whose
+    priority changed are not removed from the heap, but just from
+    the dictionary of the entries in the queue, and are skipped when
+    they reach the top; the heap is rebuilt when they become more
+    than the valid ones. The elements of the queue are QueueItems.
 
     """
 
@@ -115,12 +127,13 @@ class PriorityQueue(object):
     def __init__(self):
         """Create a priority queue."""
         # The queue: a min-heap whose elements are of the form
-        # (priority, timestamp, item), where item is the actual data.
+        # (priority, timestamp, index, entry); the index is unique,
+        # hence entries are never compared.
         self._queue = []
 
-        # Reverse lookup for the items in the queue: a dictionary
-        # associating the index in the queue to each item.
-        self._reverse = {}
+        # The entries in the queue, indexed by their item. An element
+        # of the heap is valid if its entry is the one here.
+        self._entries = {}
 
         # Event to signal that there are items in the queue.
         self._event = Event()
@@ -129,7 +142,7 @@ class PriorityQueue(object):
         self._next_index = 0
 
     def __len__(self):
-        return len(self._queue)
+        return len(self._entries)
 
     def _verify(self):
         """Make sure that the internal state of the queue is consistent.
@@ -137,17 +150,21 @@ class PriorityQueue(object):
         This is used only for testing.
 
         """
-        if len(self._queue) != len(self._reverse):
+        valid = [element for element in self._queue
+                 if self._is_valid(element)]
+        if len(valid) != len(self._entries):
             return False
-        if len(self._queue) != self.length():
+        if len(self._entries) != self.length():
             return False
         if self.empty() != (self.length() == 0):
             return False
         if self._event.isSet() == self.empty():
             return False
-        for item, idx in self._reverse.iteritems():
-            if self._queue[idx].item != item:
+        for item, entry in self._entries.iteritems():
+            if entry.item != item:
                 return False
+        if len(self._queue) > 0 and not self._is_valid(self._queue[0]):
+            return False
         return True
 
     def __contains__(self, item):
@@ -158,72 +175,63 @@ class PriorityQueue(object):
         return (bool): True if item is in the queue.
 
         """
-        return item in self._reverse
+        return item in self._entries
 
-    def _swap(self, idx1, idx2):
-        """Swap two elements in the queue, keeping their reverse
-        indices up to date.
+    def _is_valid(self, element):
+        """Return whether an element of the heap is still in the queue.
 
-        idx1 (int): the index of the first element.
-        idx2 (int): the index of the second element.
+        element ((int, datetime, int, QueueEntry)): the element.
 
-        """
-        self._queue[idx1], self._queue[idx2] = \
-            self._queue[idx2], self._queue[idx1]
-        self._reverse[self._queue[idx1].item] = idx1
-        self._reverse[self._queue[idx2].item] = idx2
+        return (bool): True if the entry has not been removed.
 
-    def _up_heap(self, idx):
-        """Take the element in position idx up in the heap until its
-        position is the right one.
+        """
+        entry = element[3]
+        return self._entries.get(entry.item) is entry
 
-        idx (int): the index of the element to lift.
+    def _clean(self):
+        """Restore the invariants after entries have been invalidated.
 
-        return (int): the new index of the element.
+        Drop the invalid elements at the top of the heap (so that the
+        first element is always valid) and rebuild the heap if there
+        are too many invalid elements.
 
         """
-        while idx > 0:
-            parent = (idx - 1) // 2
-            if self._queue[idx] < self._queue[parent]:
-                self._swap(parent, idx)
-                idx = parent
-            else:
-                break
-        return idx
+        if len(self._queue) > 2 * len(self._entries) + 16:
+            self._queue = [element for element in self._queue
+                           if self._is_valid(element)]
+            heapq.heapify(self._queue)
+        while len(self._queue) > 0 and not self._is_valid(self._queue[0]):
+            heapq.heappop(self._queue)
+        if len(self._entries) == 0:
+            # Signal that there is nothing left for listeners.
+            self._event.clear()
 
-    def _down_heap(self, idx):
-        """Take the element in position idx down in the heap until its
-        position is the right one.
+    def _add(self, item, priority, timestamp):
+        """Add an entry without touching the heap.
 
-        idx (int): the index of the element to lower.
+        item (QueueItem): the item to add to the queue.
+        priority (int|None): the priority of the item.
+        timestamp (datetime|None): the time of the submission.
 
-        return (int): the new index of the element.
+        return ((int, datetime, int, QueueEntry)|None): the element
+            to add to the heap, or None if the item was already in
+            the queue.
 
         """
-        last = len(self._queue) - 1
-        while 2 * idx + 1 <= last:
-            child = 2 * idx + 1
-            if 2 * idx + 2 <= last and \
-                    self._queue[2 * idx + 2] < self._queue[child]:
-                child = 2 * idx + 2
-            if self._queue[child] < self._queue[idx]:
-                self._swap(child, idx)
-                idx = child
-            else:
-                break
-        return idx
+        if item in self._entries:
+            return None
 
-    def _updown_heap(self, idx):
-        """Perform both operations of up_heap and down_heap on an
-        element.
+        if priority is None:
+            priority = PriorityQueue.PRIORITY_MEDIUM
+        if timestamp is None:
+            timestamp = make_datetime()
 
-        idx (int): the index of the element to lift.
+        index = self._next_index
+        self._next_index += 1
 
-        return (int): the new index of the element.
-
-        """
-        idx = self._up_heap(idx)
-        return self._down_heap(idx)
+        entry = QueueEntry(item, priority, timestamp, index)
+        self._entries[item] = entry
+        return (priority, timestamp, index, entry)
 
     def push(self, item, priority=None, timestamp=None):
         """Push an item in the queue. If timestamp is not specified,
@@ -239,27 +247,46 @@ class PriorityQueue(object):
             and was not pushed again, true otherwise..
 
         """
-        if item in self._reverse:
+        element = self._add(item, priority, timestamp)
+        if element is None:
             return False
-
-        if priority is None:
-            priority = PriorityQueue.PRIORITY_MEDIUM
-        if timestamp is None:
-            timestamp = make_datetime()
-
-        index = self._next_index
-        self._next_index += 1
-
-        self._queue.append(QueueEntry(item, priority, timestamp, index))
-        last = len(self._queue) - 1
-        self._reverse[item] = last
-        self._up_heap(last)
+        heapq.heappush(self._queue, element)
 
         # Signal to listener greenlets that there might be something.
         self._event.set()
 
         return True
 
+    def push_many(self, items):
+        """Push several items in the queue.
+
+        items ([(QueueItem, int|None, datetime|None)]): the items to
+            add to the queue, with their priority and timestamp (see
+            push).
+
+        return (int): the number of items actually pushed (that is,
+            not already in the queue).
+
+        """
+        elements = []
+        for item, priority, timestamp in items:
+            element = self._add(item, priority, timestamp)
+            if element is not None:
+                elements.append(element)
+        if len(elements) == 0:
+            return 0
+
+        if len(elements) > len(self._queue):
+            # Cheaper to rebuild the whole heap.
+            self._queue.extend(elements)
+            heapq.heapify(self._queue)
+        else:
+            for element in elements:
+                heapq.heappush(self._queue, element)
+
+        self._event.set()
+        return len(elements)
+
     def top(self, wait=False):
         """Return the first element in the queue without extracting it.
 
@@ -271,7 +298,7 @@ class PriorityQueue(object):
 
         """
         if not self.empty():
-            return self._queue[0]
+            return self._queue[0][3]
         else:
             if not wait:
                 raise LookupError("Empty queue.")
@@ -280,7 +307,7 @@ class PriorityQueue(object):
                     if self.empty():
                         self._event.wait()
                         continue
-                    return self._queue[0]
+                    return self._queue[0][3]
 
     def pop(self, wait=False):
         """Extract (and return) the first element in the queue.
@@ -293,19 +320,28 @@ class PriorityQueue(object):
 
         """
         top = self.top(wait)
-        last = len(self._queue) - 1
-        self._swap(0, last)
+        heapq.heappop(self._queue)
+        del self._entries[top.item]
+        self._clean()
+        return top
 
-        del self._reverse[top.item]
-        del self._queue[last]
+    def pop_many(self, number, wait=False):
+        """Extract (and return) the first elements in the queue.
 
-        # last is 0 when the queue becomes empty.
-        if last > 0:
-            self._down_heap(0)
-        else:
-            # Signal that there is nothing left for listeners.
-            self._event.clear()
-        return top
+        number (int): the maximum number of elements to extract.
+        wait (bool): if True, block until an element is present.
+
+        return ([QueueEntry]): the first (at most) number elements in
+            the queue, in order; it is empty only if the queue was
+            empty and wait was false.
+
+        """
+        if number <= 0 or (self.empty() and not wait):
+            return []
+        entries = [self.pop(wait)]
+        while len(entries) < number and not self.empty():
+            entries.append(self.pop())
+        return entries
 
     def remove(self, item):
         """Remove an item from the queue. Raise a KeyError if not present.
@@ -317,20 +353,8 @@ class PriorityQueue(object):
         raise (KeyError): if item not present.
 
         """
-        pos = self._reverse[item]
-        entry = self._queue[pos]
-
-        last = len(self._queue) - 1
-        self._swap(pos, last)
-
-        del self._reverse[item]
-        del self._queue[last]
-        if pos != last:
-            self._updown_heap(pos)
-
-        if self.empty():
-            self._event.clear()
-
+        entry = self._entries.pop(item)
+        self._clean()
         return entry
 
     def set_priority(self, item, priority):
@@ -343,9 +367,13 @@ class PriorityQueue(object):
         raise (LookupError): if item not present.
 
         """
-        pos = self._reverse[item]
-        self._queue[pos].priority = priority
-        self._updown_heap(pos)
+        old_entry = self._entries[item]
+        entry = QueueEntry(item, priority, old_entry.timestamp,
+                           old_entry.index)
+        self._entries[item] = entry
+        heapq.heappush(self._queue, (priority, entry.timestamp,
+                                     entry.index, entry))
+        self._clean()
 
     def length(self):
         """Return the number of elements in the queue.
@@ -353,7 +381,7 @@ class PriorityQueue(object):
         return (int): length of the queue
 
         """
-        return len(self._queue)
+        return len(self._entries)
 
     def empty(self):
         """Return if the queue is empty.
@@ -361,7 +389,22 @@ class PriorityQueue(object):
         return (bool): is the queue empty?
 
         """
-        return self.length() == 0
+        return len(self._entries) == 0
+
+    def get_entries(self):
+        """Return the entries in the queue. Note that the order may be
+        not correct, but the first element is the one at the top.
+
+        return ([QueueEntry]): the entries in the queue.
+
+        """
+        entries = []
+        if not self.empty():
+            top = self._queue[0][3]
+            entries.append(top)
+            entries.extend(entry for entry in self._entries.itervalues()
+                           if entry is not top)
+        return entries
 
     def get_status(self):
         """Return the content of the queue. Note that the order may be not
@@ -375,7 +418,7 @@ class PriorityQueue(object):
         return [{'item': entry.item.to_dict(),
                  'priority': entry.priority,
                  'timestamp': make_timestamp(entry.timestamp)}
-                for entry in self._queue]
+                for entry in self.get_entries()]
 
 
 # Fake objects for testing follow.
@@ -86,6 +86,15 @@ class Executor(object):  # pylint: disable=R0921
         """
         return self._operation_queue.get_status()
 
+    def get_entries(self):
+        """Return the entries in the queue.
+
+        return ([QueueEntry]): the entries in the queue, the first
+            being the top one and the others not in order.
+
+        """
+        return self._operation_queue.get_entries()
+
     def enqueue(self, item, priority=None, timestamp=None):
         """Add an item to the queue.
 
@@ -124,7 +133,8 @@ class Executor(object):  # pylint: disable=R0921
                 max_operations = self.max_operations_per_batch()
                 while not self._operation_queue.empty() and (
                         max_operations == 0 or
-                        len(to_execute) < max_operations):
+                        len(to_execute) < max_operations) and \
+                        not self.batch_is_full(to_execute):
                     to_execute.append(self._operation_queue.pop())
 
             assert len(to_execute) > 0, "Expected at least one element."
@@ -167,6 +177,20 @@ class Executor(object):  # pylint: disable=R0921
         """
         return 0
 
+    def batch_is_full(self, entries):
+        """Return whether a batch must not grow further.
+
+        If the service has batch executions, this method is called
+        each time an entry is added to the batch, allowing to limit
+        its size depending on its content.
+
+        entries ([QueueEntry]): the entries in the batch so far.
+
+        return (bool): True if no more entries should be added.
+
+        """
+        return False
+
     def execute(self, entry):
         """Perform a single operation.
 
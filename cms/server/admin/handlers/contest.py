@@ -151,6 +151,7 @@ class OverviewHandler(BaseHandler):
             self.contest = self.safe_get_item(Contest, contest_id)
 
         self.r_params = self.render_params()
+        self.r_params["worker_shards"] = get_service_shards("Worker")
         self.render("overview.html", **self.r_params)
 
 
@@ -34,6 +34,7 @@ RPCS_ALLOWED_FOR_AUTHENTICATED = [
     ("ResourceService", "get_resources"),
     ("EvaluationService", "workers_status"),
     ("EvaluationService", "queue_status"),
+    ("Worker", "get_job_stats"),
     ("LogService", "last_messages"),
 ]
 
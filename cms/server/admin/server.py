@@ -41,6 +41,7 @@ from cms.db import SessionGen, Dataset, Submission, SubmissionResult, Task
 from cms.db.filecacher import FileCacher
 from cms.io import WebService, rpc_method
 from cms.service import EvaluationService
+from cms.service.esrouting import EvaluationServiceRouter
 
 from .handlers import HANDLERS
 from .handlers import views
@@ -83,8 +84,7 @@ class AdminWebServer(WebService):
         self.file_cacher = FileCacher(self)
         self.admin_web_server = self.connect_to(
             ServiceCoord("AdminWebServer", 0))
-        self.evaluation_service = self.connect_to(
-            ServiceCoord("EvaluationService", 0))
+        self.evaluation_service = EvaluationServiceRouter(self)
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
 
@@ -98,6 +98,10 @@ class AdminWebServer(WebService):
             self.resource_services.append(self.connect_to(
                 ServiceCoord("ResourceService", i)))
         self.logservice = self.connect_to(ServiceCoord("LogService", 0))
+        self.workers = []
+        for i in range(get_service_shards("Worker")):
+            self.workers.append(self.connect_to(
+                ServiceCoord("Worker", i)))
 
     def is_rpc_authorized(self, service, shard, method):
         return rpc_authorization_checker(self.auth_handler.admin_id,
@@ -50,6 +50,7 @@ from cms import ConfigError, ServiceCoord, config
 from cms.io import WebService
 from cms.db.filecacher import FileCacher
 from cms.locale import get_translations, wrap_translations_for_tornado
+from cms.service.esrouting import EvaluationServiceRouter
 
 from .handlers import HANDLERS
 
@@ -105,8 +106,7 @@ class ContestWebServer(WebService):
                       for lang_code, trans in get_translations().iteritems()}
 
         self.file_cacher = FileCacher(self)
-        self.evaluation_service = self.connect_to(
-            ServiceCoord("EvaluationService", 0))
+        self.evaluation_service = EvaluationServiceRouter(self)
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
 
@@ -36,29 +36,42 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
+import math
+import os
 
 from collections import defaultdict
 from datetime import timedelta
 from functools import wraps
 
+import gevent
 import gevent.coros
 
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 
-from cms import ServiceCoord, get_service_shards
-from cms.io import Executor, TriggeredService, rpc_method
-from cms.db import SessionGen, Dataset, Submission, UserTest
+from cms import ServiceCoord, config, mkdir
+from cms.io import Executor, RPCError, TriggeredService, rpc_method
+from cms.db import SessionGen, Dataset, Evaluation, Submission, UserTest
 from cms.db.filecacher import FileCacher
 from cms.service import get_datasets_to_judge, \
     get_submissions, get_submission_results
+from cms.grading import skipped_evaluation_text
 from cms.grading.Job import JobGroup
+from cms.grading.scoretypes import get_score_type
+from cmscommon.datetime import make_datetime, make_timestamp, \
+    monotonic_time
 
 from .esoperations import ESOperation, get_relevant_operations, \
     get_submissions_operations, get_user_tests_operations, \
-    submission_get_operations, submission_to_evaluate, \
-    user_test_get_operations
+    submission_get_operations, submission_reuse_evaluations, \
+    submission_to_evaluate, user_test_get_operations
+from .durationestimator import DurationEstimator
+from .failureestimator import FailureEstimator
+from .esrouting import get_es_shard, get_es_shards, get_es_worker_shards, \
+    get_worker_es_shard
 from .flushingdict import FlushingDict
+from .queuejournal import QueueJournal
 from .workerpool import WorkerPool
 
 
@@ -70,16 +83,23 @@ class EvaluationExecutor(Executor):
     # Real maximum number of operations to be sent to a worker.
     MAX_OPERATIONS_PER_BATCH = 25
 
-    def __init__(self, evaluation_service):
+    def __init__(self, evaluation_service, queue_journal=None):
         """Create the single executor for ES.
 
         The executor just delegates work to the worker pool.
 
+        evaluation_service (EvaluationService): the service.
+        queue_journal (QueueJournal|None): if not None, where to
+            record the changes to the queue.
+
         """
         super(EvaluationExecutor, self).__init__(True)
 
         self.evaluation_service = evaluation_service
+        self.queue_journal = queue_journal
         self.pool = WorkerPool(self.evaluation_service)
+        self.duration_estimator = DurationEstimator()
+        self.failure_estimator = FailureEstimator()
 
         # List of QueueItem (ESOperation) we have extracted from the
         # queue, but not yet finished to execute.
@@ -92,7 +112,15 @@ class EvaluationExecutor(Executor):
         # operation.
         self._drop_current = False
 
-        for i in xrange(get_service_shards("Worker")):
+        worker_shards = get_es_worker_shards(
+            self.evaluation_service.shard,
+            self.evaluation_service.es_shards)
+        if len(worker_shards) == 0:
+            logger.warning("No Worker is assigned to this shard of "
+                           "EvaluationService, hence it will not be able "
+                           "to handle its submissions: configure at least "
+                           "as many Workers as EvaluationServices.")
+        for i in worker_shards:
             worker = ServiceCoord("Worker", i)
             self.pool.add_worker(worker)
 
@@ -114,17 +142,55 @@ class EvaluationExecutor(Executor):
         """Return the maximum number of operations per batch.
 
         We derive the number from the length of the queue divided by
-        the number of workers, with a cap at MAX_OPERATIONS_PER_BATCH.
+        the number of usable workers, with a cap at
+        MAX_OPERATIONS_PER_BATCH. The batch may be further limited by
+        its estimated duration, see batch_is_full.
 
         """
-        # TODO: len(self.pool) is the total number of workers,
-        # included those that are disabled.
-        ratio = len(self._operation_queue) // len(self.pool) + 1
+        usable_workers = max(self.pool.get_usable_workers_count(), 1)
+        ratio = len(self._operation_queue) // usable_workers + 1
         ret = min(max(ratio, 1), EvaluationExecutor.MAX_OPERATIONS_PER_BATCH)
-        logger.info("Ratio is %d, executing %d operations together.",
+        logger.info("Ratio is %d, executing at most %d operations together.",
                     ratio, ret)
         return ret
 
+    def batch_is_full(self, entries):
+        """Return whether the batch is long enough to be executed.
+
+        A batch is full when its estimated duration reaches
+        config.batch_target_duration, which is long enough to make
+        the overhead of sending it to a worker negligible, but short
+        enough not to leave the other workers idle while one is
+        completing a long batch.
+
+        entries ([QueueEntry]): the entries in the batch so far.
+
+        return (bool): True if the batch is full.
+
+        """
+        duration = sum(
+            self.duration_estimator.estimate_operation(entry.item)
+            for entry in entries)
+        return duration >= config.batch_target_duration
+
+    def estimated_batch_size(self, type_, dataset_id):
+        """Return how many operations of the same kind fill a batch.
+
+        type_ (unicode): the type of the operations.
+        dataset_id (int): the dataset of the operations.
+
+        return (int): the number of operations that would be sent
+            together if they were the only ones in the queue (but not
+            considering the number of workers).
+
+        """
+        duration = self.duration_estimator.estimate(type_, dataset_id)
+        if duration <= 0:
+            return EvaluationExecutor.MAX_OPERATIONS_PER_BATCH
+        return min(
+            max(int(math.ceil(config.batch_target_duration / duration)), 1),
+            EvaluationExecutor.MAX_OPERATIONS_PER_BATCH)
+
     def execute(self, entries):
         """Execute a batch of operations in the queue.
 
@@ -139,6 +205,8 @@ class EvaluationExecutor(Executor):
             self._currently_executing = []
             for entry in entries:
                 operation = entry.item
+                # The operation stays in the journal until its result
+                # is written (see EvaluationService.write_results).
                 # Side data is attached to the operation sent to the
                 # worker pool. In case the operation is lost, the pool
                 # will return it to us, and we will use it to
@@ -157,6 +225,45 @@ class EvaluationExecutor(Executor):
                     self._currently_executing = []
                     break
 
+    def get_journal_entries(self):
+        """Return the content of the queue to record in the journal.
+
+        These are the operations in the queue and those extracted from
+        it whose results have not been received yet. The results
+        received and not written yet are not included: if ES stops
+        before writing them, the sweep after the restart finds them.
+
+        return ([(ESOperation, int, datetime)]): the operations, with
+            their priority and timestamp.
+
+        """
+        entries = [(entry.item, entry.priority, entry.timestamp)
+                   for entry in self.get_entries()]
+        seen = set(operation for operation, _, _ in entries)
+        with self._current_execution_lock:
+            operations = self._currently_executing + \
+                self.pool.get_operations()
+        for operation in operations:
+            if operation not in seen:
+                seen.add(operation)
+                priority, timestamp = operation.side_data
+                entries.append((operation, priority, timestamp))
+        return entries
+
+    def enqueue(self, item, priority=None, timestamp=None):
+        """Add an item to the queue, recording it in the journal.
+
+        See Executor.enqueue.
+
+        """
+        if timestamp is None:
+            timestamp = make_datetime()
+        ret = super(EvaluationExecutor, self).enqueue(
+            item, priority, timestamp)
+        if ret and self.queue_journal is not None:
+            self.queue_journal.record_push(item, priority, timestamp)
+        return ret
+
     def dequeue(self, operation):
         """Remove an item from the queue.
 
@@ -168,11 +275,15 @@ class EvaluationExecutor(Executor):
         """
         try:
             super(EvaluationExecutor, self).dequeue(operation)
+            if self.queue_journal is not None:
+                self.queue_journal.record_remove(operation)
         except KeyError:
             with self._current_execution_lock:
                 for i in range(len(self._currently_executing)):
                     if self._currently_executing[i] == operation:
                         del self._currently_executing[i]
+                        if self.queue_journal is not None:
+                            self.queue_journal.record_remove(operation)
                         return
             raise
 
@@ -222,6 +333,12 @@ class EvaluationService(TriggeredService):
     # How often we check if a worker is connected.
     WORKER_CONNECTION_CHECK_TIME = timedelta(seconds=10)
 
+    # How often we write to disk the changes to the queue.
+    QUEUE_JOURNAL_FLUSH_TIME = timedelta(seconds=1)
+
+    # How long we wait for the other shards of ES to answer.
+    OTHER_SHARDS_TIMEOUT = timedelta(seconds=5)
+
     # How many worker results we accumulate before processing them.
     RESULT_CACHE_SIZE = 100
     # The maximum time since the last result before processing.
@@ -232,6 +349,16 @@ class EvaluationService(TriggeredService):
 
         self.contest_id = contest_id
 
+        # The other shards of ES, which handle disjoint sets of
+        # submissions, user tests and workers (see esrouting).
+        self.es_shards = get_es_shards()
+        # Type: {int: RemoteServiceClient}
+        self.other_shards = dict(
+            (es_shard, self.connect_to(
+                ServiceCoord("EvaluationService", es_shard)))
+            for es_shard in xrange(self.es_shards)
+            if es_shard != self.shard)
+
         # Cache holding the results from the worker until they are
         # written to the DB.
         self.result_cache = FlushingDict(
@@ -262,10 +389,48 @@ class EvaluationService(TriggeredService):
         # operations in state 4.
         self.post_finish_lock = gevent.coros.RLock()
 
+        # State of the incremental sweeper. Apart from a full scan
+        # every config.full_sweep_interval seconds, the sweeper only
+        # looks for the operations of the submissions and user tests
+        # created since the previous sweep started (found by id), and
+        # of those that ES handled since the previous sweep (which
+        # might need new operations if ES failed to enqueue them).
+        # Type: float|None
+        self._last_full_sweep = None
+        # The maximum ids at the start of the last two sweeps; we
+        # consider the objects with id greater than the oldest, in
+        # order to include those committed shortly after the previous
+        # sweep with a smaller id.
+        # Type: [int|None]
+        self._submission_id_marks = [None, None]
+        self._user_test_id_marks = [None, None]
+        # Type: {int}
+        self._submissions_to_sweep = set()
+        self._user_tests_to_sweep = set()
+        # Operations loaded from the queue journal, to be removed from
+        # the queue if the next sweep does not find them.
+        # Type: {ESOperation}|None
+        self._operations_to_reconcile = None
+
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
 
-        self.add_executor(EvaluationExecutor(self))
+        self.queue_journal = None
+        if config.queue_journal and not mkdir(config.data_dir):
+            logger.error("Cannot create the data directory, the queue "
+                         "journal will not be used.")
+        elif config.queue_journal:
+            self.queue_journal = QueueJournal(
+                os.path.join(config.data_dir,
+                             "evaluation_queue_%d.journal" % shard),
+                self.contest_id)
+        self.add_executor(EvaluationExecutor(self, self.queue_journal))
+        if self.queue_journal is not None:
+            self.load_queue_journal()
+            self.add_timeout(self.flush_queue_journal, None,
+                             EvaluationService.QUEUE_JOURNAL_FLUSH_TIME
+                             .total_seconds(),
+                             immediately=False)
         self.start_sweeper(117.0)
 
         self.add_timeout(self.check_workers_timeout, None,
@@ -277,6 +442,45 @@ class EvaluationService(TriggeredService):
                          .total_seconds(),
                          immediately=False)
 
+    def load_queue_journal(self):
+        """Fill the queue with the operations in the journal.
+
+        The operations are reconciled with the database by the next
+        sweep, which looks only for the objects created since the
+        journal was written and those of the operations loaded; a
+        full sweep follows immediately, in the background, for the
+        operations whose records were not flushed before the restart.
+
+        """
+        start_time = monotonic_time()
+        operations, marks = self.queue_journal.load()
+        for operation, priority, timestamp in operations:
+            self.enqueue(operation, priority, timestamp)
+        logger.info("Queue rebuilt from the journal in %.3lf seconds.",
+                    monotonic_time() - start_time)
+
+        if marks is None:
+            # We don't know which objects were created since, hence
+            # the first sweep will be a full one.
+            return
+        submission_marks, user_test_marks = marks
+        self._submission_id_marks = [submission_marks[0], submission_marks[0]]
+        self._user_test_id_marks = [user_test_marks[0], user_test_marks[0]]
+        if None in self._submission_id_marks + self._user_test_id_marks:
+            return
+        self._last_full_sweep = monotonic_time()
+        self._operations_to_reconcile = set()
+        for operation, unused_priority, unused_timestamp in operations:
+            self._operations_to_reconcile.add(operation)
+            self._mark_to_sweep(operation)
+
+    def flush_queue_journal(self):
+        """Write to disk the changes to the queue.
+
+        """
+        self.queue_journal.flush(self.get_executor().get_journal_entries)
+        return True
+
     def submission_enqueue_operations(self, submission):
         """Push in queue the operations required by a submission.
 
@@ -288,9 +492,21 @@ class EvaluationService(TriggeredService):
         new_operations = 0
         for dataset in get_datasets_to_judge(submission.task):
             submission_result = submission.get_result(dataset)
+            if config.reuse_evaluations \
+                    and submission_to_evaluate(submission_result):
+                self.submission_reuse_evaluations(submission_result)
+            if config.lazy_evaluation \
+                    and submission_to_evaluate(submission_result):
+                if len(self.skip_irrelevant_evaluations(
+                        submission_result,
+                        self._get_score_type(dataset))) > 0:
+                    submission_result.sa_session.commit()
             number_of_operations = 0
-            for operation, priority, timestamp in submission_get_operations(
-                    submission_result, submission, dataset):
+            # The testcases most likely to fail are evaluated first.
+            operations = self.get_executor().failure_estimator\
+                .sort_operations(submission_get_operations(
+                    submission_result, submission, dataset))
+            for operation, priority, timestamp in operations:
                 number_of_operations += 1
                 if self.enqueue(operation, priority, timestamp):
                     new_operations += 1
@@ -308,6 +524,33 @@ class EvaluationService(TriggeredService):
 
         return new_operations
 
+    def submission_reuse_evaluations(self, submission_result):
+        """Copy to a result the evaluations of equivalent ones.
+
+        See esoperations.submission_reuse_evaluations; the operations
+        for the testcases that received an evaluation are removed
+        from the queue.
+
+        submission_result (SubmissionResult): a submission result to
+            evaluate.
+
+        """
+        codenames = submission_reuse_evaluations(submission_result)
+        if len(codenames) == 0:
+            return
+        submission_result.sa_session.commit()
+        logger.info("Reused %d evaluations for submission %d(%d).",
+                    len(codenames), submission_result.submission_id,
+                    submission_result.dataset_id)
+        for codename in codenames:
+            try:
+                self.dequeue(ESOperation(ESOperation.EVALUATION,
+                                         submission_result.submission_id,
+                                         submission_result.dataset_id,
+                                         codename))
+            except KeyError:
+                pass  # Not in the queue.
+
     def user_test_enqueue_operations(self, user_test):
         """Push in queue the operations required by a user test.
 
@@ -331,32 +574,170 @@ class EvaluationService(TriggeredService):
         evaluated for no good reasons. Put the missing operation in
         the queue.
 
+        The whole database is scanned only every
+        config.full_sweep_interval seconds (at every sweep if it is
+        0); the other times, only the new submissions and user tests
+        and those recently handled by ES are considered.
+
         """
+        full_sweep = self._last_full_sweep is None or \
+            monotonic_time() - self._last_full_sweep >= \
+            config.full_sweep_interval
+        submission_ids = self._submissions_to_sweep
+        user_test_ids = self._user_tests_to_sweep
+        self._submissions_to_sweep = set()
+        self._user_tests_to_sweep = set()
+
         counter = 0
         with SessionGen() as session:
-
-            for operation, timestamp, priority in \
-                    get_submissions_operations(session, self.contest_id):
-                if self.enqueue(operation, timestamp, priority):
+            # We get the marks before looking for the operations, so
+            # that the objects created in the meantime will be
+            # considered in the next sweep.
+            self._submission_id_marks = [
+                self._submission_id_marks[1],
+                session.query(func.max(Submission.id)).scalar() or 0]
+            self._user_test_id_marks = [
+                self._user_test_id_marks[1],
+                session.query(func.max(UserTest.id)).scalar() or 0]
+
+            if full_sweep:
+                logger.info("Scanning all submissions and user tests.")
+                self._last_full_sweep = monotonic_time()
+                submission_operations = get_submissions_operations(
+                    session, self.contest_id,
+                    es_shard=self.shard, es_shards=self.es_shards)
+                user_test_operations = get_user_tests_operations(
+                    session, self.contest_id,
+                    es_shard=self.shard, es_shards=self.es_shards)
+            else:
+                submission_operations = get_submissions_operations(
+                    session, self.contest_id,
+                    min_id=self._submission_id_marks[0] or 0,
+                    ids=submission_ids,
+                    es_shard=self.shard, es_shards=self.es_shards)
+                user_test_operations = get_user_tests_operations(
+                    session, self.contest_id,
+                    min_id=self._user_test_id_marks[0] or 0,
+                    ids=user_test_ids,
+                    es_shard=self.shard, es_shards=self.es_shards)
+
+            submission_operations = self.get_executor().failure_estimator\
+                .sort_operations(submission_operations)
+            for operation, priority, timestamp in submission_operations:
+                if self.enqueue(operation, priority, timestamp):
                     counter += 1
 
-            for operation, timestamp, priority in \
-                    get_user_tests_operations(session, self.contest_id):
-                if self.enqueue(operation, timestamp, priority):
+            for operation, priority, timestamp in user_test_operations:
+                if self.enqueue(operation, priority, timestamp):
                     counter += 1
 
+        if self._operations_to_reconcile is not None:
+            found = set(operation for operation, unused_priority,
+                        unused_timestamp in
+                        submission_operations + user_test_operations)
+            for operation in self._operations_to_reconcile - found:
+                logger.info("Removing `%s' loaded from the queue journal, "
+                            "as it is not to be done anymore.", operation)
+                try:
+                    self.dequeue(operation)
+                except KeyError:
+                    pass  # Ok, the operation was already done.
+            self._operations_to_reconcile = None
+            # The queue is usable, now look for what the journal
+            # missed, without waiting for full_sweep_interval.
+            if not full_sweep:
+                self._last_full_sweep = None
+                self.search_operations_not_done()
+
+        if self.queue_journal is not None:
+            self.queue_journal.record_marks(self._submission_id_marks,
+                                            self._user_test_id_marks)
+
         return counter
 
+    def _mark_to_sweep(self, operation):
+        """Make the next sweep consider the object of an operation.
+
+        operation (ESOperation): an operation handled by ES.
+
+        """
+        if operation.for_submission():
+            self._submissions_to_sweep.add(operation.object_id)
+        else:
+            self._user_tests_to_sweep.add(operation.object_id)
+
+    def _get_owner(self, object_id):
+        """Return the shard of ES responsible for an object.
+
+        object_id (int): the id of a submission or of a user test.
+
+        return (RemoteServiceClient|None): the client for the shard
+            responsible for the object, or None if it is this one.
+
+        """
+        return self.other_shards.get(get_es_shard(object_id,
+                                                  self.es_shards))
+
+    def _get_worker_es_shard(self, shard):
+        """Return the shard of ES using a worker.
+
+        shard (int): the shard of the worker in the pool.
+
+        return (int): the shard of ES that has the worker in its pool.
+
+        """
+        worker_shard, unused_slot = WorkerPool.get_worker_shard_and_slot(shard)
+        return get_worker_es_shard(worker_shard, self.es_shards)
+
+    def _wait_other_shards(self, results):
+        """Wait for the results of RPCs sent to the other shards.
+
+        results ({int: AsyncResult}): the pending RPCs, by shard.
+
+        return ([object]): the values returned by the RPCs which
+            completed successfully in time.
+
+        """
+        timeout = gevent.Timeout(
+            EvaluationService.OTHER_SHARDS_TIMEOUT.total_seconds())
+        values = []
+        timeout.start()
+        try:
+            for es_shard, result in sorted(results.iteritems()):
+                try:
+                    values.append(result.get())
+                except RPCError:
+                    logger.warning("Shard %d of EvaluationService failed "
+                                   "to answer.", es_shard, exc_info=True)
+        except gevent.Timeout as error:
+            if error is not timeout:
+                raise
+            logger.warning("Timeout while waiting for the other shards of "
+                           "EvaluationService.")
+        finally:
+            timeout.cancel()
+        return values
+
     @rpc_method
-    def workers_status(self):
+    def workers_status(self, forward=True):
         """Returns a dictionary (indexed by shard number) whose values
         are the information about the corresponding worker. See
         WorkerPool.get_status for more details.
 
+        forward (bool): whether to include the workers of the other
+            shards of ES.
+
         returns (dict): the dict with the workers information.
 
         """
-        return self.get_executor().pool.get_status()
+        status = self.get_executor().pool.get_status()
+        if forward:
+            for other_status in self._wait_other_shards(dict(
+                    (es_shard, remote_service.workers_status(forward=False))
+                    for es_shard, remote_service
+                    in self.other_shards.iteritems())):
+                status.update(other_status)
+        return status
 
     def check_workers_timeout(self):
         """We ask WorkerPool for the unresponsive workers, and we put
@@ -422,6 +803,7 @@ class EvaluationService(TriggeredService):
         # this method and do nothing because in that case we know the
         # operation has returned to the queue and perhaps already been
         # reassigned to another worker.
+        duration = self.get_executor().pool.get_execution_time(shard)
         to_ignore = self.get_executor().pool.release_worker(shard)
         if to_ignore is True:
             logger.info("Ignored result from worker %s as requested.", shard)
@@ -442,10 +824,19 @@ class EvaluationService(TriggeredService):
                 job_group_success = False
 
         if job_group_success:
+            if duration is not None:
+                self.get_executor().duration_estimator.add_measurement(
+                    [ESOperation.from_dict(job.operation)
+                     for job in job_group.jobs],
+                    duration)
             for job in job_group.jobs:
                 operation = ESOperation.from_dict(job.operation)
                 logger.info("`%s' completed. Success: %s.",
                             operation, job.success)
+                if job.success and \
+                        operation.type_ == ESOperation.EVALUATION:
+                    self.get_executor().failure_estimator.add_outcome(
+                        operation, job.outcome)
                 if isinstance(to_ignore, list) and operation in to_ignore:
                     logger.info("`%s' result ignored as requested", operation)
                 else:
@@ -474,6 +865,9 @@ class EvaluationService(TriggeredService):
         for operation, result in items:
             t = (operation.type_, operation.object_id, operation.dataset_id)
             by_object_and_type[t].append((operation, result))
+            # The next steps for the object are enqueued below, but
+            # if anything goes wrong the sweeper will find them.
+            self._mark_to_sweep(operation)
 
         with SessionGen() as session:
             # Dictionary holding the objects we use repeatedly,
@@ -483,6 +877,9 @@ class EvaluationService(TriggeredService):
             datasets = dict()
             subs = dict()
             srs = dict()
+            # The successful evaluations, to write all together.
+            # Type: [(SubmissionResult, [(ESOperation, Result)])]
+            evaluations = []
 
             for key, operation_results in by_object_and_type.iteritems():
                 type_, object_id, dataset_id = key
@@ -519,12 +916,42 @@ class EvaluationService(TriggeredService):
                     object_ = UserTest.get_from_id(object_id, session)
                     object_result = object_.get_result_or_create(dataset)
 
+                if type_ == ESOperation.EVALUATION:
+                    successes = [(operation, result)
+                                 for operation, result in operation_results
+                                 if result.job_success]
+                    if len(successes) > 0:
+                        evaluations.append((object_result, successes))
+                    operation_results = [
+                        (operation, result)
+                        for operation, result in operation_results
+                        if not result.job_success]
+
                 self.write_results_one_object_and_type(
                     session, object_result, operation_results)
 
+            self.write_evaluations(session, evaluations)
+
             logger.info("Committing evaluations...")
             session.commit()
 
+            # The operations are done; those to retry are enqueued
+            # again below.
+            if self.queue_journal is not None:
+                for operation, unused_result in items:
+                    self.queue_journal.record_remove(operation)
+
+            if config.lazy_evaluation:
+                score_types = dict()
+                for type_, object_id, dataset_id in by_object_and_type:
+                    if type_ == ESOperation.EVALUATION:
+                        if dataset_id not in score_types:
+                            score_types[dataset_id] = self._get_score_type(
+                                datasets[dataset_id])
+                        self.skip_irrelevant_evaluations(
+                            srs[(object_id, dataset_id)],
+                            score_types[dataset_id])
+
             for type_, object_id, dataset_id in by_object_and_type:
                 if type_ == ESOperation.EVALUATION:
                     submission_result = srs[(object_id, dataset_id)]
@@ -559,6 +986,133 @@ class EvaluationService(TriggeredService):
 
         logger.info("Done")
 
+    @staticmethod
+    def _get_score_type(dataset):
+        """Return the score type of a dataset, if valid.
+
+        dataset (Dataset): a dataset.
+
+        return (ScoreType|None): the score type, or None if it cannot
+            be loaded.
+
+        """
+        try:
+            return get_score_type(dataset=dataset)
+        except Exception:
+            logger.warning("Cannot load the score type of dataset %d.",
+                           dataset.id, exc_info=True)
+            return None
+
+    def skip_irrelevant_evaluations(self, submission_result, score_type):
+        """Skip the evaluations that cannot change the score anymore.
+
+        The testcases that the score type deems irrelevant given the
+        outcomes known so far receive an evaluation explicitly marked
+        as skipped (with outcome 0.0), and their operations are
+        removed from the queue and from the workers.
+
+        submission_result (SubmissionResult): a submission result
+            being evaluated.
+        score_type (ScoreType|None): the score type of its dataset.
+
+        return ([unicode]): the codenames of the skipped testcases.
+
+        """
+        if score_type is None or not submission_result.compiled():
+            return []
+        outcomes = dict((evaluation.codename, float(evaluation.outcome))
+                        for evaluation in submission_result.evaluations)
+        if len(outcomes) == 0:
+            return []
+        try:
+            irrelevant = score_type.get_irrelevant_testcases(outcomes)
+        except Exception:
+            logger.warning("Cannot compute the irrelevant testcases of "
+                           "submission %d(%d).",
+                           submission_result.submission_id,
+                           submission_result.dataset_id, exc_info=True)
+            return []
+        codenames = sorted(codename for codename in irrelevant
+                           if codename not in outcomes)
+        if len(codenames) == 0:
+            return []
+
+        logger.info("Skipping %d evaluations of submission %d(%d).",
+                    len(codenames), submission_result.submission_id,
+                    submission_result.dataset_id)
+        testcases = submission_result.dataset.testcases
+        for codename in codenames:
+            Evaluation(submission_result=submission_result,
+                       testcase=testcases[codename],
+                       outcome="0.0",
+                       text=skipped_evaluation_text())
+            operation = ESOperation(ESOperation.EVALUATION,
+                                    submission_result.submission_id,
+                                    submission_result.dataset_id,
+                                    codename)
+            try:
+                self.dequeue(operation)
+            except KeyError:
+                pass  # Ok, the operation wasn't in the queue.
+            try:
+                self.get_executor().pool.ignore_operation(operation)
+            except LookupError:
+                pass  # Ok, the operation wasn't in the pool.
+        return codenames
+
+    def write_evaluations(self, session, evaluations):
+        """Write to the DB many successful evaluations at once.
+
+        All evaluations are inserted with a single statement; if that
+        fails because of integrity errors (for example, because an
+        evaluation is already present), we fall back to inserting them
+        one at a time, skipping the problematic ones.
+
+        session (Session): the DB session to use.
+        evaluations ([(SubmissionResult, [(ESOperation, Result)])]):
+            the successful evaluation results, grouped by the
+            submission result they belong to.
+
+        """
+        # Skip the results whose compilation has just been invalidated
+        # (see write_results_one_row), as the evaluations were of the
+        # previous executables.
+        for submission_result, operation_results in evaluations:
+            if not submission_result.compiled():
+                logger.warning(
+                    "Discarding %d evaluations of submission %d on dataset "
+                    "%d, as its compilation was invalidated: %s.",
+                    len(operation_results), submission_result.submission_id,
+                    submission_result.dataset_id,
+                    ", ".join("%s" % operation
+                              for operation, unused_result
+                              in operation_results))
+        evaluations = [(submission_result, operation_results)
+                       for submission_result, operation_results in evaluations
+                       if submission_result.compiled()]
+        rows = []
+        for submission_result, operation_results in evaluations:
+            for unused_operation, result in operation_results:
+                rows.append(result.job.to_evaluation_row(submission_result))
+        if len(rows) == 0:
+            return
+
+        logger.info("Writing %d evaluations to db.", len(rows))
+        try:
+            with session.begin_nested():
+                session.execute(Evaluation.__table__.insert().values(rows))
+        except IntegrityError:
+            logger.warning("Integrity error while inserting %d evaluations "
+                           "together, inserting them one by one.", len(rows),
+                           exc_info=True)
+            for submission_result, operation_results in evaluations:
+                self.write_results_one_object_and_type(
+                    session, submission_result, operation_results)
+        else:
+            # The ORM does not know about the new rows.
+            for submission_result, unused_operation_results in evaluations:
+                session.expire(submission_result, ["evaluations"])
+
     def write_results_one_object_and_type(
             self, session, object_result, operation_results):
         """Write to the DB the results for one object and type.
@@ -807,11 +1361,17 @@ class EvaluationService(TriggeredService):
         submission_id (int): the id of the new submission.
 
         """
+        owner = self._get_owner(submission_id)
+        if owner is not None:
+            owner.new_submission(submission_id=submission_id)
+            return
+
         with SessionGen() as session:
             submission = Submission.get_from_id(submission_id, session)
             if submission is None:
                 logger.error("[new_submission] Couldn't find submission "
                              "%d in the database.", submission_id)
+                self._submissions_to_sweep.add(submission_id)
                 return
 
             self.submission_enqueue_operations(submission)
@@ -829,11 +1389,17 @@ class EvaluationService(TriggeredService):
         returns (bool): True if everything went well.
 
         """
+        owner = self._get_owner(user_test_id)
+        if owner is not None:
+            owner.new_user_test(user_test_id=user_test_id)
+            return
+
         with SessionGen() as session:
             user_test = UserTest.get_from_id(user_test_id, session)
             if user_test is None:
                 logger.error("[new_user_test] Couldn't find user test %d "
                              "in the database.", user_test_id)
+                self._user_tests_to_sweep.add(user_test_id)
                 return
 
             self.user_test_enqueue_operations(user_test)
@@ -848,7 +1414,8 @@ class EvaluationService(TriggeredService):
                               dataset_id=None,
                               participation_id=None,
                               task_id=None,
-                              level="compilation"):
+                              level="compilation",
+                              forward=True):
         """Request to invalidate some computed data.
 
         Invalidate the compilation and/or evaluation data of the
@@ -866,6 +1433,10 @@ class EvaluationService(TriggeredService):
         the workers are ignored. New appropriate operations are
         enqueued.
 
+        Each shard of ES takes care only of its own submissions; if
+        forward is True, the request is forwarded to the shards
+        responsible for the other submissions involved.
+
         submission_id (int|None): id of the submission to invalidate,
             or None.
         dataset_id (int|None): id of the dataset to invalidate, or
@@ -874,6 +1445,8 @@ class EvaluationService(TriggeredService):
             invalidate, or None.
         task_id (int|None): id of the task to invalidate, or None.
         level (string): 'compilation' or 'evaluation'
+        forward (bool): whether to forward the request to the other
+            shards of ES.
 
         """
         logger.info("Invalidation request received.")
@@ -887,14 +1460,39 @@ class EvaluationService(TriggeredService):
         if contest_id is None:
             contest_id = self.contest_id
 
+        owner = None
+        if submission_id is not None:
+            owner = self._get_owner(submission_id)
+        if forward:
+            if submission_id is None:
+                other_shards = self.other_shards.values()
+            elif owner is not None:
+                other_shards = [owner]
+            else:
+                other_shards = []
+            for remote_service in other_shards:
+                remote_service.invalidate_submission(
+                    contest_id=contest_id,
+                    submission_id=submission_id,
+                    dataset_id=dataset_id,
+                    participation_id=participation_id,
+                    task_id=task_id,
+                    level=level,
+                    forward=False)
+        if owner is not None:
+            # The submission is handled by another shard.
+            return
+
         with SessionGen() as session:
             # First we load all involved submissions.
-            submissions = get_submissions(
-                # Give contest_id only if all others are None.
-                contest_id
-                if {participation_id, task_id, submission_id} == {None}
-                else None,
-                participation_id, task_id, submission_id, session)
+            submissions = [
+                submission for submission in get_submissions(
+                    # Give contest_id only if all others are None.
+                    contest_id
+                    if {participation_id, task_id, submission_id} == {None}
+                    else None,
+                    participation_id, task_id, submission_id, session)
+                if self._get_owner(submission.id) is None]
 
             # Then we get all relevant operations, and we remove them
             # both from the queue and from the pool (i.e., we ignore
@@ -922,6 +1520,9 @@ class EvaluationService(TriggeredService):
                     dataset_id} == {None}
                 else None,
                 participation_id, task_id, submission_id, dataset_id, session)
+            submission_results = [
+                submission_result for submission_result in submission_results
+                if self._get_owner(submission_result.submission_id) is None]
             logger.info("Submission results to invalidate %s for: %d.",
                         level, len(submission_results))
             for submission_result in submission_results:
@@ -951,6 +1552,12 @@ class EvaluationService(TriggeredService):
         """
         logger.info("Received request to disable worker %s.", shard)
 
+        es_shard = self._get_worker_es_shard(shard)
+        if es_shard != self.shard:
+            return self._wait_other_shards({
+                es_shard: self.other_shards[es_shard].disable_worker(shard=shard)
+            }) == [True]
+
         lost_operations = []
         try:
             lost_operations = self.get_executor().pool.disable_worker(shard)
@@ -974,6 +1581,13 @@ class EvaluationService(TriggeredService):
 
         """
         logger.info("Received request to enable worker %s.", shard)
+
+        es_shard = self._get_worker_es_shard(shard)
+        if es_shard != self.shard:
+            return self._wait_other_shards({
+                es_shard: self.other_shards[es_shard].enable_worker(shard=shard)
+            }) == [True]
+
         try:
             self.get_executor().pool.enable_worker(shard)
         except ValueError:
@@ -982,7 +1596,7 @@ class EvaluationService(TriggeredService):
         return True
 
     @rpc_method
-    def queue_status(self):
+    def queue_status(self, forward=True):
         """Return the status of the queue.
 
         Parent method returns list of queues of each executor, but in
@@ -995,26 +1609,51 @@ class EvaluationService(TriggeredService):
         tuple. Generally, we will see only one evaluate operation for
         each submission in the queue status with the number of
         testcase which will be evaluated next. Moreover, we pass also
-        the number of testcases in the queue.
+        the number of testcases in the queue, the estimated duration
+        of each operation, and the number of operations of that kind
+        that would be sent together to a worker.
 
         The entries are then ordered by priority and timestamp (the
         same criteria used to look at what to complete next).
 
+        forward (bool): whether to include the queues of the other
+            shards of ES.
+
         return ([QueueEntry]): the list with the queued elements.
 
         """
-        entries = super(EvaluationService, self).queue_status()[0]
+        # We group the entries before converting them, as the queue
+        # may contain millions of entries.
+        executor = self.get_executor()
         entries_by_key = dict()
-        for entry in entries:
-            key = (str(entry["item"]["type"]),
-                   str(entry["item"]["object_id"]),
-                   str(entry["item"]["dataset_id"]))
-            if key in entries_by_key:
-                entries_by_key[key]["item"]["multiplicity"] += 1
-            else:
+        multiplicity = defaultdict(int)
+        for entry in executor.get_entries():
+            operation = entry.item
+            key = (operation.type_, operation.object_id, operation.dataset_id)
+            multiplicity[key] += 1
+            if key not in entries_by_key:
                 entries_by_key[key] = entry
-                entries_by_key[key]["item"]["multiplicity"] = 1
-        return sorted(
-            entries_by_key.values(),
-            lambda x, y: cmp((x["priority"], x["timestamp"]),
-                             (y["priority"], y["timestamp"])))
+
+        ret = []
+        for key, entry in sorted(
+                entries_by_key.iteritems(),
+                key=lambda x: (x[1].priority, x[1].timestamp)):
+            type_, unused_object_id, dataset_id = key
+            item = entry.item.to_dict()
+            item["multiplicity"] = multiplicity[key]
+            item["estimated_duration"] = \
+                executor.duration_estimator.estimate(type_, dataset_id)
+            item["batch_size"] = \
+                executor.estimated_batch_size(type_, dataset_id)
+            ret.append({"item": item,
+                        "priority": entry.priority,
+                        "timestamp": make_timestamp(entry.timestamp)})
+
+        if forward:
+            for other_ret in self._wait_other_shards(dict(
+                    (es_shard, remote_service.queue_status(forward=False))
+                    for es_shard, remote_service
+                    in self.other_shards.iteritems())):
+                ret.extend(other_ret)
+            ret.sort(key=lambda x: (x["priority"], x["timestamp"]))
+        return ret
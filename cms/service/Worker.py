@@ -30,21 +30,189 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
+import multiprocessing
 import time
 
 import gevent.coros
 
+from cms import ConfigError, config, get_service_shards
 from cms.io import Service, rpc_method
-from cms.db import SessionGen, Contest
 from cms.db.filecacher import FileCacher, TombstoneError
 from cms.grading import JobException
 from cms.grading.tasktypes import get_task_type
 from cms.grading.Job import CompilationJob, EvaluationJob, JobGroup
+from cms.grading.phasetimer import PhaseTimer
+from cms.grading.Sandbox import IsolateSandbox
+from cms.grading.sandboxpool import SandboxPool, SandboxSession
+from cms.service.precacher import Precacher
+from cmscommon.datetime import make_datetime, make_timestamp
 
 
 logger = logging.getLogger(__name__)
 
 
+class WorkerSlot(object):
+    """One of the execution slots of a Worker.
+
+    A Worker can execute up to config.worker_slots job groups at the
+    same time, one in each slot. Each slot uses its own range of
+    sandbox ids (keeping some sandboxes ready in a SandboxPool) and,
+    if config.worker_pin_slots is true, its own CPU; the file cache is
+    the same for all slots of a Worker.
+
+    Each slot accepts up to config.worker_pipeline_depth job groups:
+    one is executed, while the others wait for their turn, their
+    files being downloaded in the meantime.
+
+    """
+
+    def __init__(self, worker, slot):
+        """Create the slot.
+
+        worker (Worker): the Worker this slot belongs to.
+        slot (int): the index of the slot in the Worker.
+
+        """
+        # Name and shard are needed by FileCacher to find the cache
+        # directory (hence the same as the Worker's); shard, slot
+        # and cpus are used by the sandbox.
+        self.name = worker.name
+        self.shard = worker.shard
+        self.slot = slot
+        self.cpus = None
+        if config.worker_pin_slots:
+            self.cpus = [(self.shard * config.worker_slots + slot)
+                         % multiprocessing.cpu_count()]
+
+        self.file_cacher = FileCacher(self)
+        self.work_lock = gevent.coros.RLock()
+
+        # Used by create_sandbox through the file cacher; the pool is
+        # filled when the first sandbox is requested.
+        self.sandbox_pool = None
+        if config.worker_sandbox_pool_size > 0 \
+                and config.sandbox_implementation == "isolate" \
+                and not config.keep_sandbox:
+            self.sandbox_pool = SandboxPool(
+                self.file_cacher, config.worker_sandbox_pool_size)
+        # Used by create_sandbox and delete_sandbox while executing a
+        # job group, to keep sandboxes between its jobs.
+        self.sandbox_session = None
+        # Used by timed_phase through the file cacher, to measure the
+        # phases of the job being executed.
+        self.phase_timer = PhaseTimer()
+
+        # Number of job groups received and not finished yet,
+        # including the one being executed.
+        self.queued = 0
+        # Type: datetime|None
+        self.start_time = None
+        self._last_end_time = None
+        self._total_free_time = 0
+        self._total_busy_time = 0
+        self._number_execution = 0
+        # Number of jobs executed, their total time, and the total
+        # time spent in each phase and the number of times it was
+        # entered.
+        self._jobs = 0
+        self._jobs_time = 0.0
+        # Type: {unicode: float}
+        self._phase_times = {}
+        # Type: {unicode: int}
+        self._phase_counts = {}
+
+    def get_status(self):
+        """Return the status of the slot.
+
+        return (dict): whether the slot is executing a job group,
+            and since when.
+
+        """
+        return {
+            "slot": self.slot,
+            "cpus": self.cpus,
+            "busy": self.start_time is not None,
+            "queued": self.queued,
+            "start_time": make_timestamp(self.start_time)
+            if self.start_time is not None else None,
+        }
+
+    def record_job(self, job, elapsed):
+        """Store in a job the time spent in its phases, and add it to
+        the statistics of the slot.
+
+        job (Job): the job just executed.
+        elapsed (float): the time the execution took, in seconds.
+
+        """
+        job.timings = dict(self.phase_timer.times)
+        self._jobs += 1
+        self._jobs_time += elapsed
+        self.record_phases(self.phase_timer)
+        self.phase_timer.reset()
+
+    def record_phases(self, timer):
+        """Add the times measured by a timer to the statistics of the
+        slot.
+
+        timer (PhaseTimer): the timer.
+
+        """
+        for phase, seconds in timer.times.iteritems():
+            self._phase_times[phase] = \
+                self._phase_times.get(phase, 0.0) + seconds
+        for phase, count in timer.counts.iteritems():
+            self._phase_counts[phase] = \
+                self._phase_counts.get(phase, 0) + count
+
+    def get_job_stats(self):
+        """Return the statistics on the jobs executed by the slot.
+
+        return (dict): the number of jobs executed ("jobs"), their
+            total time in seconds ("time") and, for each phase (see
+            PhaseTimer), the total time spent in it and the number of
+            times it was entered ("phases").
+
+        """
+        return {
+            "jobs": self._jobs,
+            "time": self._jobs_time,
+            "phases": dict(
+                (phase, {"time": self._phase_times.get(phase, 0.0),
+                         "count": self._phase_counts.get(phase, 0)})
+                for phase in PhaseTimer.PHASES),
+        }
+
+    def finalize(self, start_time):
+        """Update and log the statistics after a job group.
+
+        start_time (float): when the execution of the job group
+            started.
+
+        """
+        end_time = time.time()
+        busy_time = end_time - start_time
+        free_time = 0.0
+        if self._last_end_time is not None:
+            free_time = start_time - self._last_end_time
+        self._last_end_time = end_time
+        self._total_busy_time += busy_time
+        self._total_free_time += free_time
+        ratio = self._total_busy_time * 100.0 / \
+            (self._total_busy_time + self._total_free_time)
+        avg_free_time = 0.0
+        if self._number_execution > 0:
+            avg_free_time = self._total_free_time / self._number_execution
+        avg_busy_time = 0.0
+        if self._number_execution > 0:
+            avg_busy_time = self._total_busy_time / self._number_execution
+        self._number_execution += 1
+        logger.info("Slot %d executed in %.3lf after free for %.3lf; "
+                    "busyness is %.1lf%%; avg free time is %.3lf "
+                    "avg busy time is %.3lf ", self.slot,
+                    busy_time, free_time, ratio, avg_free_time, avg_busy_time)
+
+
 class Worker(Service):
     """This service implement the possibility to compile and evaluate
     submissions in a sandbox. The instructions to follow for the
@@ -57,133 +225,239 @@ class Worker(Service):
     JOB_TYPE_EVALUATION = "evaluate"
 
     def __init__(self, shard, fake_worker_time=None):
+        if config.sandbox_implementation == "isolate":
+            # Each slot uses its own range of box ids, which must not
+            # overlap those of the other Workers on the same machine.
+            needed_box_ids = IsolateSandbox.get_needed_box_ids(
+                max(get_service_shards("Worker"), shard + 1))
+            if needed_box_ids > config.isolate_num_boxes:
+                raise ConfigError(
+                    "The Workers need %d isolate boxes, but "
+                    "isolate_num_boxes is %d. Please increase it in "
+                    "cms.conf (and num_boxes in the configuration of "
+                    "isolate), or decrease worker_slots." %
+                    (needed_box_ids, config.isolate_num_boxes))
         Service.__init__(self, shard)
         self.file_cacher = FileCacher(self)
+        self.precacher = Precacher(
+            self.file_cacher, config.worker_precache_concurrency,
+            shard * config.worker_precache_stagger)
 
-        self.work_lock = gevent.coros.RLock()
-        self._last_end_time = None
-        self._total_free_time = 0
-        self._total_busy_time = 0
-        self._number_execution = 0
+        self.slots = [WorkerSlot(self, slot)
+                      for slot in xrange(config.worker_slots)]
 
         self._fake_worker_time = fake_worker_time
 
+    def exit(self):
+        """Delete the sandboxes kept ready, and terminate the service.
+
+        """
+        for worker_slot in self.slots:
+            if worker_slot.sandbox_pool is not None:
+                worker_slot.sandbox_pool.clear()
+        Service.exit(self)
+
     @rpc_method
     def precache_files(self, contest_id):
         """RPC to ask the worker to precache of files in the contest.
 
+        The files are downloaded in the background, see Precacher.
+
         contest_id (int): the id of the contest
 
         """
-        # In order to avoid a long-living connection, first fetch the
-        # complete list of files and then download the files; since
-        # this is just pre-caching, possible race conditions are not
-        # dangerous
-        logger.info("Precaching files for contest %d.", contest_id)
-        with SessionGen() as session:
-            contest = Contest.get_from_id(contest_id, session)
-            files = contest.enumerate_files(skip_submissions=True,
-                                            skip_user_tests=True)
-        for digest in files:
-            try:
-                self.file_cacher.load(digest, if_needed=True)
-            except KeyError:
-                # No problem (at this stage) if we cannot find the
-                # file
-                pass
-
-        logger.info("Precaching finished.")
+        self.precacher.start(contest_id)
 
     @rpc_method
-    def execute_job_group(self, job_group_dict):
+    def precache_status(self):
+        """Return the progress of the precaching of the files.
+
+        return (dict): see Precacher.get_status.
+
+        """
+        return self.precacher.get_status()
+
+    @rpc_method
+    def slots_status(self):
+        """Return the status of each of the execution slots.
+
+        return ([dict]): the status of each slot, see
+            WorkerSlot.get_status.
+
+        """
+        return [slot.get_status() for slot in self.slots]
+
+    @rpc_method
+    def get_job_stats(self):
+        """Return the time spent by the jobs in each of their phases.
+
+        This allows to tell whether the time to grade is spent, for
+        example, getting files from the database, in the sandboxes or
+        executing the solutions.
+
+        return (dict): the statistics of all slots together, see
+            WorkerSlot.get_job_stats, plus those of the local cache of
+            the files ("file_cache", see FileCacher.get_stats).
+
+        """
+        stats = {"jobs": 0, "time": 0.0,
+                 "phases": dict((phase, {"time": 0.0, "count": 0})
+                                for phase in PhaseTimer.PHASES)}
+        for slot in self.slots:
+            slot_stats = slot.get_job_stats()
+            stats["jobs"] += slot_stats["jobs"]
+            stats["time"] += slot_stats["time"]
+            for phase, phase_stats in slot_stats["phases"].iteritems():
+                stats["phases"][phase]["time"] += phase_stats["time"]
+                stats["phases"][phase]["count"] += phase_stats["count"]
+
+        # The slots share the cache (and its index) of the Worker.
+        stats["file_cache"] = self.file_cacher.get_stats()
+        for slot in self.slots:
+            for key, value in slot.file_cacher.stats.iteritems():
+                stats["file_cache"][key] += value
+        return stats
+
+    @staticmethod
+    def _prefetch_files(job_group, worker_slot):
+        """Download in the cache the files needed by a job group.
+
+        Errors are ignored: they will be raised again, and handled,
+        when executing the jobs. The downloads are measured as file
+        fetch misses in the statistics of the slot, but not in the
+        timings of the jobs (the slot may be executing another job
+        group meanwhile).
+
+        job_group (JobGroup): the job group.
+        worker_slot (WorkerSlot): the slot that will execute it.
+
+        """
+        file_cacher = worker_slot.file_cacher
+        timer = PhaseTimer()
+        for job in job_group.jobs:
+            for digest in job.get_digests():
+                if file_cacher.is_cached(digest):
+                    continue
+                with timer.phase(PhaseTimer.FILE_FETCH_MISS):
+                    try:
+                        file_cacher.load(digest, if_needed=True)
+                    except (KeyError, TombstoneError):
+                        pass
+        worker_slot.record_phases(timer)
+
+    @rpc_method
+    def execute_job_group(self, job_group_dict, slot=0):
         """Receive a group of jobs in a list format and executes them one by
         one.
 
         job_group_dict ({}): a JobGroup exported to dict.
+        slot (int): the execution slot to use.
 
         return ({}): the same JobGroup in dict format, but containing
             the results.
 
         """
-        start_time = time.time()
         job_group = JobGroup.import_from_dict(job_group_dict)
 
-        if self.work_lock.acquire(False):
-            try:
-                logger.info("Starting job group.")
-                for job in job_group.jobs:
-                    logger.info("Starting job.",
-                                extra={"operation": job.info})
-
-                    job.shard = self.shard
-
-                    if self._fake_worker_time is None:
-                        task_type = get_task_type(job.task_type,
-                                                  job.task_type_parameters)
-                        try:
-                            task_type.execute_job(job, self.file_cacher)
-                        except TombstoneError:
-                            job.success = False
-                            job.plus = {"tombstone": True}
-                    else:
-                        time.sleep(self._fake_worker_time)
-                        job.success = True
-                        job.text = ["ok"]
-                        job.plus = {
-                            "execution_time": self._fake_worker_time,
-                            "execution_wall_clock_time":
-                            self._fake_worker_time,
-                            "execution_memory": 1000,
-                        }
-
-                        if isinstance(job, CompilationJob):
-                            job.compilation_success = True
-                        elif isinstance(job, EvaluationJob):
-                            job.outcome = "1.0"
-
-                    logger.info("Finished job.",
-                                extra={"operation": job.info})
-
-                logger.info("Finished job group.")
-                return job_group.export_to_dict()
-
-            except:
-                err_msg = "Worker failed."
-                logger.error(err_msg, exc_info=True)
-                raise JobException(err_msg)
-
-            finally:
-                self._finalize(start_time)
-                self.work_lock.release()
-
-        else:
-            err_msg = "Request received, but declined because of acquired " \
-                "lock (Worker is busy executing another job, this should " \
-                "not happen: check if there are more than one ES running, " \
-                "or for bugs in ES."
+        if not 0 <= slot < len(self.slots):
+            err_msg = "Request received for slot %s, but the Worker " \
+                "has only %d slots (check that worker_slots is the " \
+                "same for ES and the Worker)." % (slot, len(self.slots))
+            logger.error(err_msg)
+            raise JobException(err_msg)
+        worker_slot = self.slots[slot]
+
+        if worker_slot.queued >= config.worker_pipeline_depth:
+            err_msg = "Request received, but declined because Worker " \
+                "slot %d has already %d job groups to execute (this " \
+                "should not happen: check if more than one ES is using " \
+                "this Worker, if all ES and the Worker have the same " \
+                "configuration, or for bugs in ES)." % (
+                    slot, worker_slot.queued)
             logger.warning(err_msg)
-            self._finalize(start_time)
             raise JobException(err_msg)
 
-    def _finalize(self, start_time):
-        end_time = time.time()
-        busy_time = end_time - start_time
-        free_time = 0.0
-        if self._last_end_time is not None:
-            free_time = start_time - self._last_end_time
-        self._last_end_time = end_time
-        self._total_busy_time += busy_time
-        self._total_free_time += free_time
-        ratio = self._total_busy_time * 100.0 / \
-            (self._total_busy_time + self._total_free_time)
-        avg_free_time = 0.0
-        if self._number_execution > 0:
-            avg_free_time = self._total_free_time / self._number_execution
-        avg_busy_time = 0.0
-        if self._number_execution > 0:
-            avg_busy_time = self._total_busy_time / self._number_execution
-        self._number_execution += 1
-        logger.info("Executed in %.3lf after free for %.3lf; "
-                    "busyness is %.1lf%%; avg free time is %.3lf "
-                    "avg busy time is %.3lf ",
-                    busy_time, free_time, ratio, avg_free_time, avg_busy_time)
+        worker_slot.queued += 1
+        try:
+            # While the slot is executing the previous job groups, we
+            # download the files we will need.
+            if self._fake_worker_time is None:
+                self._prefetch_files(job_group, worker_slot)
+
+            with worker_slot.work_lock:
+                start_time = time.time()
+                worker_slot.start_time = make_datetime()
+                try:
+                    return self._execute_job_group(job_group, worker_slot)
+                finally:
+                    worker_slot.start_time = None
+                    worker_slot.finalize(start_time)
+        finally:
+            worker_slot.queued -= 1
+
+    def _execute_job_group(self, job_group, worker_slot):
+        """Execute the jobs of a group, one by one, in a slot.
+
+        job_group (JobGroup): the jobs to execute.
+        worker_slot (WorkerSlot): the slot to use, whose lock must be
+            held by the caller.
+
+        return ({}): the job group in dict format, containing the
+            results.
+
+        raise (JobException): if the execution failed.
+
+        """
+        if config.sandbox_implementation == "isolate" \
+                and not config.keep_sandbox:
+            worker_slot.sandbox_session = SandboxSession()
+        try:
+            logger.info("Starting job group in slot %d.", worker_slot.slot)
+            for job in job_group.jobs:
+                logger.info("Starting job.",
+                            extra={"operation": job.info})
+
+                job.shard = self.shard
+                worker_slot.phase_timer.reset()
+                job_start_time = time.time()
+
+                if self._fake_worker_time is None:
+                    task_type = get_task_type(job.task_type,
+                                              job.task_type_parameters)
+                    try:
+                        task_type.execute_job(job, worker_slot.file_cacher)
+                    except TombstoneError:
+                        job.success = False
+                        job.plus = {"tombstone": True}
+                else:
+                    time.sleep(self._fake_worker_time)
+                    job.success = True
+                    job.text = ["ok"]
+                    job.plus = {
+                        "execution_time": self._fake_worker_time,
+                        "execution_wall_clock_time":
+                        self._fake_worker_time,
+                        "execution_memory": 1000,
+                    }
+
+                    if isinstance(job, CompilationJob):
+                        job.compilation_success = True
+                    elif isinstance(job, EvaluationJob):
+                        job.outcome = "1.0"
+
+                worker_slot.record_job(job, time.time() - job_start_time)
+                logger.info("Finished job.",
+                            extra={"operation": job.info})
+
+            logger.info("Finished job group in slot %d.", worker_slot.slot)
+            return job_group.export_to_dict()
+
+        except:
+            err_msg = "Worker failed."
+            logger.error(err_msg, exc_info=True)
+            raise JobException(err_msg)
+
+        finally:
+            if worker_slot.sandbox_session is not None:
+                worker_slot.sandbox_session.close()
+                worker_slot.sandbox_session = None
@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Rolling estimates of the time needed to execute ES operations.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class DurationEstimator(object):
+    """Keep an estimate of the execution time of the operations.
+
+    Operations are grouped by type and dataset (the latter implying
+    also the task), and for each group we keep an exponential moving
+    average of the time a worker needs to execute one of them.
+
+    Workers execute operations in groups, and we only know how long
+    the whole group took; the duration is split among the operations
+    of the group proportionally to their current estimates.
+
+    """
+
+    # Weight of a new measurement in the moving average.
+    SMOOTHING = 0.2
+
+    # Estimate (in seconds) for operations never measured.
+    DEFAULT_DURATION = 1.0
+
+    def __init__(self):
+        # Type: {(unicode, int): float}
+        self._estimates = dict()
+
+    def estimate(self, type_, dataset_id):
+        """Return the estimated duration of an operation.
+
+        type_ (unicode): the type of the operation.
+        dataset_id (int): the dataset of the operation.
+
+        return (float): the estimated duration, in seconds.
+
+        """
+        return self._estimates.get((type_, dataset_id),
+                                   DurationEstimator.DEFAULT_DURATION)
+
+    def estimate_operation(self, operation):
+        """Return the estimated duration of an operation.
+
+        operation (ESOperation): the operation.
+
+        return (float): the estimated duration, in seconds.
+
+        """
+        return self.estimate(operation.type_, operation.dataset_id)
+
+    def add_measurement(self, operations, duration):
+        """Update the estimates with the duration of a group.
+
+        operations ([ESOperation]): the operations executed together.
+        duration (float): how long (in seconds) the worker took to
+            execute all of them.
+
+        """
+        if len(operations) == 0 or duration < 0:
+            return
+        expected = sum(self.estimate_operation(operation)
+                       for operation in operations)
+        ratio = duration / expected
+        for key in set((operation.type_, operation.dataset_id)
+                       for operation in operations):
+            old = self.estimate(*key)
+            self._estimates[key] = \
+                (1 - DurationEstimator.SMOOTHING) * old + \
+                DurationEstimator.SMOOTHING * old * ratio
+            logger.debug("Estimated duration of %s on dataset %s "
+                         "updated from %.3lf to %.3lf.",
+                         key[0], key[1], old, self._estimates[key])
+
+    def get_status(self):
+        """Return the current estimates.
+
+        return ([dict]): one item for each type and dataset with a
+            measured duration.
+
+        """
+        return [{"type": type_,
+                 "dataset_id": dataset_id,
+                 "duration": duration}
+                for (type_, dataset_id), duration
+                in self._estimates.iteritems()]
@@ -33,11 +33,12 @@ from __future__ import unicode_literals
 
 import logging
 
-from sqlalchemy import case, literal
+from sqlalchemy import case, literal, or_
 
 from cms.io import PriorityQueue, QueueItem
 from cms.db import Dataset, Evaluation, Submission, SubmissionResult, \
     Task, Testcase, UserTest, UserTestResult
+from cms.grading import is_evaluation_skipped
 
 
 logger = logging.getLogger(__name__)
@@ -125,6 +126,87 @@ def submission_to_evaluate_on_testcase(submission_result, testcase_codename):
     return True
 
 
+def _get_evaluation_setup(submission_result):
+    """Return what determines the evaluations of a submission result.
+
+    submission_result (SubmissionResult): a compiled submission
+        result.
+
+    return (tuple): the executables, the managers, the task type (with
+        its parameters) and the limits of the dataset; two submission
+        results with the same setup get the same evaluation on
+        testcases with the same input and output.
+
+    """
+    dataset = submission_result.dataset
+    return (
+        sorted((filename, executable.digest) for filename, executable
+               in submission_result.executables.iteritems()),
+        sorted((filename, manager.digest) for filename, manager
+               in dataset.managers.iteritems()),
+        dataset.task_type,
+        dataset.task_type_parameters,
+        dataset.time_limit,
+        dataset.memory_limit)
+
+
+def submission_reuse_evaluations(submission_result):
+    """Copy evaluations from the other datasets where possible.
+
+    The testcases of the submission result's dataset not evaluated
+    yet receive a copy of the evaluation that the submission has on
+    a testcase with the same codename, input and output of another
+    dataset, provided that the two results have the same executables and the
+    two datasets the same managers, task type and limits (e.g., when
+    a dataset is a clone of another with a few testcases changed).
+    Evaluations skipped by the lazy evaluation are not copied, as
+    they say nothing about the outcome of the testcase.
+
+    submission_result (SubmissionResult): a submission result to
+        evaluate.
+
+    return ([unicode]): the codenames of the testcases that received
+        an evaluation.
+
+    """
+    evaluated_testcase_ids = set(
+        evaluation.testcase_id
+        for evaluation in submission_result.evaluations)
+    # The codename is part of the key as some task types (e.g.,
+    # OutputOnly) evaluate a different file for each codename.
+    # Type: {(unicode, unicode, unicode): Testcase}
+    testcases_to_evaluate = {}
+    for testcase in submission_result.dataset.testcases.itervalues():
+        if testcase.id not in evaluated_testcase_ids:
+            testcases_to_evaluate[(testcase.codename, testcase.input,
+                                   testcase.output)] = testcase
+    if len(testcases_to_evaluate) == 0:
+        return []
+
+    setup = _get_evaluation_setup(submission_result)
+    copied = []
+    for other_result in submission_result.submission.results:
+        if other_result is submission_result \
+                or not other_result.compilation_succeeded() \
+                or len(other_result.evaluations) == 0 \
+                or _get_evaluation_setup(other_result) != setup:
+            continue
+        for evaluation in other_result.evaluations:
+            if is_evaluation_skipped(evaluation.text):
+                continue
+            testcase = evaluation.testcase
+            new_testcase = testcases_to_evaluate.pop(
+                (testcase.codename, testcase.input, testcase.output), None)
+            if new_testcase is not None:
+                new_evaluation = evaluation.clone()
+                new_evaluation.submission_result = submission_result
+                new_evaluation.testcase = new_testcase
+                copied.append(new_testcase.codename)
+        if len(testcases_to_evaluate) == 0:
+            break
+    return copied
+
+
 def user_test_to_compile(user_test_result):
     """Return whether ES is interested in compiling the user test.
 
@@ -288,12 +370,66 @@ def get_relevant_operations(level, submissions, dataset_id=None):
     return operations
 
 
-def get_submissions_operations(session, contest_id=None):
+def _get_ids_filter(column, min_id=None, ids=None):
+    """Return a filter selecting some objects by their id.
+
+    column (Column): the id column of the objects.
+    min_id (int|None): if not None, select the objects with id
+        greater than this.
+    ids ({int}|None): if not None, select also these objects.
+
+    return (ColumnElement): the filter; it selects everything if both
+        min_id and ids are None.
+
+    """
+    if min_id is None and ids is None:
+        return literal(True)
+    conditions = []
+    if min_id is not None:
+        conditions.append(column > min_id)
+    if ids:
+        conditions.append(column.in_(ids))
+    if len(conditions) == 0:
+        return literal(False)
+    return or_(*conditions)
+
+
+def _get_es_shard_filter(column, es_shard=None, es_shards=1):
+    """Return a filter selecting the objects of a shard of ES.
+
+    column (Column): the id column of the objects.
+    es_shard (int|None): if not None, select the objects that the
+        shard es_shard of ES is responsible for (see
+        cms.service.esrouting).
+    es_shards (int): the number of shards of ES.
+
+    return (ColumnElement): the filter.
+
+    """
+    if es_shard is None or es_shards == 1:
+        return literal(True)
+    return column % es_shards == es_shard
+
+
+def get_submissions_operations(session, contest_id=None,
+                               min_id=None, ids=None,
+                               es_shard=None, es_shards=1):
     """Return all the operations to do for submissions in the contest.
 
+    If min_id or ids are given, only the submissions with id greater
+    than min_id or in ids are considered; for them, the operations
+    are exactly the same returned when considering all submissions.
+    Similarly, if es_shard is given only the submissions handled by
+    that shard of ES are considered.
+
     session (Session): the database session to use.
     contest_id (int|None): the contest for which we want the operations.
         If none, get operations for any contest.
+    min_id (int|None): if not None, consider the submissions with id
+        greater than this.
+    ids ({int}|None): if not None, consider these submissions.
+    es_shard (int|None): if not None, the shard of ES asking.
+    es_shards (int): the number of shards of ES.
 
     return ([ESOperation, float, int]): a list of operation, timestamp
         and priority.
@@ -305,6 +441,9 @@ def get_submissions_operations(session, contest_id=None):
         contest_filter = literal(True)
     else:
         contest_filter = Task.contest_id == contest_id
+    contest_filter &= _get_ids_filter(Submission.id, min_id, ids)
+    contest_filter &= _get_es_shard_filter(Submission.id,
+                                           es_shard, es_shards)
 
     # Retrieve the compilation operations for all submissions without
     # the corresponding result for a dataset to judge. Since we have
@@ -395,12 +534,22 @@ def get_submissions_operations(session, contest_id=None):
     return operations
 
 
-def get_user_tests_operations(session, contest_id=None):
+def get_user_tests_operations(session, contest_id=None,
+                              min_id=None, ids=None,
+                              es_shard=None, es_shards=1):
     """Return all the operations to do for user tests in the contest.
 
+    If min_id, ids or es_shard are given, only some user tests are
+    considered, as in get_submissions_operations.
+
     session (Session): the database session to use.
     contest_id (int|None): the contest for which we want the operations.
         If none, get operations for any contest.
+    min_id (int|None): if not None, consider the user tests with id
+        greater than this.
+    ids ({int}|None): if not None, consider these user tests.
+    es_shard (int|None): if not None, the shard of ES asking.
+    es_shards (int): the number of shards of ES.
 
     return ([ESOperation, float, int]): a list of operation, timestamp
         and priority.
@@ -412,6 +561,8 @@ def get_user_tests_operations(session, contest_id=None):
         contest_filter = literal(True)
     else:
         contest_filter = Task.contest_id == contest_id
+    contest_filter &= _get_ids_filter(UserTest.id, min_id, ids)
+    contest_filter &= _get_es_shard_filter(UserTest.id, es_shard, es_shards)
 
     # Retrieve the compilation operations for all user tests without
     # the corresponding result for a dataset to judge. Since we have
@@ -496,17 +647,43 @@ def get_user_tests_operations(session, contest_id=None):
 
 class ESOperation(QueueItem):
 
+    """An operation for ES, immutable (apart from side_data).
+
+    ES can hold millions of operations at the same time, hence they
+    do not have a __dict__, their hash is computed once, and the
+    strings they contain are shared among operations.
+
+    """
+
+    __slots__ = ("type_", "object_id", "dataset_id", "testcase_codename",
+                 "side_data", "_hash")
+
     COMPILATION = "compile"
     EVALUATION = "evaluate"
     USER_TEST_COMPILATION = "compile_test"
     USER_TEST_EVALUATION = "evaluate_test"
 
+    # The types, used to share the same string among all operations.
+    _TYPES = dict((type_, type_) for type_ in [
+        COMPILATION, EVALUATION, USER_TEST_COMPILATION, USER_TEST_EVALUATION])
+
+    # The codenames seen so far, for the same purpose (they are few
+    # and cannot be interned by Python as they are unicode).
+    _codenames = dict()
+
     # Testcase codename is only needed for EVALUATION type of operation
     def __init__(self, type_, object_id, dataset_id, testcase_codename=None):
-        self.type_ = type_
+        self.type_ = ESOperation._TYPES.get(type_, type_)
         self.object_id = object_id
         self.dataset_id = dataset_id
+        if testcase_codename is not None:
+            testcase_codename = ESOperation._codenames.setdefault(
+                testcase_codename, testcase_codename)
         self.testcase_codename = testcase_codename
+        # Data that the user of the operation can attach to it.
+        self.side_data = None
+        self._hash = hash((self.type_, self.object_id, self.dataset_id,
+                           self.testcase_codename))
 
     @staticmethod
     def from_dict(d):
@@ -519,16 +696,21 @@ class ESOperation(QueueItem):
         # We may receive a non-ESOperation other when comparing with
         # operations in the worker pool (as these may also be unicode or
         # None)
+        if self is other:
+            return True
         if self.__class__ != other.__class__:
             return False
-        return self.type_ == other.type_ \
+        return self._hash == other._hash \
+            and self.type_ == other.type_ \
             and self.object_id == other.object_id \
             and self.dataset_id == other.dataset_id \
             and self.testcase_codename == other.testcase_codename
 
+    def __ne__(self, other):
+        return not self == other
+
     def __hash__(self):
-        return hash((self.type_, self.object_id, self.dataset_id,
-                     self.testcase_codename))
+        return self._hash
 
     def __str__(self):
         if self.type_ == ESOperation.EVALUATION:
@@ -0,0 +1,181 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Partition of the work among the shards of EvaluationService.
+
+When more than one EvaluationService is configured, each shard is
+responsible for the submissions and user tests whose id modulo the
+number of shards is equal to its own shard, and uses the Workers
+whose shard modulo the number of shards is equal to its own. Hence,
+shards never share operations nor workers.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+
+from cms import ServiceCoord, get_service_shards
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_es_shards():
+    """Return the number of shards of EvaluationService.
+
+    return (int): the number of shards in the configuration (at
+        least 1, as services may want to talk to the shard 0 even if
+        it is not configured).
+
+    """
+    return max(1, get_service_shards("EvaluationService"))
+
+
+def get_es_shard(object_id, es_shards=None):
+    """Return the shard of ES responsible for an object.
+
+    object_id (int): the id of a submission or of a user test.
+    es_shards (int|None): the number of shards of ES, or None to read
+        it from the configuration.
+
+    return (int): the shard of ES that handles the object.
+
+    """
+    if es_shards is None:
+        es_shards = get_es_shards()
+    return object_id % es_shards
+
+
+def get_worker_es_shard(worker_shard, es_shards=None):
+    """Return the shard of ES that uses a Worker.
+
+    worker_shard (int): the shard of the Worker service.
+    es_shards (int|None): the number of shards of ES, or None to read
+        it from the configuration.
+
+    return (int): the shard of ES that sends jobs to the Worker.
+
+    """
+    if es_shards is None:
+        es_shards = get_es_shards()
+    return worker_shard % es_shards
+
+
+def get_es_worker_shards(es_shard, es_shards=None):
+    """Return the Workers that a shard of ES uses.
+
+    es_shard (int): the shard of ES.
+    es_shards (int|None): the number of shards of ES, or None to read
+        it from the configuration.
+
+    return ([int]): the shards of the Worker services assigned to
+        the shard of ES.
+
+    """
+    if es_shards is None:
+        es_shards = get_es_shards()
+    return [worker_shard
+            for worker_shard in xrange(get_service_shards("Worker"))
+            if get_worker_es_shard(worker_shard, es_shards) == es_shard]
+
+
+class EvaluationServiceRouter(object):
+    """Proxy sending the RPCs for EvaluationService to the right shard.
+
+    It can be used in place of the RemoteServiceClient of ES by the
+    services that notify it of new submissions and user tests, or ask
+    for invalidations: the requests about a single object go to the
+    shard responsible for it, the others to all shards.
+
+    """
+
+    def __init__(self, service):
+        """Connect to all the shards of ES.
+
+        service (Service): the service connecting to ES.
+
+        """
+        self.es_shards = get_es_shards()
+        self._remote_services = [
+            service.connect_to(ServiceCoord("EvaluationService", es_shard))
+            for es_shard in xrange(self.es_shards)]
+
+    def get_remote_service(self, object_id):
+        """Return the shard of ES responsible for an object.
+
+        object_id (int): the id of a submission or of a user test.
+
+        return (RemoteServiceClient): the client for the shard.
+
+        """
+        return self._remote_services[get_es_shard(object_id,
+                                                  self.es_shards)]
+
+    def new_submission(self, submission_id, **kwargs):
+        """Notify the right shard of a new submission.
+
+        submission_id (int): the id of the new submission.
+
+        return (AsyncResult): the result of the RPC.
+
+        """
+        return self.get_remote_service(submission_id).new_submission(
+            submission_id=submission_id, **kwargs)
+
+    def new_user_test(self, user_test_id, **kwargs):
+        """Notify the right shard of a new user test.
+
+        user_test_id (int): the id of the new user test.
+
+        return (AsyncResult): the result of the RPC.
+
+        """
+        return self.get_remote_service(user_test_id).new_user_test(
+            user_test_id=user_test_id, **kwargs)
+
+    def invalidate_submission(self, submission_id=None, **kwargs):
+        """Ask for an invalidation to the shards involved.
+
+        submission_id (int|None): the id of the submission to
+            invalidate, or None to invalidate all the submissions
+            matching the other arguments (see
+            EvaluationService.invalidate_submission).
+
+        return ([AsyncResult]): the results of the RPCs.
+
+        """
+        if submission_id is not None:
+            return [self.get_remote_service(submission_id)
+                    .invalidate_submission(submission_id=submission_id,
+                                           forward=False, **kwargs)]
+        return [remote_service.invalidate_submission(forward=False,
+                                                     **kwargs)
+                for remote_service in self._remote_services]
+
+    def search_operations_not_done(self, **kwargs):
+        """Ask all shards to look for operations to do.
+
+        return ([AsyncResult]): the results of the RPCs.
+
+        """
+        return [remote_service.search_operations_not_done(**kwargs)
+                for remote_service in self._remote_services]
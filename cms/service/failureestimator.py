@@ -0,0 +1,123 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Rolling estimates of how often the testcases make submissions fail.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+
+from .esoperations import ESOperation
+
+
+logger = logging.getLogger(__name__)
+
+
+class FailureEstimator(object):
+    """Keep an estimate of the failure rate of the testcases.
+
+    For each testcase (identified by dataset and codename) we keep an
+    exponential moving average of how often the evaluations on it
+    fail (i.e., have outcome 0, as for wrong answers, timeouts and
+    crashes). ES uses it to evaluate each submission on the testcases
+    most likely to fail first, so that the final verdict (or, with
+    lazy evaluation, the decision to skip the rest of a subtask)
+    comes earlier.
+
+    """
+
+    # Weight of a new evaluation in the moving average.
+    SMOOTHING = 0.1
+
+    # Estimate for testcases never evaluated.
+    DEFAULT_RATE = 0.0
+
+    def __init__(self):
+        # Type: {(int, unicode): float}
+        self._rates = dict()
+
+    def estimate(self, dataset_id, testcase_codename):
+        """Return the estimated failure rate of a testcase.
+
+        dataset_id (int): the dataset of the testcase.
+        testcase_codename (unicode): the codename of the testcase.
+
+        return (float): the estimated probability that an evaluation
+            on the testcase fails.
+
+        """
+        return self._rates.get((dataset_id, testcase_codename),
+                               FailureEstimator.DEFAULT_RATE)
+
+    def add_outcome(self, operation, outcome):
+        """Update the estimates with the outcome of an evaluation.
+
+        operation (ESOperation): an evaluation operation, executed
+            successfully.
+        outcome (unicode|None): the outcome of the evaluation.
+
+        """
+        if operation.type_ != ESOperation.EVALUATION:
+            return
+        try:
+            failed = outcome is None or float(outcome) <= 0.0
+        except ValueError:
+            return
+        key = (operation.dataset_id, operation.testcase_codename)
+        self._rates[key] = \
+            (1 - FailureEstimator.SMOOTHING) * self.estimate(*key) + \
+            FailureEstimator.SMOOTHING * (1.0 if failed else 0.0)
+
+    def sort_key(self, operation):
+        """Return a key to order operations failure-first.
+
+        operation (ESOperation): an operation.
+
+        return (float): a smaller value for the evaluations on the
+            testcases more likely to fail; 0.0 for other operations.
+
+        """
+        if operation.type_ != ESOperation.EVALUATION:
+            return 0.0
+        return -self.estimate(operation.dataset_id,
+                              operation.testcase_codename)
+
+    def sort_operations(self, operations):
+        """Sort operations to be enqueued, failure-first.
+
+        The operations are sorted by priority and timestamp, as the
+        queue would do, and then by the failure rate of their
+        testcases; the queue keeps this order among operations with
+        the same priority and timestamp (i.e., those of the same
+        submission).
+
+        operations ([(ESOperation, int, datetime)]): the operations
+            with their priority and timestamp.
+
+        return ([(ESOperation, int, datetime)]): the same operations,
+            sorted.
+
+        """
+        return sorted(operations,
+                      key=lambda entry: (entry[1], entry[2],
+                                         self.sort_key(entry[0])))
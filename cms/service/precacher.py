@@ -0,0 +1,297 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Download in the cache of a Worker the files of a contest.
+
+When a Worker comes online, EvaluationService asks it to precache
+the files it will need to evaluate the submissions of the contest
+(managers and testcases). They can amount to gigabytes, so they are
+listed with a single query, the ones of the active datasets first,
+and downloaded by a few greenlets at the same time. Only the files
+fitting in the cache are downloaded: the others would evict from
+the cache (least recently used first) the ones more likely needed.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import logging
+import time
+
+import gevent
+import gevent.pool
+
+from sqlalchemy import case, func
+
+from cms import config
+from cms.db import SessionGen, Dataset, FSObject, Manager, Task, Testcase
+from cms.db.filecacher import TombstoneError
+from cms.db.fsobject import LargeObject
+
+
+logger = logging.getLogger(__name__)
+
+
+# The priorities of the files: lower values are downloaded first.
+PRIORITY_ACTIVE_MANAGER = 0
+PRIORITY_ACTIVE_TESTCASE = 1
+PRIORITY_OTHER = 2
+
+
+def get_precache_files(session, contest_id):
+    """Return the files to precache for a contest.
+
+    The files are the managers and the testcases of all the datasets
+    of the tasks of the contest; those of the active datasets come
+    first (managers before testcases, as every job needs them), the
+    larger first among files of the same priority. Files missing from
+    the database are omitted.
+
+    session (Session): the session to use.
+    contest_id (int): the id of the contest.
+
+    return ([(unicode, int)]): the digest and size (0 if unknown) of
+        each file.
+
+    """
+    def priority(active_priority):
+        return case([(Task.active_dataset_id == Dataset.id,
+                      active_priority)],
+                    else_=PRIORITY_OTHER)
+
+    def dataset_files(digest_column, dataset_column, active_priority):
+        return session.query(digest_column.label("digest"),
+                             priority(active_priority).label("priority"))\
+            .filter(dataset_column == Dataset.id)\
+            .filter(Dataset.task_id == Task.id)\
+            .filter(Task.contest_id == contest_id)
+
+    files = dataset_files(Manager.digest, Manager.dataset_id,
+                          PRIORITY_ACTIVE_MANAGER).union_all(
+        dataset_files(Testcase.input, Testcase.dataset_id,
+                      PRIORITY_ACTIVE_TESTCASE),
+        dataset_files(Testcase.output, Testcase.dataset_id,
+                      PRIORITY_ACTIVE_TESTCASE)).subquery()
+    digests = session.query(
+        files.c.digest,
+        func.min(files.c.priority).label("priority"))\
+        .group_by(files.c.digest).subquery()
+
+    # The size of a large object is the position of its end; that of
+    # the files in the store (see HybridBackend) is not known.
+    size = case([(FSObject.loid == 0, 0)],
+                else_=func.lo_lseek(
+                    func.lo_open(FSObject.loid, LargeObject.INV_READ),
+                    0, io.SEEK_END)).label("size")
+    rows = session.query(digests.c.digest, size)\
+        .join(FSObject, FSObject.digest == digests.c.digest)\
+        .order_by(digests.c.priority, size.desc(), digests.c.digest)\
+        .all()
+    return [(digest, size) for digest, size in rows]
+
+
+class Precacher(object):
+    """Download the files of a contest in the cache of a Worker.
+
+    The download happens in the background, using at most a given
+    number of greenlets; its progress is available through
+    get_status.
+
+    """
+
+    IDLE = "idle"
+    WAITING = "waiting"
+    LISTING = "listing"
+    LOADING = "loading"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, file_cacher, concurrency, delay=0.0):
+        """Initialize.
+
+        file_cacher (FileCacher): the cache to fill.
+        concurrency (int): the maximum number of files downloaded at
+            the same time.
+        delay (float): seconds to wait before starting, so that the
+            Workers coming online together do not all query the
+            database at the same time.
+
+        """
+        self.file_cacher = file_cacher
+        self.concurrency = max(1, concurrency)
+        self.delay = delay
+        self._greenlet = None
+        self._reset(None)
+
+    def _reset(self, contest_id):
+        """Forget the progress of the previous precaching.
+
+        contest_id (int|None): the contest to precache.
+
+        """
+        self._contest_id = contest_id
+        self._state = Precacher.IDLE
+        self._start_time = None
+        self._end_time = None
+        self._files_total = 0
+        self._files_done = 0
+        self._files_missing = 0
+        self._files_skipped = 0
+        self._bytes_total = 0
+        self._bytes_done = 0
+
+    def start(self, contest_id):
+        """Start precaching the files of a contest.
+
+        If the files of the same contest are already being precached
+        nothing happens; if those of another one are, that precaching
+        is stopped.
+
+        contest_id (int): the id of the contest.
+
+        """
+        if self._greenlet is not None and not self._greenlet.ready():
+            if self._contest_id == contest_id:
+                return
+            logger.info("Stopping precaching for contest %d.",
+                        self._contest_id)
+            self._greenlet.kill()
+        self._reset(contest_id)
+        self._start_time = time.time()
+        self._greenlet = gevent.spawn(self._run, contest_id)
+
+    def wait(self):
+        """Wait for the current precaching, if any, to finish."""
+        if self._greenlet is not None:
+            self._greenlet.join()
+
+    def get_status(self):
+        """Return the progress of the last precaching.
+
+        return (dict): the contest ("contest_id"), the state
+            ("state", one of IDLE, WAITING, LISTING, LOADING, DONE
+            and FAILED), the number of files to precache and already
+            precached ("files_total", "files_done"; those missing
+            from the database, "files_missing", are counted as done),
+            their size in bytes ("bytes_total", "bytes_done"), the
+            number of files not precached as they would not fit in
+            the cache ("files_skipped") and the seconds since the
+            start ("elapsed").
+
+        """
+        elapsed = 0.0
+        if self._start_time is not None:
+            elapsed = (self._end_time or time.time()) - self._start_time
+        return {
+            "contest_id": self._contest_id,
+            "state": self._state,
+            "files_total": self._files_total,
+            "files_done": self._files_done,
+            "files_missing": self._files_missing,
+            "files_skipped": self._files_skipped,
+            "bytes_total": self._bytes_total,
+            "bytes_done": self._bytes_done,
+            "elapsed": elapsed,
+        }
+
+    def _run(self, contest_id):
+        """Precache the files of a contest (in its own greenlet).
+
+        contest_id (int): the id of the contest.
+
+        """
+        try:
+            if self.delay > 0:
+                self._state = Precacher.WAITING
+                gevent.sleep(self.delay)
+
+            logger.info("Precaching files for contest %d.", contest_id)
+            self._state = Precacher.LISTING
+            # In order to avoid a long-living connection, first fetch
+            # the complete list of files and then download the files;
+            # since this is just pre-caching, possible race conditions
+            # are not dangerous.
+            with SessionGen() as session:
+                files = get_precache_files(session, contest_id)
+            files = self._fit_in_cache(files)
+            self._files_total = len(files)
+            self._bytes_total = sum(size for unused_digest, size in files)
+
+            self._state = Precacher.LOADING
+            pool = gevent.pool.Pool(self.concurrency)
+            for digest, size in files:
+                pool.spawn(self._load, digest, size)
+            pool.join()
+        except Exception:
+            logger.error("Precaching for contest %d failed.", contest_id,
+                         exc_info=True)
+            self._state = Precacher.FAILED
+        else:
+            logger.info("Precaching finished: %d files (%d missing), "
+                        "%.1f MiB in %.1f seconds.", self._files_total,
+                        self._files_missing, self._bytes_total / 2.0 ** 20,
+                        time.time() - self._start_time)
+            self._state = Precacher.DONE
+        self._end_time = time.time()
+
+    def _fit_in_cache(self, files):
+        """Return the files to precache that fit in the cache.
+
+        files ([(unicode, int)]): the digest and size of the files to
+            precache, the most important first.
+
+        return ([(unicode, int)]): the longest prefix of files whose
+            total size does not exceed config.file_cache_size.
+
+        """
+        if config.file_cache_size <= 0:
+            return files
+        budget = config.file_cache_size * 1024 * 1024
+        total_size = 0
+        for index, (unused_digest, size) in enumerate(files):
+            total_size += size
+            if total_size > budget:
+                self._files_skipped = len(files) - index
+                logger.warning("The files of contest %d do not fit in the "
+                               "cache: precaching only %d of %d.",
+                               self._contest_id, index, len(files))
+                return files[:index]
+        return files
+
+    def _load(self, digest, size):
+        """Download a file in the cache, if needed.
+
+        digest (unicode): the digest of the file.
+        size (int): the size of the file, in bytes.
+
+        """
+        try:
+            self.file_cacher.load(digest, if_needed=True)
+        except (KeyError, TombstoneError):
+            # No problem (at this stage) if we cannot find the file.
+            self._files_missing += 1
+        except Exception:
+            logger.warning("Couldn't precache file %s.", digest,
+                           exc_info=True)
+            self._files_missing += 1
+        self._files_done += 1
+        self._bytes_done += size
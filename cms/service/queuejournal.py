@@ -0,0 +1,349 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""On-disk journal of the queue of EvaluationService.
+
+The journal allows ES to rebuild its queue right after a restart,
+without waiting for a scan of the whole database.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import os
+
+from collections import OrderedDict
+
+import gevent
+
+from cmscommon.datetime import make_datetime, make_timestamp
+
+from .esoperations import ESOperation
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueJournal(object):
+    """An append-only log of the changes to the queue of ES.
+
+    Each line of the file is a JSON list: the first line is a header
+    with the contest ES is running for, the others record that an
+    operation was pushed in the queue (with its priority and
+    timestamp) or removed from it, or the marks of the sweeper (see
+    EvaluationService._missing_operations). An operation is removed
+    when ES writes its result, not when it is sent to a Worker, so
+    that the operations being executed are not lost in a restart.
+    When the file has grown too much since it was last written, it is
+    rewritten from the content of the queue that ES holds in memory.
+
+    Records are buffered and written to disk on flush(); losing the
+    last ones is not a problem, as ES reconciles the queue with the
+    database after loading it.
+
+    """
+
+    VERSION = 1
+
+    HEADER = "cms-es-queue"
+    PUSH = "+"
+    REMOVE = "-"
+    MARKS = "m"
+
+    # The file is rewritten when it has more than this number of
+    # times the records it had when last rewritten (and at least
+    # MIN_COMPACTION_RECORDS records).
+    COMPACTION_RATIO = 4
+    MIN_COMPACTION_RECORDS = 10000
+
+    # Number of records written when rewriting the file before
+    # yielding to the other greenlets.
+    REWRITE_CHUNK_SIZE = 1000
+
+    def __init__(self, path, contest_id):
+        """Create the journal.
+
+        path (unicode): the file where to keep the journal.
+        contest_id (int|None): the contest ES is running for.
+
+        """
+        self.path = path
+        self.contest_id = contest_id
+
+        # Type: ([int|None], [int|None])|None
+        self._marks = None
+        # The number of records in the file (and in the buffer), and
+        # in the file when it was last rewritten.
+        self._records = 0
+        self._rewritten_records = 0
+        self._buffer = []
+        self._file = None
+        # Whether the file misses some records (because writing them
+        # failed) and must be rewritten, and whether it is being
+        # rewritten.
+        self._needs_rewrite = False
+        self._rewriting = False
+
+    def load(self):
+        """Read the content of the queue from the journal.
+
+        The journal is then started anew, so that the caller should
+        enqueue again the operations returned (recording them).
+
+        return ([(ESOperation, int, datetime)], ([int|None],
+            [int|None])|None): the operations in the queue, with
+            their priority and timestamp, and the marks of the
+            sweeper for submissions and user tests (None if not
+            recorded).
+
+        """
+        entries, marks = self._read()
+        self._marks = marks
+        self.rewrite([])
+        logger.info("Loaded %d operations from the queue journal.",
+                    len(entries))
+        return [(operation, priority, make_datetime(timestamp))
+                for operation, (priority, timestamp) in entries.iteritems()],\
+            marks
+
+    def _read(self):
+        """Replay the records in the file.
+
+        return ({ESOperation: (int, float)}, ([int|None],
+            [int|None])|None): the operations in the queue, in the
+            order they were pushed, with their priority and timestamp,
+            and the marks of the sweeper (None if not recorded).
+
+        """
+        entries = OrderedDict()
+        marks = None
+        try:
+            with io.open(self.path, "rt", encoding="utf-8") as journal:
+                header = json.loads(journal.readline())
+                records = journal
+                if header != [QueueJournal.HEADER, QueueJournal.VERSION,
+                              self.contest_id]:
+                    logger.warning("Ignoring queue journal %s as it was "
+                                   "written for a different version or "
+                                   "contest.", self.path)
+                    records = []
+                for line in records:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Probably the last line, partially written.
+                        logger.warning("Skipping invalid record in the "
+                                       "queue journal.")
+                        continue
+                    if record[0] == QueueJournal.PUSH:
+                        entries[ESOperation(*record[1:5])] = \
+                            (record[5], record[6])
+                    elif record[0] == QueueJournal.REMOVE:
+                        entries.pop(ESOperation(*record[1:5]), None)
+                    elif record[0] == QueueJournal.MARKS:
+                        marks = (record[1], record[2])
+        except (IOError, OSError):
+            logger.info("No queue journal found in %s.", self.path)
+        except ValueError:
+            logger.warning("Ignoring queue journal %s as it is invalid.",
+                           self.path)
+        return entries, marks
+
+    @staticmethod
+    def _encode_operation(operation):
+        """Return the fields of an operation to write in a record.
+
+        operation (ESOperation): the operation.
+
+        return ([object]): type, object id, dataset id and testcase
+            codename.
+
+        """
+        return [operation.type_, operation.object_id, operation.dataset_id,
+                operation.testcase_codename]
+
+    def _append(self, record):
+        """Buffer a record to write.
+
+        record ([object]): the record.
+
+        """
+        self._buffer.append(QueueJournal._dumps(record))
+        self._records += 1
+
+    @staticmethod
+    def _dumps(record):
+        """Return the line of the file for a record.
+
+        record ([object]): the record.
+
+        return (unicode): the line, without the newline.
+
+        """
+        return json.dumps(record, separators=(',', ':'))
+
+    @staticmethod
+    def _push_record(operation, priority, timestamp):
+        """Return the record of an operation pushed in the queue.
+
+        operation (ESOperation): the operation.
+        priority (int): its priority.
+        timestamp (datetime): its timestamp.
+
+        return ([object]): the record.
+
+        """
+        return [QueueJournal.PUSH] \
+            + QueueJournal._encode_operation(operation) \
+            + [priority, make_timestamp(timestamp)]
+
+    def record_push(self, operation, priority, timestamp):
+        """Record that an operation was pushed in the queue.
+
+        operation (ESOperation): the operation.
+        priority (int): its priority.
+        timestamp (datetime): its timestamp.
+
+        """
+        self._append(QueueJournal._push_record(
+            operation, priority, timestamp))
+
+    def record_remove(self, operation):
+        """Record that an operation was removed from the queue, or
+        that its result was written.
+
+        operation (ESOperation): the operation.
+
+        """
+        self._append([QueueJournal.REMOVE]
+                     + QueueJournal._encode_operation(operation))
+
+    def record_marks(self, submission_marks, user_test_marks):
+        """Record the marks of the sweeper.
+
+        submission_marks ([int|None]): the marks for submissions.
+        user_test_marks ([int|None]): the marks for user tests.
+
+        """
+        marks = (list(submission_marks), list(user_test_marks))
+        if marks != self._marks:
+            self._marks = marks
+            self._append([QueueJournal.MARKS] + list(marks))
+
+    def flush(self, get_entries):
+        """Write the buffered records to disk, rewriting the journal
+        if it has become too long or if it misses some records.
+
+        get_entries (function): called without arguments when the
+            journal has to be rewritten, it returns the current
+            content of the queue, as [(ESOperation, int, datetime)]
+            (see rewrite).
+
+        """
+        if self._rewriting:
+            # The records will be written at the end of the rewrite.
+            return
+        if not self._needs_rewrite:
+            self._write_buffer()
+        if self._needs_rewrite or self._records > max(
+                QueueJournal.MIN_COMPACTION_RECORDS,
+                QueueJournal.COMPACTION_RATIO * self._rewritten_records):
+            self.rewrite(get_entries())
+
+    def _write_buffer(self):
+        """Append the buffered records to the file.
+
+        If this fails the records would be lost, so the file is
+        marked to be rewritten from the content of the queue.
+
+        """
+        if len(self._buffer) == 0:
+            return
+        try:
+            if self._file is None:
+                raise IOError("The queue journal is not open.")
+            self._file.write("".join(
+                "%s\n" % record for record in self._buffer))
+            self._file.flush()
+        except (IOError, OSError):
+            logger.error("Couldn't write to the queue journal, it will be "
+                         "rewritten.", exc_info=True)
+            self._needs_rewrite = True
+        self._buffer = []
+
+    def rewrite(self, entries):
+        """Write a new journal with the given content of the queue.
+
+        The records are written in chunks, yielding to the other
+        greenlets in between; the records buffered meanwhile come
+        after the new content and are written at the end.
+
+        entries ([(ESOperation, int, datetime)]): the operations in
+            the queue, with their priority and timestamp.
+
+        """
+        self._rewriting = True
+        self._needs_rewrite = True
+        self._buffer = []
+        self._records = 0
+        marks = self._marks
+        rewritten_records = 0
+
+        temp_path = "%s.tmp" % self.path
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            with io.open(temp_path, "wt", encoding="utf-8") as journal:
+                journal.write("%s\n" % QueueJournal._dumps(
+                    [QueueJournal.HEADER, QueueJournal.VERSION,
+                     self.contest_id]))
+                for start in xrange(0, len(entries),
+                                    QueueJournal.REWRITE_CHUNK_SIZE):
+                    journal.write("".join(
+                        "%s\n" % QueueJournal._dumps(
+                            QueueJournal._push_record(
+                                operation, priority, timestamp))
+                        for operation, priority, timestamp in entries[
+                            start:start + QueueJournal.REWRITE_CHUNK_SIZE]))
+                    gevent.sleep(0)
+                if marks is not None:
+                    journal.write("%s\n" % QueueJournal._dumps(
+                        [QueueJournal.MARKS] + list(marks)))
+                rewritten_records = 1 + len(entries) + \
+                    (1 if marks is not None else 0)
+            os.rename(temp_path, self.path)
+            self._file = io.open(self.path, "at", encoding="utf-8")
+        except (IOError, OSError):
+            logger.error("Couldn't write the queue journal, it will be "
+                         "rewritten again.", exc_info=True)
+            self._buffer = []
+        else:
+            self._needs_rewrite = False
+        finally:
+            self._rewriting = False
+        self._records += rewritten_records
+        self._rewritten_records = rewritten_records
+        if not self._needs_rewrite:
+            self._write_buffer()
@@ -33,12 +33,14 @@ from __future__ import unicode_literals
 import logging
 import random
 
+from collections import OrderedDict
 from datetime import timedelta
 
 import gevent.coros
 
 from gevent.event import Event
 
+from cms import config
 from cms.db import Dataset, SessionGen, Submission, UserTest
 from cms.grading.Job import Job, JobGroup
 from cmscommon.datetime import make_datetime, make_timestamp
@@ -51,6 +53,21 @@ class WorkerPool(object):
     """This class keeps the state of the workers attached to ES, and
     allow the ES to get a usable worker when it needs it.
 
+    Each execution slot of a Worker service is a separate worker for
+    the pool: if Workers have config.worker_slots slots, the slot s of
+    the Worker with shard w is identified by the shard number
+    w * config.worker_slots + s (that is, just w when Workers have a
+    single slot).
+
+    Moreover, each slot can be sent up to config.worker_pipeline_depth
+    job groups before the first one finishes, so that the Worker can
+    download the files of the next ones while executing the current
+    one. Hence each slot is in turn split into that many workers, the
+    position p of the slot with index i above being identified by the
+    shard number i * config.worker_pipeline_depth + p. The results and
+    the failures of each job group are thus tracked separately, exactly
+    as for the other workers.
+
     """
 
     WORKER_INACTIVE = None
@@ -59,6 +76,15 @@ class WorkerPool(object):
     # Seconds after which we declare a worker stale.
     WORKER_TIMEOUT = timedelta(seconds=600)
 
+    # Maximum number of digests we remember for each worker when
+    # scheduling by cache affinity (the least recently sent are
+    # forgotten first).
+    MAX_CACHED_DIGESTS = 10000
+
+    # Time after which an idle worker passed over in favor of one with
+    # a better cache affinity is chosen anyway.
+    MAX_AFFINITY_WAIT = timedelta(seconds=60)
+
     def __init__(self, service):
         """service (Service): the EvaluationService using this
         WorkerPool.
@@ -85,6 +111,19 @@ class WorkerPool(object):
         self._schedule_disabling = {}
         # Type: {int: bool}
         self._ignore = {}
+        # The digests we sent to each Worker (identified by its shard
+        # as a service, hence shared among its slots), which we expect
+        # to be in its cache, in order of last use.
+        # Type: {int: OrderedDict}
+        self._cached_digests = {}
+        # When each worker was first passed over in favor of one with
+        # a better cache affinity, since it was last chosen.
+        # Type: {int: Datetime|None}
+        self._passed_over_since = {}
+        # When each slot (identified by shard //
+        # config.worker_pipeline_depth) last finished a job group.
+        # Type: {int: Datetime}
+        self._last_release_time = {}
 
         # TODO: given the number of pieces data associated to each
         # worker, this class could be simplified by creating a new
@@ -114,6 +153,16 @@ class WorkerPool(object):
     def __contains__(self, operation):
         return operation in self._operations_reverse
 
+    def get_operations(self):
+        """Return the operations assigned to the workers.
+
+        return ([ESOperation]): the operations, as they were given to
+            acquire_worker.
+
+        """
+        with self._operation_lock:
+            return self._operations_reverse.keys()
+
     def _remove_operations(self, shard, new_operation):
         """Safely remove operations from a worker, assigning a new status.
 
@@ -143,30 +192,69 @@ class WorkerPool(object):
             for operation in operations:
                 self._operations_reverse[operation] = shard
 
+    def get_usable_workers_count(self):
+        """Return the number of workers that can receive operations.
+
+        return (int): the number of connected and enabled workers.
+
+        """
+        return sum(1 for shard, worker_operation
+                   in self._operations.iteritems()
+                   if worker_operation != WorkerPool.WORKER_DISABLED and
+                   self._worker[shard].connected)
+
     def wait_for_workers(self):
         """Wait until a worker might be available."""
         self._workers_available_event.wait()
 
+    @staticmethod
+    def get_worker_shard_and_slot(shard):
+        """Return the Worker and the slot corresponding to a worker.
+
+        shard (int): the shard of the worker in the pool.
+
+        return ((int, int)): the shard of the Worker service, and the
+            index of the slot.
+
+        """
+        return divmod(shard // config.worker_pipeline_depth,
+                      config.worker_slots)
+
+    def _get_shards(self, worker_shard):
+        """Return the shards of the workers of a Worker service.
+
+        worker_shard (int): the shard of the Worker service.
+
+        return ([int]): the shards of its slots (and of their pipeline
+            positions) in the pool.
+
+        """
+        units = config.worker_slots * config.worker_pipeline_depth
+        return range(worker_shard * units, (worker_shard + 1) * units)
+
     def add_worker(self, worker_coord):
-        """Add a new worker to the worker pool.
+        """Add a new Worker (that is, all of its slots) to the pool.
 
         worker_coord (ServiceCoord): the coordinates of the worker.
 
         """
-        shard = worker_coord.shard
         # Instruct GeventLibrary to connect ES to the Worker.
-        self._worker[shard] = self._service.connect_to(
+        worker = self._service.connect_to(
             worker_coord,
             on_connect=self.on_worker_connected)
+        self._cached_digests[worker_coord.shard] = OrderedDict()
 
         # And we fill all data.
-        self._operations[shard] = WorkerPool.WORKER_INACTIVE
-        self._operations_to_ignore[shard] = []
-        self._start_time[shard] = None
-        self._schedule_disabling[shard] = False
-        self._ignore[shard] = False
+        for shard in self._get_shards(worker_coord.shard):
+            self._worker[shard] = worker
+            self._operations[shard] = WorkerPool.WORKER_INACTIVE
+            self._operations_to_ignore[shard] = []
+            self._start_time[shard] = None
+            self._schedule_disabling[shard] = False
+            self._ignore[shard] = False
+            self._passed_over_since[shard] = None
+            logger.debug("Worker %s added.", shard)
         self._workers_available_event.set()
-        logger.debug("Worker %s added.", shard)
 
     def on_worker_connected(self, worker_coord):
         """To be called when a worker comes alive after being
@@ -177,10 +265,16 @@ class WorkerPool(object):
                                      that came online.
 
         """
-        shard = worker_coord.shard
-        logger.info("Worker %s online again.", shard)
+        worker_shard = worker_coord.shard
+        logger.info("Worker %s online again.", worker_shard)
+        worker = self._worker[self._get_shards(worker_shard)[0]]
+        # The worker might have been restarted elsewhere, so we do
+        # not trust anymore what we know about its cache.
+        self._cached_digests[worker_shard] = OrderedDict()
+        worker.slots_status(callback=self._check_slots,
+                            plus=worker_shard)
         if self._service.contest_id is not None:
-            self._worker[shard].precache_files(
+            worker.precache_files(
                 contest_id=self._service.contest_id
             )
         # We don't requeue the operation, because a connection lost
@@ -190,11 +284,35 @@ class WorkerPool(object):
         # so we wake up the consumers.
         self._workers_available_event.set()
 
+    def _check_slots(self, data, worker_shard, error=None):
+        """Compare the slots reported by a Worker with ours.
+
+        data ([dict]|None): the status of the slots of the Worker, as
+            returned by Worker.slots_status.
+        worker_shard (int): the shard of the Worker.
+        error (unicode|None): the error, if the RPC failed.
+
+        """
+        if error is not None:
+            logger.warning("Couldn't retrieve the slots of worker %s: %s.",
+                           worker_shard, error)
+        elif len(data) != config.worker_slots:
+            logger.error("Worker %s has %d slots, but %d are expected; "
+                         "check that worker_slots is the same for all "
+                         "services.", worker_shard, len(data),
+                         config.worker_slots)
+
     def acquire_worker(self, operations):
         """Tries to assign an operation to an available worker. If no workers
         are available then this returns None, otherwise this returns
         the chosen worker.
 
+        The operations are sent to one of the slots with the fewest
+        job groups in flight. If worker_affinity_scheduling is enabled
+        in the configuration, among those we choose the one that most
+        likely has in its cache the files they need; otherwise a random
+        one.
+
         operations ([ESOperation]): the operations to assign to a worker.
 
         return (int|None): None if no workers are available, the worker
@@ -203,19 +321,12 @@ class WorkerPool(object):
         """
         # We look for an available worker.
         try:
-            shard = self.find_worker(WorkerPool.WORKER_INACTIVE,
-                                     require_connection=True,
-                                     random_worker=True)
+            self.find_worker(WorkerPool.WORKER_INACTIVE,
+                             require_connection=True)
         except LookupError:
             self._workers_available_event.clear()
             return None
 
-        # Then we fill the info for future memory.
-        self._add_operations(shard, operations)
-
-        logger.debug("Worker %s acquired.", shard)
-        self._start_time[shard] = make_datetime()
-
         with SessionGen() as session:
             jobs = []
             datasets = {}
@@ -237,18 +348,123 @@ class WorkerPool(object):
                         user_tests[operation.object_id] = \
                             UserTest.get_from_id(operation.object_id, session)
                     object_ = user_tests[operation.object_id]
-                logger.info("Asking worker %s to `%s'.", shard, operation)
 
                 jobs.append(Job.from_operation(
                     operation, object_, datasets[operation.dataset_id]))
             job_group_dict = JobGroup(jobs).export_to_dict()
 
+        digests = set()
+        for job in jobs:
+            digests.update(job.get_digests())
+
+        # Building the jobs may have yielded, so the worker we found
+        # before might not be available anymore.
+        try:
+            shard = self._choose_worker(digests)
+        except LookupError:
+            self._workers_available_event.clear()
+            return None
+
+        # Then we fill the info for future memory.
+        self._add_operations(shard, operations)
+        self._remember_digests(shard, digests)
+
+        logger.debug("Worker %s acquired.", shard)
+        self._start_time[shard] = make_datetime()
+
+        for operation in operations:
+            logger.info("Asking worker %s to `%s'.", shard, operation)
+
+        unused_worker_shard, slot = self.get_worker_shard_and_slot(shard)
         self._worker[shard].execute_job_group(
             job_group_dict=job_group_dict,
+            slot=slot,
             callback=self._service.action_finished,
             plus=shard)
         return shard
 
+    def _choose_worker(self, digests):
+        """Return the idle worker to which to send a group of jobs.
+
+        We only consider the idle workers whose slot has the fewest
+        job groups in flight, so that the pipeline of a slot is used
+        only when all slots are busy. Among them, without affinity
+        scheduling, the worker is chosen uniformly
+        at random. Otherwise, we choose the worker that has been sent
+        the largest number of the digests, unless there are workers
+        that were first passed over in favor of one with a better
+        affinity at least MAX_AFFINITY_WAIT ago, in which case we
+        choose among them. Ties do not count as being passed over, so
+        that the jobs sharing files keep going to the same worker.
+
+        digests ({unicode}): the digests needed by the jobs.
+
+        return (int): the shard of the chosen worker.
+
+        raise (LookupError): if no worker is available.
+
+        """
+        pool = [shard
+                for shard, worker_operation in self._operations.iteritems()
+                if worker_operation == WorkerPool.WORKER_INACTIVE and
+                self._worker[shard].connected]
+        if pool == []:
+            raise LookupError("No such operation.")
+
+        in_flight = dict()
+        for shard, worker_operation in self._operations.iteritems():
+            if isinstance(worker_operation, list):
+                slot_id = shard // config.worker_pipeline_depth
+                in_flight[slot_id] = in_flight.get(slot_id, 0) + 1
+        least_in_flight = min(
+            in_flight.get(shard // config.worker_pipeline_depth, 0)
+            for shard in pool)
+        pool = [shard for shard in pool
+                if in_flight.get(shard // config.worker_pipeline_depth, 0)
+                == least_in_flight]
+
+        if not config.worker_affinity_scheduling:
+            return random.choice(pool)
+
+        affinity = dict()
+        for shard in pool:
+            worker_shard, unused_slot = self.get_worker_shard_and_slot(shard)
+            cached_digests = self._cached_digests[worker_shard]
+            affinity[shard] = sum(1 for digest in digests
+                                  if digest in cached_digests)
+
+        now = make_datetime()
+        candidates = [shard for shard in pool
+                      if self._passed_over_since[shard] is not None and
+                      now - self._passed_over_since[shard] >=
+                      WorkerPool.MAX_AFFINITY_WAIT]
+        if candidates == []:
+            best = max(affinity.itervalues())
+            candidates = [shard for shard in pool if affinity[shard] == best]
+        shard = random.choice(candidates)
+
+        for other_shard in pool:
+            if affinity[other_shard] < affinity[shard] and \
+                    self._passed_over_since[other_shard] is None:
+                self._passed_over_since[other_shard] = now
+        self._passed_over_since[shard] = None
+        return shard
+
+    def _remember_digests(self, shard, digests):
+        """Record that a worker will have some digests in its cache.
+
+        shard (int): the worker.
+        digests ({unicode}): the digests sent to the worker.
+
+        """
+        worker_shard, unused_slot = self.get_worker_shard_and_slot(shard)
+        cached_digests = self._cached_digests[worker_shard]
+        for digest in digests:
+            cached_digests.pop(digest, None)
+            cached_digests[digest] = None
+        while len(cached_digests) > WorkerPool.MAX_CACHED_DIGESTS:
+            cached_digests.popitem(last=False)
+
     def release_worker(self, shard):
         """To be called by ES when it receives a notification that an
         operation finished.
@@ -274,6 +490,8 @@ class WorkerPool(object):
         if self._operations[shard] == WorkerPool.WORKER_DISABLED:
             return True
 
+        self._last_release_time[shard // config.worker_pipeline_depth] = \
+            make_datetime()
         ret = self._ignore[shard]
         with self._operation_lock:
             to_ignore = self._operations_to_ignore[shard]
@@ -293,6 +511,55 @@ class WorkerPool(object):
         else:
             return ret
 
+    def _get_execution_start(self, shard):
+        """Return when a worker started executing its operations.
+
+        Job groups sent to the same slot are executed one after the
+        other, so the execution started when the job group was sent
+        or when the slot finished the previous one, whichever is
+        later; until the job groups sent before to the slot are
+        finished, it has not started at all.
+
+        shard (int): the worker.
+
+        return (Datetime|None): the start of the execution, or None if
+            the worker is not executing anything.
+
+        """
+        start_time = self._start_time[shard]
+        if start_time is None:
+            return None
+        slot_id = shard // config.worker_pipeline_depth
+        for other_shard in xrange(
+                slot_id * config.worker_pipeline_depth,
+                (slot_id + 1) * config.worker_pipeline_depth):
+            other_start_time = self._start_time[other_shard]
+            if other_start_time is not None and \
+                    (other_start_time, other_shard) < (start_time, shard):
+                return None
+        last_release_time = self._last_release_time.get(slot_id)
+        if last_release_time is not None and last_release_time > start_time:
+            start_time = last_release_time
+        return start_time
+
+    def get_execution_time(self, shard):
+        """Return for how long a worker has been executing its
+        operations (see _get_execution_start).
+
+        shard (int): the worker.
+
+        return (float|None): the time in seconds (0 if the job group
+            is waiting for the previous ones sent to the same slot),
+            or None if the worker is not executing anything.
+
+        """
+        if self._start_time[shard] is None:
+            return None
+        start_time = self._get_execution_start(shard)
+        if start_time is None:
+            return 0.0
+        return (make_datetime() - start_time).total_seconds()
+
     def find_worker(self, operation, require_connection=False,
                     random_worker=False):
         """Return a worker whose assigned operation is operation.
@@ -355,8 +622,12 @@ class WorkerPool(object):
         for shard in self._worker.keys():
             s_time = self._start_time[shard]
             s_time = make_timestamp(s_time) if s_time is not None else None
+            worker_shard, slot = self.get_worker_shard_and_slot(shard)
 
             result["%d" % shard] = {
+                'worker_shard': worker_shard,
+                'slot': slot,
+                'position': shard % config.worker_pipeline_depth,
                 'connected': self._worker[shard].connected,
                 'operations': [operation.to_dict()
                                for operation in self._operations[shard]]
@@ -377,8 +648,11 @@ class WorkerPool(object):
         now = make_datetime()
         lost_operations = []
         for shard in self._worker:
-            if self._start_time[shard] is not None:
-                active_for = now - self._start_time[shard]
+            # Job groups waiting in the pipeline of a slot are not
+            # timed, as they depend on the ones before them.
+            start_time = self._get_execution_start(shard)
+            if start_time is not None:
+                active_for = now - start_time
 
                 if active_for > WorkerPool.WORKER_TIMEOUT:
                     # Here shard is a working worker with no sign of
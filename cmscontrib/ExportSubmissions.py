@@ -33,8 +33,9 @@ import sys
 import codecs
 
 from cms import utf8_decoder
-from cms.db import Dataset, File, FSObject, Participation, SessionGen, \
-    Submission, SubmissionResult, Task, User
+from cms.db import Dataset, File, Participation, SessionGen, Submission, \
+    SubmissionResult, Task, User
+from cms.db.filecacher import FileCacher
 from cms.grading import languagemanager
 
 
@@ -145,6 +146,8 @@ def main():
         logger.critical("The output-dir parameter must point to a directory")
         return 1
 
+    file_cacher = FileCacher()
+
     with SessionGen() as session:
         q = session.query(Submission)\
             .join(Submission.task)\
@@ -201,41 +204,39 @@ def main():
                 logger.warning("Skipping file '%s' because it already exists",
                                filename)
 
-            fso = FSObject.get_from_digest(f_digest, session)
-            assert fso is not None
-            with fso.get_lobject(mode="rb") as file_obj:
-                data = file_obj.read()
-
-                if args.utf8:
-                    try:
-                        data = utf8_decoder(data)
-                    except TypeError:
-                        logger.critical("Could not guess encoding of file "
-                                        "'%s'. Aborting.",
-                                        filename)
-                        sys.exit(1)
-
-                    if args.add_info:
-                        data = TEMPLATE[ext] % (
-                            u_name,
-                            u_fname,
-                            u_lname,
-                            t_name,
-                            sr_score,
-                            s_timestamp
-                        ) + data
-
-                    # Print utf8-encoded, possibly altered data
-                    with codecs.open(filename, "w", encoding="utf-8") as f_out:
-                        f_out.write(data)
-                else:
-                    # Print raw, untouched binary data
-                    with open(filename, "wb") as f_out:
-                        f_out.write(data)
+            data = file_cacher.get_file_content(f_digest)
+
+            if args.utf8:
+                try:
+                    data = utf8_decoder(data)
+                except TypeError:
+                    logger.critical("Could not guess encoding of file "
+                                    "'%s'. Aborting.",
+                                    filename)
+                    sys.exit(1)
+
+                if args.add_info:
+                    data = TEMPLATE[ext] % (
+                        u_name,
+                        u_fname,
+                        u_lname,
+                        t_name,
+                        sr_score,
+                        s_timestamp
+                    ) + data
+
+                # Print utf8-encoded, possibly altered data
+                with codecs.open(filename, "w", encoding="utf-8") as f_out:
+                    f_out.write(data)
+            else:
+                # Print raw, untouched binary data
+                with open(filename, "wb") as f_out:
+                    f_out.write(data)
 
             done += 1
             print(done, "/", len(results))
 
+    file_cacher.destroy_cache()
     return 0
 
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the transfer of large objects from and to the database.
+
+Measure the throughput of writing and reading files of a few sizes as
+large objects, as FileCacher does with the database backend, against
+the previous implementation (a new cursor for each query, and chunks
+of FileCacher.CHUNK_SIZE bytes). It needs the database configured in
+cms.conf; the large objects it creates are deleted at the end.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import sys
+import time
+
+from argparse import ArgumentParser
+
+from cms.db.filecacher import FileCacher
+from cms.db.fsobject import LargeObject
+from cms.io.GeventUtils import copyfileobj
+
+
+class LegacyLargeObject(LargeObject):
+    """LargeObject as it was before reusing its cursor and reading
+    without intermediate buffers.
+
+    """
+
+    def _execute(self, operation, parameters, message, cursor=None):
+        if cursor is None:
+            cursor = self._conn.cursor()
+            res = LargeObject._execute(
+                self, operation, parameters, message, cursor)
+            cursor.close()
+            return res
+        return LargeObject._execute(
+            self, operation, parameters, message, cursor)
+
+    def read(self, size=-1):
+        return io.RawIOBase.read(self, size)
+
+
+def legacy_copy(src, dst):
+    copyfileobj(src, dst, FileCacher.CHUNK_SIZE)
+
+
+def current_copy(src, dst):
+    copyfileobj(src, dst, FileCacher.CHUNK_SIZE, FileCacher.MAX_CHUNK_SIZE)
+
+
+def put(cls, copy, content):
+    """Store content in a new large object.
+
+    return ((int, float)): the id of the large object and the elapsed
+        time in seconds.
+
+    """
+    start = time.time()
+    with cls(0, "wb") as lobj:
+        copy(io.BytesIO(content), lobj)
+        loid = lobj.loid
+    return loid, max(time.time() - start, 1e-9)
+
+
+def get(cls, copy, loid, content):
+    """Read a large object, checking it has the given content.
+
+    return (float): the elapsed time in seconds.
+
+    """
+    dst = io.BytesIO()
+    start = time.time()
+    with cls(loid, "rb") as lobj:
+        copy(lobj, dst)
+    elapsed = max(time.time() - start, 1e-9)
+    assert dst.getvalue() == content
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser(
+        description="Benchmark of the transfer of large objects.")
+    parser.add_argument("-s", "--sizes", type=int, nargs="+",
+                        default=[16, 1024, 100 * 1024],
+                        help="sizes of the files, in KiB "
+                        "(default 16 1024 102400)")
+    args = parser.parse_args()
+
+    loids = []
+    try:
+        for size in args.sizes:
+            content = os.urandom(size * 1024)
+            megabytes = len(content) / 2.0 ** 20
+            print("File of %d KiB." % size)
+            for operation in ["put", "get"]:
+                throughputs = []
+                for cls, copy in [(LegacyLargeObject, legacy_copy),
+                                  (LargeObject, current_copy)]:
+                    loid, elapsed = put(cls, copy, content)
+                    loids.append(loid)
+                    if operation == "get":
+                        elapsed = get(cls, copy, loid, content)
+                    throughputs.append(megabytes / elapsed)
+                print("  %-4s previous %8.1lf MB/s, current %8.1lf MB/s, "
+                      "speedup %6.2lfx" %
+                      (operation, throughputs[0], throughputs[1],
+                       throughputs[1] / throughputs[0]))
+    finally:
+        for loid in loids:
+            LargeObject.unlink(loid)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
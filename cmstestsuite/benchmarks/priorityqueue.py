@@ -0,0 +1,236 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of PriorityQueue.
+
+Measure the throughput of push, set_priority, remove and pop on a
+queue of ESOperations, comparing PriorityQueue with the binary heap
+of QueueEntry objects that it replaced (reproduced below).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import sys
+import time
+
+from argparse import ArgumentParser
+
+from cms.io.priorityqueue import PriorityQueue
+from cms.service.esoperations import ESOperation
+from cmscommon.datetime import make_datetime
+
+
+class LegacyQueueEntry(object):
+    """QueueEntry as it was before PriorityQueue used heapq."""
+
+    def __init__(self, item, priority, timestamp, index):
+        self.item = item
+        self.priority = priority
+        self.timestamp = timestamp
+        self.index = index
+
+    def __cmp__(self, other):
+        if self.priority != other.priority:
+            return cmp(self.priority, other.priority)
+        elif self.timestamp != other.timestamp:
+            return cmp(self.timestamp, other.timestamp)
+        else:
+            return cmp(self.index, other.index)
+
+
+class LegacyPriorityQueue(object):
+    """The core of PriorityQueue as it was before using heapq."""
+
+    def __init__(self):
+        self._queue = []
+        self._reverse = {}
+        self._next_index = 0
+
+    def __contains__(self, item):
+        return item in self._reverse
+
+    def _swap(self, idx1, idx2):
+        self._queue[idx1], self._queue[idx2] = \
+            self._queue[idx2], self._queue[idx1]
+        self._reverse[self._queue[idx1].item] = idx1
+        self._reverse[self._queue[idx2].item] = idx2
+
+    def _up_heap(self, idx):
+        while idx > 0:
+            parent = (idx - 1) // 2
+            if self._queue[idx] < self._queue[parent]:
+                self._swap(parent, idx)
+                idx = parent
+            else:
+                break
+        return idx
+
+    def _down_heap(self, idx):
+        last = len(self._queue) - 1
+        while 2 * idx + 1 <= last:
+            child = 2 * idx + 1
+            if 2 * idx + 2 <= last and \
+                    self._queue[2 * idx + 2] < self._queue[child]:
+                child = 2 * idx + 2
+            if self._queue[child] < self._queue[idx]:
+                self._swap(child, idx)
+                idx = child
+            else:
+                break
+        return idx
+
+    def push(self, item, priority=None, timestamp=None):
+        if item in self._reverse:
+            return False
+        index = self._next_index
+        self._next_index += 1
+        self._queue.append(LegacyQueueEntry(item, priority, timestamp, index))
+        last = len(self._queue) - 1
+        self._reverse[item] = last
+        self._up_heap(last)
+        return True
+
+    def pop(self):
+        top = self._queue[0]
+        last = len(self._queue) - 1
+        self._swap(0, last)
+        del self._reverse[top.item]
+        del self._queue[last]
+        if last > 0:
+            self._down_heap(0)
+        return top
+
+    def remove(self, item):
+        pos = self._reverse[item]
+        entry = self._queue[pos]
+        last = len(self._queue) - 1
+        self._swap(pos, last)
+        del self._reverse[item]
+        del self._queue[last]
+        if pos != last:
+            self._down_heap(self._up_heap(pos))
+        return entry
+
+    def set_priority(self, item, priority):
+        pos = self._reverse[item]
+        self._queue[pos].priority = priority
+        self._down_heap(self._up_heap(pos))
+
+    def empty(self):
+        return len(self._queue) == 0
+
+
+def timed(name, size, function, *args):
+    """Run a function and print its throughput.
+
+    name (unicode): what is being measured.
+    size (int): the number of operations the function performs.
+    function (function): the function to run.
+
+    return (float): the throughput in operations per second.
+
+    """
+    start = time.time()
+    function(*args)
+    elapsed = max(time.time() - start, 1e-9)
+    print("  %-14s %10d ops in %7.3lf s, %12.0lf ops/s" %
+          (name, size, elapsed, size / elapsed))
+    return size / elapsed
+
+
+def benchmark(queue_class, operations, push_many=False):
+    """Run the benchmark on a queue implementation.
+
+    queue_class (type): the class of the queue.
+    operations ([(ESOperation, int, datetime)]): the items to push.
+    push_many (bool): whether to use push_many instead of push.
+
+    return ({unicode: float}): the throughput of each method.
+
+    """
+    queue = queue_class()
+    changed = random.sample(operations, len(operations) // 10)
+    removed = random.sample(operations, len(operations) // 10)
+    results = {}
+
+    def push():
+        for item, priority, timestamp in operations:
+            queue.push(item, priority, timestamp)
+
+    def set_priority():
+        for item, unused_priority, unused_timestamp in changed:
+            queue.set_priority(item, PriorityQueue.PRIORITY_EXTRA_HIGH)
+
+    def remove():
+        for item, unused_priority, unused_timestamp in removed:
+            if item in queue:
+                queue.remove(item)
+
+    def pop():
+        while not queue.empty():
+            queue.pop()
+
+    if push_many:
+        results["push_many"] = timed(
+            "push_many", len(operations), queue.push_many, operations)
+    else:
+        results["push"] = timed("push", len(operations), push)
+    results["set_priority"] = timed("set_priority", len(changed),
+                                    set_priority)
+    results["remove"] = timed("remove", len(removed), remove)
+    results["pop"] = timed(
+        "pop", len(operations) - len(set(removed)), pop)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark of PriorityQueue.")
+    parser.add_argument("-n", "--size", type=int, default=10 ** 6,
+                        help="number of items to push (default 10^6)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    operations = []
+    for i in xrange(args.size):
+        operations.append((
+            ESOperation(ESOperation.EVALUATION, i // 100, 1,
+                        "%03d" % (i % 100)),
+            random.randint(PriorityQueue.PRIORITY_EXTRA_HIGH,
+                           PriorityQueue.PRIORITY_EXTRA_LOW),
+            make_datetime(random.randint(0, 10 ** 6))))
+
+    print("Previous binary heap:")
+    legacy = benchmark(LegacyPriorityQueue, operations)
+    print("PriorityQueue:")
+    current = benchmark(PriorityQueue, operations)
+    print("PriorityQueue with push_many:")
+    benchmark(PriorityQueue, operations, push_many=True)
+
+    print("Speedup:")
+    for name in ["push", "set_priority", "remove", "pop"]:
+        print("  %-14s %6.2lfx" % (name, current[name] / legacy[name]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
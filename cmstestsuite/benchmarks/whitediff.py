@@ -0,0 +1,129 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of white_diff.
+
+Measure the time to compare large outputs with the reference, in the
+common cases of outputs identical to it, equal up to whitespaces, and
+wrong, comparing white_diff with the line by line implementation that
+it replaced (reproduced below).
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+from cms.grading import WHITES, white_diff, white_diff_canonicalize
+from cms.io.GeventUtils import rmtree
+
+
+def legacy_white_diff(output, res):
+    """white_diff as it was before comparing in chunks."""
+    while True:
+        lout = output.readline()
+        lres = res.readline()
+        if lres == b'' and lout == b'':
+            return True
+        elif lres == b'' or lout == b'':
+            lout = lout.strip(WHITES)
+            lres = lres.strip(WHITES)
+            if lout != b'' or lres != b'':
+                return False
+        else:
+            lout = white_diff_canonicalize(lout)
+            lres = white_diff_canonicalize(lres)
+            if lout != lres:
+                return False
+
+
+def timed(function, output_path, res_path):
+    """Compare two files and return the time it took.
+
+    function (function): the comparator.
+    output_path (string): path of the first file.
+    res_path (string): path of the second file.
+
+    return ((bool, float)): the result of the comparison and the
+        elapsed time in seconds.
+
+    """
+    with io.open(output_path, "rb") as output, \
+            io.open(res_path, "rb") as res:
+        start = time.time()
+        result = function(output, res)
+        return result, max(time.time() - start, 1e-9)
+
+
+def write(path, lines):
+    with io.open(path, "wb") as f:
+        f.write(b"\n".join(lines))
+        f.write(b"\n")
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark of white_diff.")
+    parser.add_argument("-n", "--lines", type=int, default=10 ** 6,
+                        help="number of lines of the outputs (default 10^6)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    lines = [b" ".join(b"%d" % random.randint(0, 10 ** 9)
+                       for _ in xrange(random.randint(1, 10)))
+             for _ in xrange(args.lines)]
+    spaced = [b"\t" + line.replace(b" ", b"  ") + b" \r" for line in lines]
+    wrong = list(lines)
+    wrong[len(wrong) * 9 // 10] = b"0"
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = {}
+        for name, content in [("res", lines), ("identical", lines),
+                              ("spaced", spaced), ("wrong", wrong)]:
+            paths[name] = os.path.join(tmpdir, name)
+            write(paths[name], content)
+        print("Reference of %d lines, %d bytes." %
+              (args.lines, os.path.getsize(paths["res"])))
+
+        for name in ["identical", "spaced", "wrong"]:
+            legacy_result, legacy_time = timed(
+                legacy_white_diff, paths[name], paths["res"])
+            result, current_time = timed(
+                white_diff, paths[name], paths["res"])
+            assert result == legacy_result
+            print("  %-10s %-5s previous %7.3lf s, current %7.3lf s, "
+                  "speedup %6.2lfx" %
+                  (name, result, legacy_time, current_time,
+                   legacy_time / current_time))
+    finally:
+        rmtree(tmpdir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -34,9 +34,17 @@ import random
 from StringIO import StringIO
 import hashlib
 import shutil
+import stat
+import tempfile
 import unittest
 
-from cms.db.filecacher import FileCacher
+import gevent
+
+from mock import MagicMock, Mock, patch
+
+from cms import config
+from cms.db.filecacher import CacheIndex, CorruptedFileError, FileCacher, \
+    HybridBackend
 
 
 class RandomFile(object):
@@ -171,6 +179,8 @@ class TestFileCacher(unittest.TestCase):
 
         # Retrieve the file.
         self.fake_content = "Fake content.\n"
+        # Cached files are read-only.
+        os.chmod(self.cache_path, 0644)
         with io.open(self.cache_path, "wb") as cached_file:
             cached_file.write(self.fake_content)
         try:
@@ -264,6 +274,8 @@ class TestFileCacher(unittest.TestCase):
 
         # Retrieve the file as a string.
         self.fake_content = "Fake content.\n"
+        # Cached files are read-only.
+        os.chmod(self.cache_path, 0644)
         with io.open(self.cache_path, "wb") as cached_file:
             cached_file.write(self.fake_content)
         try:
@@ -324,5 +336,341 @@ class TestFileCacher(unittest.TestCase):
             self.file_cacher.delete(self.digest)
 
 
+
+class TestCacheIndex(unittest.TestCase):
+    """Tests for the limit on the size of the local cache, using a
+    file system backend.
+
+    """
+
+    def setUp(self):
+        patcher = patch.object(config, "file_cache_size", 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_path, True)
+        self.file_cacher = FileCacher(path=self.storage_path)
+        self.addCleanup(shutil.rmtree, self.file_cacher.file_dir, True)
+        self.index = self.file_cacher.index
+        self.megabyte = 1024 * 1024
+
+    def put(self, char, size):
+        return self.file_cacher.put_file_content(char * size)
+
+    def test_eviction(self):
+        """The least recently used files are deleted from the cache,
+        but can still be retrieved.
+
+        """
+        digest_a = self.put(b"a", self.megabyte // 2)
+        digest_b = self.put(b"b", self.megabyte // 4)
+        self.assertEqual(self.megabyte * 3 // 4, self.index.get_total_size())
+
+        # Use a, so that b becomes the least recently used.
+        self.file_cacher.get_file_content(digest_a)
+        digest_c = self.put(b"c", self.megabyte // 2)
+        self.assertFalse(self.file_cacher.is_cached(digest_b))
+        self.assertTrue(self.file_cacher.is_cached(digest_a))
+        self.assertTrue(self.file_cacher.is_cached(digest_c))
+        self.assertEqual(self.megabyte, self.index.get_total_size())
+
+        self.assertEqual(b"b" * (self.megabyte // 4),
+                         self.file_cacher.get_file_content(digest_b))
+        self.assertTrue(self.file_cacher.is_cached(digest_b))
+        self.assertLessEqual(self.index.get_total_size(), self.megabyte)
+
+    def test_large_file(self):
+        """A file larger than the cache is kept until the next one."""
+        digest_a = self.put(b"a", self.megabyte * 2)
+        self.assertTrue(self.file_cacher.is_cached(digest_a))
+        digest_b = self.put(b"b", 10)
+        self.assertFalse(self.file_cacher.is_cached(digest_a))
+        self.assertTrue(self.file_cacher.is_cached(digest_b))
+
+    def test_open_file(self):
+        """Files being read are not affected by the eviction."""
+        digest_a = self.put(b"a", self.megabyte)
+        with self.file_cacher.get_file(digest_a) as f:
+            self.put(b"b", 10)
+            self.assertFalse(self.file_cacher.is_cached(digest_a))
+            self.assertEqual(b"a" * self.megabyte, f.read())
+
+    def test_restart(self):
+        """The recency of the files is kept across restarts."""
+        digests = [self.put(char, 10) for char in [b"a", b"b", b"c"]]
+        for age, digest in zip([10, 30, 20], digests):
+            os.utime(os.path.join(self.file_cacher.file_dir, digest),
+                     (1000 - age, 1000 - age))
+        index = CacheIndex(self.file_cacher.file_dir, 20)
+        self.assertEqual(30, index.get_total_size())
+        # Make room for a new file of 10 bytes.
+        index.add(digests[0])
+        self.assertNotIn(digests[1], index)
+        self.assertFalse(self.file_cacher.is_cached(digests[1]))
+        self.assertIn(digests[2], index)
+
+    def test_drop(self):
+        digest = self.put(b"a", 10)
+        self.file_cacher.drop(digest)
+        self.assertEqual(0, len(self.index))
+        self.assertEqual(0, self.index.get_total_size())
+
+    def test_hard_linked(self):
+        """Files linked in a sandbox are not evicted."""
+        digest_a = self.put(b"a", self.megabyte)
+        os.link(os.path.join(self.file_cacher.file_dir, digest_a),
+                os.path.join(self.storage_path, "sandbox_a"))
+        digest_b = self.put(b"b", 10)
+        self.assertTrue(self.file_cacher.is_cached(digest_a))
+        self.assertTrue(self.file_cacher.is_cached(digest_b))
+        self.assertEqual(0, self.index.evictions)
+
+        os.unlink(os.path.join(self.storage_path, "sandbox_a"))
+        self.put(b"c", 10)
+        self.assertFalse(self.file_cacher.is_cached(digest_a))
+        # When found linked, a was marked as used after b, hence b
+        # was deleted first.
+        self.assertFalse(self.file_cacher.is_cached(digest_b))
+        self.assertEqual(2, self.index.evictions)
+
+    def test_no_eviction_below_size(self):
+        """Adding files does not look at the others while the cache
+        is not full.
+
+        """
+        digest_a = self.put(b"a", 10)
+        with patch("cms.db.filecacher.os.stat", wraps=os.stat) as stat:
+            digest_b = self.put(b"b", 10)
+        self.assertEqual(
+            [], [args for args, unused_kwargs in stat.call_args_list
+                 if args[0].endswith(digest_a)])
+        self.assertTrue(self.file_cacher.is_cached(digest_a))
+        self.assertTrue(self.file_cacher.is_cached(digest_b))
+
+    def test_cache_path_no_chmod(self):
+        """Looking up a cached file does not change its permissions."""
+        digest = self.put(b"a", 10)
+        with patch("cms.db.filecacher.os.chmod") as chmod:
+            self.file_cacher.get_file_cache_path(digest)
+        self.assertFalse(chmod.called)
+
+    def test_old_permissions(self):
+        """Files cached by older versions are made read-only when the
+        cache is indexed.
+
+        """
+        digest = self.put(b"a", 10)
+        path = os.path.join(self.file_cacher.file_dir, digest)
+        os.chmod(path, 0644)
+        CacheIndex(self.file_cacher.file_dir, 0)
+        self.assertEqual(FileCacher.CACHE_FILE_MODE,
+                         stat.S_IMODE(os.stat(path).st_mode))
+
+
+class TestSharedCache(unittest.TestCase):
+    """Tests for the cache shared by the services of a host, using a
+    file system backend.
+
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+        for name, value in [("shared_file_cache", True),
+                            ("cache_dir", self.cache_dir)]:
+            patcher = patch.object(config, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.storage_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.storage_path, True)
+
+        self.worker = self.file_cacher(Mock(shard=0), "Worker")
+        self.cws = self.file_cacher(Mock(shard=0), "ContestWebServer")
+
+    def file_cacher(self, service, name):
+        service.name = name
+        return FileCacher(service, path=self.storage_path)
+
+    def test_same_directory(self):
+        self.assertEqual(self.worker.file_dir, self.cws.file_dir)
+        digest = self.cws.put_file_content(b"content")
+        self.assertEqual(b"content", self.worker.get_file_content(digest))
+        self.assertEqual({"hits": 1, "misses": 0, "waits": 0,
+                          "downloaded_bytes": 0, "evictions": 0},
+                         self.worker.get_stats())
+
+    def test_single_flight(self):
+        """Concurrent loads of the same file download it once."""
+        digest = self.cws.put_file_content(b"content")
+        self.cws.drop(digest)
+
+        backend_get_file = self.worker.backend.get_file
+
+        def slow_get_file(digest):
+            gevent.sleep(0.2)
+            return backend_get_file(digest)
+        self.worker.backend.get_file = Mock(side_effect=slow_get_file)
+        self.cws.backend.get_file = self.worker.backend.get_file
+
+        greenlets = [gevent.spawn(file_cacher.load, digest, if_needed=True)
+                     for file_cacher in [self.worker, self.cws]]
+        gevent.joinall(greenlets, raise_error=True)
+
+        self.assertEqual(1, self.worker.backend.get_file.call_count)
+        stats = [self.worker.get_stats(), self.cws.get_stats()]
+        self.assertEqual([1, 0], [stats[0]["misses"], stats[1]["misses"]])
+        self.assertEqual([0, 1], [stats[0]["waits"], stats[1]["waits"]])
+        self.assertEqual(len(b"content"), stats[0]["downloaded_bytes"])
+        self.assertEqual([], os.listdir(self.worker.lock_dir))
+        self.assertEqual(b"content", self.cws.get_file_content(digest))
+
+    def test_missing_file(self):
+        """A failed load releases the lock and leaves no file."""
+        with self.assertRaises(KeyError):
+            self.worker.load("0" * 40)
+        self.assertEqual([], os.listdir(self.worker.lock_dir))
+        self.assertEqual([], os.listdir(self.worker.temp_dir))
+
+    def test_evicted_by_another_service(self):
+        digest = self.cws.put_file_content(b"content")
+        os.unlink(os.path.join(self.cws.file_dir, digest))
+        self.assertEqual(b"content", self.worker.get_file_content(digest))
+
+
+class TestHybridBackend(unittest.TestCase):
+    """Tests for the backend storing the content of the files in a
+    directory, with the database mocked.
+
+    """
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_path, True)
+        self.backend = HybridBackend(self.store_path)
+
+        # The FSObjects in the database, by digest.
+        self.objects = {}
+        self.session = MagicMock()
+        self.session.add.side_effect = \
+            lambda fso: self.objects.__setitem__(fso.digest, fso)
+        # The number of FSObjects whose loid is set to 0.
+        self.session.query.return_value.filter.return_value.filter\
+            .return_value.update.return_value = 1
+        session_gen = MagicMock()
+        session_gen.return_value.__enter__.return_value = self.session
+        fsobject = Mock(side_effect=lambda description: Mock(
+            loid=0, description=description))
+        fsobject.get_from_digest.side_effect = \
+            lambda digest, session: self.objects.get(digest)
+        for name, value in [("SessionGen", session_gen),
+                            ("FSObject", fsobject)]:
+            patcher = patch("cms.db.filecacher.%s" % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def put(self, content):
+        digest = hashlib.sha1(content).hexdigest().decode("ascii")
+        fobj = self.backend.put_file(digest, "desc")
+        fobj.write(content)
+        fobj.close()
+        return digest
+
+    def test_put_and_get(self):
+        digest = self.put(b"content")
+        self.assertEqual("desc", self.objects[digest].description)
+        self.assertIsNone(self.backend.put_file(digest))
+        with self.backend.get_file(digest) as fobj:
+            self.assertEqual(b"content", fobj.read())
+        self.assertEqual(7, self.backend.get_size(digest))
+        self.assertEqual([], os.listdir(self.backend.temp_dir))
+
+    def test_put_wrong_digest(self):
+        """Content not matching the digest is not stored."""
+        fobj = self.backend.put_file("0" * 40, "desc")
+        fobj.write(b"content")
+        with self.assertRaises(CorruptedFileError):
+            fobj.close()
+        self.assertEqual({}, self.objects)
+        self.assertEqual([], os.listdir(self.backend.temp_dir))
+        with self.assertRaises(KeyError):
+            self.backend.get_file("0" * 40)
+
+    def test_get_corrupted(self):
+        digest = self.put(b"content")
+        path = os.path.join(self.store_path, digest[:2], digest)
+        os.chmod(path, 0o644)
+        with io.open(path, "wb") as f:
+            f.write(b"corrupted")
+        with self.backend.get_file(digest) as fobj:
+            with self.assertRaises(CorruptedFileError):
+                fobj.read()
+
+    def test_move_from_database(self):
+        """Files in large objects are moved to the store when read."""
+        digest = hashlib.sha1(b"content").hexdigest().decode("ascii")
+        self.objects[digest] = Mock(loid=42)
+        with patch("cms.db.filecacher.LargeObject") as large_object:
+            large_object.return_value = io.BytesIO(b"content")
+            with self.backend.get_file(digest) as fobj:
+                self.assertEqual(b"content", fobj.read())
+            large_object.assert_called_once_with(42, mode="rb")
+            large_object.unlink.assert_called_once_with(42)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.store_path, digest[:2], digest)))
+
+
+    def publish(self, content):
+        """Place a file in the store, as another service would."""
+        digest = hashlib.sha1(content).hexdigest().decode("ascii")
+        fd, temp_path = tempfile.mkstemp(dir=self.backend.temp_dir)
+        with io.open(fd, "wb") as fobj:
+            fobj.write(content)
+        self.backend.publish(digest, temp_path, digest)
+
+    def test_moved_by_another_service(self):
+        """The file is moved after it was not found in the store, but
+        before its FSObject is read.
+
+        """
+        digest = hashlib.sha1(b"content").hexdigest().decode("ascii")
+
+        def get_from_digest(digest, session):
+            self.publish(b"content")
+            return Mock(loid=0)
+        with patch("cms.db.filecacher.FSObject") as fsobject, \
+                patch("cms.db.filecacher.LargeObject") as large_object:
+            fsobject.get_from_digest.side_effect = get_from_digest
+            with self.backend.get_file(digest) as fobj:
+                self.assertEqual(b"content", fobj.read())
+            self.assertFalse(large_object.called)
+
+    def test_large_object_deleted_by_another_service(self):
+        """The file is moved, and its large object deleted, after the
+        FSObject is read.
+
+        """
+        digest = hashlib.sha1(b"content").hexdigest().decode("ascii")
+        self.objects[digest] = Mock(loid=42)
+
+        def open_large_object(loid, mode):
+            self.publish(b"content")
+            raise IOError("Large object %d does not exist." % loid)
+        with patch("cms.db.filecacher.LargeObject") as large_object:
+            large_object.side_effect = open_large_object
+            with self.backend.get_file(digest) as fobj:
+                self.assertEqual(b"content", fobj.read())
+            self.assertFalse(large_object.unlink.called)
+        self.assertEqual([], os.listdir(self.backend.temp_dir))
+
+    def test_missing_large_object(self):
+        digest = hashlib.sha1(b"content").hexdigest().decode("ascii")
+        self.objects[digest] = Mock(loid=42)
+        with patch("cms.db.filecacher.LargeObject") as large_object:
+            large_object.side_effect = IOError()
+            with self.assertRaises(IOError):
+                self.backend.get_file(digest)
+        self.assertEqual([], os.listdir(self.backend.temp_dir))
+
+
 if __name__ == "__main__":
     unittest.main()
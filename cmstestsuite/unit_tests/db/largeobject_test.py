@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the queries made by LargeObject, using a fake connection
+that stores a single large object in memory.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import unittest
+
+import psycopg2.extensions
+
+from mock import patch
+
+from cms.db.fsobject import LargeObject
+from cms.io.GeventUtils import copyfileobj
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = None
+
+    def execute(self, operation, parameters):
+        self.connection.queries.append(operation.split("(")[0])
+        data = self.connection.data
+        if operation.startswith("SELECT loread"):
+            position = self.connection.position
+            self.result = buffer(data[position:position + parameters["len"]])
+            self.connection.position += len(self.result)
+        elif operation.startswith("SELECT lowrite"):
+            buf = bytes(parameters["buf"].adapted)
+            self.connection.data += buf
+            self.result = len(buf)
+        else:
+            self.result = 0
+
+    def fetchone(self):
+        return (self.result,)
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+
+    status = psycopg2.extensions.STATUS_BEGIN
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+        self.queries = []
+        self.cursors = 0
+        self.closed = False
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    def cursor(self):
+        self.cursors += 1
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestLargeObject(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = FakeConnection(b"")
+        patcher = patch("cms.db.fsobject.custom_psycopg2_connection",
+                        return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read(self):
+        self.connection.data = b"0123456789"
+        lobj = LargeObject(1, "rb")
+        self.assertEqual(b"0123", lobj.read(4))
+        buf = bytearray(4)
+        self.assertEqual(4, lobj.readinto(buf))
+        self.assertEqual(b"4567", bytes(buf))
+        self.assertEqual(b"89", lobj.read())
+        self.assertEqual(b"", lobj.read(4))
+        lobj.close()
+        self.assertEqual(1, self.connection.cursors)
+        self.assertTrue(self.connection.closed)
+
+    def test_readall_chunks(self):
+        """Reading a large object takes few queries."""
+        self.connection.data = b"x" * (10 * LargeObject.MAX_CHUNK_SIZE)
+        with LargeObject(1, "rb") as lobj:
+            self.assertEqual(self.connection.data, lobj.read())
+        self.assertLessEqual(self.connection.queries.count("SELECT loread"),
+                             10 + 12)
+
+    def test_copy(self):
+        """copyfileobj grows its chunks up to the maximum."""
+        self.connection.data = b"x" * (2 ** 20)
+        dst = io.BytesIO()
+        with LargeObject(1, "rb") as lobj:
+            copyfileobj(lobj, dst, 2 ** 14, 2 ** 18)
+        self.assertEqual(self.connection.data, dst.getvalue())
+        # 16, 32, 64, 128 KiB, then 256 KiB four times (the last one
+        # only partially filled), then the end.
+        self.assertEqual(9, self.connection.queries.count("SELECT loread"))
+
+    def test_write(self):
+        with LargeObject(1, "wb") as lobj:
+            copyfileobj(io.BytesIO(b"0123456789"), lobj, 4)
+        self.assertEqual(b"0123456789", self.connection.data)
+        self.assertEqual(1, self.connection.cursors)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the cache of the results of compilations."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+from cms.grading.Job import CompilationJob
+from cms.grading.Sandbox import Sandbox
+from cms.grading.compilationcache import CompilationCache, \
+    get_compilation_key, load_compilation, store_compilation
+from cms.io.GeventUtils import rmtree
+
+
+class TestCompilationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, self.tmpdir)
+        self.cache = CompilationCache(
+            os.path.join(self.tmpdir, "compilations"), 2)
+        patcher = patch("cms.grading.compilationcache.get_compilation_cache",
+                        return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.language = Mock()
+        self.language.name = "C++11 / g++"
+        self.file_cacher = Mock()
+
+    def test_key(self):
+        key = get_compilation_key(self.language, {"a.cpp": "1", "b.h": "2"},
+                                  [["g++", "a.cpp"]])
+        self.assertEqual(key, get_compilation_key(
+            self.language, {"b.h": "2", "a.cpp": "1"}, [["g++", "a.cpp"]]))
+        self.assertNotEqual(key, get_compilation_key(
+            self.language, {"a.cpp": "3", "b.h": "2"}, [["g++", "a.cpp"]]))
+        self.assertNotEqual(key, get_compilation_key(
+            self.language, {"a.cpp": "1", "b.h": "2"}, [["g++", "b.h"]]))
+
+    def test_key_compiler_version(self):
+        """Upgrading the compiler changes the key."""
+        compiler = os.path.join(self.tmpdir, "g++")
+        with io.open(compiler, "wb") as f:
+            f.write(b"version 1")
+        key = get_compilation_key(self.language, {"a.cpp": "1"},
+                                  [[compiler, "a.cpp"]])
+        self.assertEqual(key, get_compilation_key(
+            self.language, {"a.cpp": "1"}, [[compiler, "a.cpp"]]))
+        with io.open(compiler, "wb") as f:
+            f.write(b"version 1.1")
+        self.assertNotEqual(key, get_compilation_key(
+            self.language, {"a.cpp": "1"}, [[compiler, "a.cpp"]]))
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", {"x": 1})
+        self.assertEqual({"x": 1}, self.cache.get("a"))
+
+    def test_eviction(self):
+        """The least recently used results are deleted."""
+        self.cache.put("a", {})
+        self.cache.put("b", {})
+        os.utime(os.path.join(self.cache.path, "b"), (0, 0))
+        self.cache.put("c", {})
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("c"))
+
+    def _compiled_job(self, compilation_success=True, exit_status=None):
+        job = CompilationJob(info="compile")
+        job.success = True
+        job.compilation_success = compilation_success
+        job.text = ["Compilation succeeded"]
+        job.plus = {"exit_status": exit_status or Sandbox.EXIT_OK,
+                    "stdout": "", "stderr": "warning"}
+        if compilation_success:
+            job.executables["a"] = Mock(digest="exe")
+        return job
+
+    def test_store_and_load(self):
+        store_compilation(self._compiled_job(), "key")
+
+        job = CompilationJob(info="compile")
+        self.assertTrue(load_compilation(job, self.file_cacher, "key"))
+        self.assertTrue(job.success)
+        self.assertTrue(job.compilation_success)
+        self.assertEqual("warning", job.plus["stderr"])
+        self.assertEqual("exe", job.executables["a"].digest)
+        self.file_cacher.load.assert_called_once_with("exe", if_needed=True)
+
+    def test_load_missing_executable(self):
+        """Results whose executables are not available are ignored."""
+        store_compilation(self._compiled_job(), "key")
+        self.file_cacher.load.side_effect = KeyError()
+
+        job = CompilationJob(info="compile")
+        self.assertFalse(load_compilation(job, self.file_cacher, "key"))
+        self.assertEqual({}, job.executables)
+
+    def test_store_timeout(self):
+        """Compilations that timed out are not remembered."""
+        store_compilation(
+            self._compiled_job(False, Sandbox.EXIT_TIMEOUT), "key1")
+        store_compilation(
+            self._compiled_job(False, Sandbox.EXIT_NONZERO_RETURN), "key2")
+        job = CompilationJob(info="compile")
+        self.assertFalse(load_compilation(job, self.file_cacher, "key1"))
+        self.assertTrue(load_compilation(job, self.file_cacher, "key2"))
+        self.assertFalse(job.compilation_success)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the limit on the size of the outputs."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import signal
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+from cms import config
+from cms.grading import EVALUATION_MESSAGES, get_output_size_limit, \
+    human_evaluation_message, is_output_too_large
+from cms.grading.Sandbox import Sandbox
+from cms.grading.tasktypes.Batch import Batch
+
+
+class TestOutputSizeLimit(unittest.TestCase):
+
+    def setUp(self):
+        for name, value in [("max_output_size_factor", 2.0),
+                            ("max_output_size_slack", 10)]:
+            patcher = patch.object(config, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with io.open(fd, "wb") as output:
+            output.write(b"x" * 100 * 1024)
+        self.file_cacher = Mock()
+        self.file_cacher.get_file_cache_path.return_value = path
+
+    def test_limit(self):
+        self.assertEqual(210, get_output_size_limit(self.file_cacher, "d"))
+        self.file_cacher.get_file_cache_path.assert_called_once_with("d")
+        self.assertFalse(self.file_cacher.get_size.called)
+
+    def test_disabled(self):
+        config.max_output_size_factor = 0
+        self.assertIsNone(get_output_size_limit(self.file_cacher, "d"))
+
+    def test_unknown_output(self):
+        self.assertIsNone(get_output_size_limit(self.file_cacher, None))
+        self.file_cacher.get_file_cache_path.side_effect = KeyError()
+        self.assertIsNone(get_output_size_limit(self.file_cacher, "d"))
+
+    def test_too_large(self):
+        sandbox = Mock()
+        sandbox.stat_file.return_value = Mock(st_size=210 * 1024)
+        self.assertFalse(is_output_too_large(sandbox, "output.txt", 210))
+        self.assertFalse(is_output_too_large(sandbox, "output.txt", None))
+        sandbox.stat_file.return_value = Mock(st_size=210 * 1024 + 1)
+        self.assertTrue(is_output_too_large(sandbox, "output.txt", 210))
+        sandbox.stat_file.assert_called_with("output.txt")
+
+    def test_message(self):
+        """Solutions killed for writing too much are told so."""
+        self.assertEqual(
+            [EVALUATION_MESSAGES.get("outputlimit").message],
+            human_evaluation_message({"exit_status": Sandbox.EXIT_SIGNAL,
+                                      "signal": signal.SIGXFSZ}))
+        self.assertEqual(
+            [EVALUATION_MESSAGES.get("signal").message, signal.SIGSEGV],
+            human_evaluation_message({"exit_status": Sandbox.EXIT_SIGNAL,
+                                      "signal": signal.SIGSEGV}))
+
+
+class TestBatchOutputSizeLimit(unittest.TestCase):
+    """Test that Batch limits the outputs only when diffing them."""
+
+    def evaluate(self, evaluation_param):
+        job = Mock(only_execution=False, output="d", language="C++11 / g++")
+        job.executables = {"exe": Mock(digest="e")}
+        job.managers = {"checker": Mock(digest="c")}
+        task_type = Batch(["alone", ["", ""], evaluation_param])
+        module = "cms.grading.tasktypes.Batch."
+        with patch(module + "create_sandbox"), \
+                patch(module + "delete_sandbox"), \
+                patch(module + "get_output_size_limit",
+                      return_value=210) as get_limit, \
+                patch(module + "evaluation_step",
+                      return_value=(False, None)) as step:
+            task_type.evaluate(job, Mock())
+        return get_limit, step.call_args[1]["max_output_size"]
+
+    def test_diff(self):
+        get_limit, max_output_size = self.evaluate("diff")
+        self.assertTrue(get_limit.called)
+        self.assertEqual(210, max_output_size)
+
+    def test_comparator(self):
+        """A checker may accept outputs larger than the correct one."""
+        get_limit, max_output_size = self.evaluate("comparator")
+        self.assertFalse(get_limit.called)
+        self.assertIsNone(max_output_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
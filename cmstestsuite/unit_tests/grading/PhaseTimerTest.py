@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the measurement of the phases of the jobs."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from mock import Mock, patch
+
+from cms.grading.phasetimer import PhaseTimer, timed_phase
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        patcher = patch("cms.grading.phasetimer.monotonic_time",
+                        side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.timer = PhaseTimer()
+
+    def test_phase(self):
+        with self.timer.phase(PhaseTimer.EXECUTION):
+            self.now += 2.0
+        with self.timer.phase(PhaseTimer.EXECUTION):
+            self.now += 1.0
+        self.now += 5.0
+        self.assertEqual({PhaseTimer.EXECUTION: 3.0}, self.timer.times)
+        self.assertEqual({PhaseTimer.EXECUTION: 2}, self.timer.counts)
+
+    def test_nested(self):
+        """Time is attributed to the innermost phase only."""
+        with self.timer.phase(PhaseTimer.CHECKING):
+            self.now += 1.0
+            with self.timer.phase(PhaseTimer.FILE_FETCH_MISS):
+                self.now += 4.0
+            self.now += 2.0
+        self.assertEqual({PhaseTimer.CHECKING: 3.0,
+                          PhaseTimer.FILE_FETCH_MISS: 4.0},
+                         self.timer.times)
+
+    def test_exception(self):
+        with self.assertRaises(ValueError):
+            with self.timer.phase(PhaseTimer.EXECUTION):
+                self.now += 1.0
+                raise ValueError()
+        self.now += 1.0
+        self.assertEqual({PhaseTimer.EXECUTION: 1.0}, self.timer.times)
+
+    def test_reset(self):
+        with self.timer.phase(PhaseTimer.EXECUTION):
+            self.now += 1.0
+        self.timer.reset()
+        self.assertEqual({}, self.timer.times)
+        self.assertEqual({}, self.timer.counts)
+
+    def test_timed_phase(self):
+        """Phases are measured by the timer of the service, if any."""
+        file_cacher = Mock()
+        file_cacher.service.phase_timer = self.timer
+        with timed_phase(file_cacher, PhaseTimer.COMPILATION):
+            self.now += 1.0
+        self.assertEqual({PhaseTimer.COMPILATION: 1.0}, self.timer.times)
+
+        file_cacher.service = None
+        with timed_phase(file_cacher, PhaseTimer.COMPILATION):
+            self.now += 1.0
+        with timed_phase(None, PhaseTimer.COMPILATION):
+            self.now += 1.0
+        self.assertEqual({PhaseTimer.COMPILATION: 1.0}, self.timer.times)
+
+
+if __name__ == "__main__":
+    unittest.main()
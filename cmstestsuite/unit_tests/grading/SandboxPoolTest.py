@@ -0,0 +1,168 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the pool of sandboxes and for the sandbox sessions."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+import gevent
+from mock import Mock, patch
+
+from cms.grading.Sandbox import SandboxInterfaceException
+from cms.grading.sandboxpool import SandboxPool, SandboxSession
+
+
+class TestSandboxPool(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch("cms.grading.sandboxpool.Sandbox",
+                        side_effect=lambda *args: Mock(pool=None))
+        self.sandbox_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = SandboxPool(Mock(), 2)
+
+    def test_get_empty(self):
+        """The first request finds no sandbox, but fills the pool."""
+        self.assertIsNone(self.pool.get(False))
+        gevent.sleep(0)
+        self.assertEqual(2, len(self.pool))
+        self.assertEqual(2, self.sandbox_class.call_count)
+
+    def test_get_and_put(self):
+        """Sandboxes given back are reset and used again."""
+        self.pool.fill()
+        gevent.sleep(0)
+        sandbox = self.pool.get(True)
+        sandbox.set_multithreaded.assert_called_once_with(True)
+        self.assertIs(self.pool, sandbox.pool)
+        gevent.sleep(0)
+        # The sandbox in use still counts.
+        self.assertEqual(1, len(self.pool))
+
+        self.pool.put(sandbox)
+        gevent.sleep(0)
+        sandbox.reset.assert_called_once_with()
+        sandbox.delete.assert_not_called()
+        self.assertIn(sandbox, self.pool._ready)
+        self.assertEqual(2, self.sandbox_class.call_count)
+
+    def test_discard(self):
+        """Sandboxes kept by the jobs are replaced."""
+        self.pool.fill()
+        gevent.sleep(0)
+        sandbox = self.pool.get(False)
+        self.pool.discard(sandbox)
+        gevent.sleep(0)
+        self.assertIsNone(sandbox.pool)
+        self.assertEqual(2, len(self.pool))
+        self.assertEqual(3, self.sandbox_class.call_count)
+
+    def test_put_when_full(self):
+        """Sandboxes exceeding the size of the pool are deleted."""
+        self.pool.fill()
+        gevent.sleep(0)
+        sandbox = self.pool.get(False)
+        self.pool.size = 1
+        self.pool.put(sandbox)
+        gevent.sleep(0)
+        sandbox.reset.assert_not_called()
+        sandbox.delete.assert_called_once_with()
+
+    def test_reset_failure(self):
+        """Sandboxes that cannot be reset are deleted."""
+        self.pool.fill()
+        gevent.sleep(0)
+        sandbox = self.pool.get(False)
+        sandbox.reset.side_effect = SandboxInterfaceException()
+        self.pool.put(sandbox)
+        gevent.sleep(0)
+        sandbox.delete.assert_called_once_with()
+        self.assertNotIn(sandbox, self.pool._ready)
+
+    def test_clear(self):
+        self.pool.fill()
+        gevent.sleep(0)
+        sandboxes = list(self.pool._ready)
+        self.pool.clear()
+        self.assertEqual(0, len(self.pool))
+        for sandbox in sandboxes:
+            sandbox.delete.assert_called_once_with()
+
+
+class TestSandboxSession(unittest.TestCase):
+
+    def setUp(self):
+        self.session = SandboxSession(2)
+
+    def test_get_and_put(self):
+        """Sandboxes given back are reset and used again by the same key."""
+        sandbox = Mock(pool=None)
+        self.session.put("a", sandbox, ["exe"])
+        sandbox.reset.assert_called_once_with(["exe"])
+        self.assertIsNone(self.session.get("b", False))
+        self.assertIs(sandbox, self.session.get("a", True))
+        sandbox.set_multithreaded.assert_called_once_with(True)
+        self.assertIsNone(self.session.get("a", False))
+
+    def test_put_same_key(self):
+        """Only one sandbox is kept for each key."""
+        sandbox1 = Mock(pool=None)
+        sandbox2 = Mock(pool=None)
+        self.session.put("a", sandbox1, [])
+        self.session.put("a", sandbox2, [])
+        sandbox1.delete.assert_called_once_with()
+        self.assertEqual(1, len(self.session))
+
+    def test_put_when_full(self):
+        """The oldest sandbox is given back to its pool."""
+        sandboxes = [Mock(pool=None), Mock(), Mock(pool=None)]
+        pool = sandboxes[1].pool
+        for key, sandbox in enumerate(sandboxes):
+            self.session.put(key, sandbox, [])
+        sandboxes[0].delete.assert_called_once_with()
+        pool.put.assert_not_called()
+
+        self.session.put(3, Mock(pool=None), [])
+        pool.put.assert_called_once_with(sandboxes[1])
+        self.assertEqual(2, len(self.session))
+
+    def test_reset_failure(self):
+        """Sandboxes that cannot be reset are not kept."""
+        sandbox = Mock(pool=None)
+        sandbox.reset.side_effect = SandboxInterfaceException()
+        self.session.put("a", sandbox, [])
+        sandbox.delete.assert_called_once_with()
+        self.assertIsNone(self.session.get("a", False))
+
+    def test_close(self):
+        sandboxes = [Mock(pool=None), Mock(pool=None)]
+        for key, sandbox in enumerate(sandboxes):
+            self.session.put(key, sandbox, [])
+        self.session.close()
+        self.assertEqual(0, len(self.session))
+        for sandbox in sandboxes:
+            sandbox.delete.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -26,8 +26,17 @@ from __future__ import unicode_literals
 
 import unittest
 import io
+import os
+import shutil
+import stat
+import tempfile
 
-from cms.grading.Sandbox import Truncator
+from mock import Mock, patch
+
+from cms import config
+from cms.db.filecacher import FileCacher
+from cms.grading.Sandbox import IsolateSandbox, SandboxInterfaceException, \
+    Truncator, clone_file
 
 
 class TestTruncator(unittest.TestCase):
@@ -67,5 +76,116 @@ class TestTruncator(unittest.TestCase):
         self.perform_truncator_test(100, 40, 7)
 
 
+class TestCreateFileFromStorage(unittest.TestCase):
+    """Test the placement of files of the cache in the sandbox."""
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.file_cacher = FileCacher(
+            path=os.path.join(self.base_dir, "storage"))
+        self.digest = self.file_cacher.put_file_content(b"content")
+        self.link_files = config.sandbox_link_files
+        config.sandbox_link_files = True
+
+    def tearDown(self):
+        config.sandbox_link_files = self.link_files
+        self.file_cacher.destroy_cache()
+        shutil.rmtree(self.base_dir)
+
+    def get_isolate_sandbox(self):
+        """Return an IsolateSandbox not needing isolate."""
+        sandbox = IsolateSandbox.__new__(IsolateSandbox)
+        sandbox.file_cacher = self.file_cacher
+        sandbox.path = os.path.join(self.base_dir, "box")
+        sandbox.linked_files = set()
+        os.mkdir(sandbox.path)
+        return sandbox
+
+    def test_cache_read_only(self):
+        path = self.file_cacher.get_file_cache_path(self.digest)
+        self.assertEqual(FileCacher.CACHE_FILE_MODE,
+                         stat.S_IMODE(os.stat(path).st_mode))
+
+    def test_clone(self):
+        """Cloning either succeeds or leaves the file empty."""
+        cache_path = self.file_cacher.get_file_cache_path(self.digest)
+        clone_path = os.path.join(self.base_dir, "clone")
+        with io.open(clone_path, "wb") as clone:
+            cloned = clone_file(cache_path, clone)
+        with io.open(clone_path, "rb") as clone:
+            self.assertEqual(b"content" if cloned else b"", clone.read())
+
+    def test_link(self):
+        sandbox = self.get_isolate_sandbox()
+        sandbox.create_file_from_storage("a.txt", self.digest)
+        self.assertEqual(b"content", sandbox.get_file_to_string("a.txt"))
+        self.assertEqual(2, os.stat(sandbox.relative_path("a.txt")).st_nlink)
+
+        # Permissions of links are never changed...
+        sandbox.allow_writing_none()
+        cache_path = self.file_cacher.get_file_cache_path(self.digest)
+        self.assertEqual(FileCacher.CACHE_FILE_MODE,
+                         stat.S_IMODE(os.stat(cache_path).st_mode))
+        # ...and writable files are copied.
+        sandbox.allow_writing_only(["a.txt"])
+        self.assertEqual(1, os.stat(sandbox.relative_path("a.txt")).st_nlink)
+        self.assertEqual(b"content", sandbox.get_file_to_string("a.txt"))
+        self.assertEqual(FileCacher.CACHE_FILE_MODE,
+                         stat.S_IMODE(os.stat(cache_path).st_mode))
+
+    def test_reset(self):
+        """Resetting removes the links without copying or making the
+        files of the cache writable.
+
+        """
+        sandbox = self.get_isolate_sandbox()
+        sandbox.create_file_from_storage("a.txt", self.digest)
+        sandbox.create_file_from_storage("b.txt", self.digest)
+        sandbox.allow_writing_only(["b.txt"])
+        sandbox.allow_writing_none()
+        with patch.object(sandbox, "unlink_file") as unlink_file, \
+                patch.object(sandbox, "_cleanup_box"), \
+                patch.object(sandbox, "_init_box"), \
+                patch.object(sandbox, "set_multithreaded"), \
+                patch.object(sandbox, "_set_default_options"):
+            sandbox.reset()
+        self.assertFalse(unlink_file.called)
+        self.assertEqual([], os.listdir(sandbox.path))
+        self.assertEqual(set(), sandbox.linked_files)
+        cache_path = self.file_cacher.get_file_cache_path(self.digest)
+        self.assertEqual(1, os.stat(cache_path).st_nlink)
+        self.assertEqual(FileCacher.CACHE_FILE_MODE,
+                         stat.S_IMODE(os.stat(cache_path).st_mode))
+
+    def test_no_link_executable(self):
+        sandbox = self.get_isolate_sandbox()
+        sandbox.create_file_from_storage("a", self.digest, executable=True)
+        self.assertEqual(1, os.stat(sandbox.relative_path("a")).st_nlink)
+        self.assertTrue(os.access(sandbox.relative_path("a"), os.X_OK))
+
+    def test_disabled(self):
+        config.sandbox_link_files = False
+        sandbox = self.get_isolate_sandbox()
+        sandbox.create_file_from_storage("a.txt", self.digest)
+        self.assertEqual(1, os.stat(sandbox.relative_path("a.txt")).st_nlink)
+
+
+class TestIsolateBoxIds(unittest.TestCase):
+    """Test the choice of the box ids of isolate."""
+
+    def test_all_in_use(self):
+        """A box id in use is never reused."""
+        file_cacher = Mock()
+        file_cacher.service = Mock(shard=1, slot=0, cpus=None)
+        with patch.object(config, "worker_slots", 2), \
+                patch.object(IsolateSandbox, "box_ids_in_use",
+                             set(xrange(30, 40))):
+            with self.assertRaises(SandboxInterfaceException):
+                IsolateSandbox(False, file_cacher)
+
+    def test_needed_box_ids(self):
+        with patch.object(config, "worker_slots", 4):
+            self.assertEqual(130, IsolateSandbox.get_needed_box_ids(3))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the testcases that score types deem irrelevant."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from cms.grading import is_evaluation_skipped, skipped_evaluation_text
+from cms.grading.scoretypes.GroupMin import GroupMin
+from cms.grading.scoretypes.GroupThreshold import GroupThreshold
+from cms.grading.scoretypes.Sum import Sum
+
+
+def public_testcases(codenames):
+    return dict((codename, True) for codename in codenames)
+
+
+class TestIrrelevantTestcases(unittest.TestCase):
+
+    def test_group_min(self):
+        score_type = GroupMin([[0, 1], [40, 2], [60, 2]],
+                              public_testcases(["0", "1", "2", "3", "4"]))
+        self.assertEqual(set(), score_type.get_irrelevant_testcases({}))
+        self.assertEqual(set(), score_type.get_irrelevant_testcases(
+            {"1": 0.5, "3": 1.0}))
+        self.assertEqual(set(["1", "2"]), score_type.get_irrelevant_testcases(
+            {"1": 0.0}))
+
+    def test_group_min_zero_subtask(self):
+        """Subtasks worth nothing are always evaluated."""
+        score_type = GroupMin([[0, 2], [100, 1]],
+                              public_testcases(["0", "1", "2"]))
+        self.assertEqual(set(), score_type.get_irrelevant_testcases(
+            {"0": 0.0}))
+
+    def test_group_min_overlapping(self):
+        """Testcases in more subtasks are skipped only if all fail."""
+        score_type = GroupMin([[50, "a|b"], [50, "b|c"]],
+                              public_testcases(["a", "b", "c"]))
+        self.assertEqual(set(["a"]), score_type.get_irrelevant_testcases(
+            {"a": 0.0}))
+        self.assertEqual(set(["a", "b", "c"]),
+                         score_type.get_irrelevant_testcases({"b": 0.0}))
+
+    def test_group_threshold(self):
+        score_type = GroupThreshold([[50, 2, 2.0], [50, 2, 2.0]],
+                                    public_testcases(["0", "1", "2", "3"]))
+        self.assertEqual(set(), score_type.get_irrelevant_testcases(
+            {"0": 1.5, "2": 2.0}))
+        self.assertEqual(set(["0", "1"]), score_type.get_irrelevant_testcases(
+            {"0": 3.0}))
+        self.assertEqual(set(["2", "3"]), score_type.get_irrelevant_testcases(
+            {"3": 0.0}))
+
+    def test_sum(self):
+        score_type = Sum(10, public_testcases(["0", "1"]))
+        self.assertEqual(set(), score_type.get_irrelevant_testcases(
+            {"0": 0.0}))
+
+    def test_skipped_text(self):
+        self.assertTrue(is_evaluation_skipped(skipped_evaluation_text()))
+        self.assertFalse(is_evaluation_skipped('["Output is correct"]'))
+        self.assertFalse(is_evaluation_skipped(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
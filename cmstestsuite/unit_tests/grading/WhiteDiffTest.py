@@ -0,0 +1,106 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the white diff comparator."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import random
+import unittest
+
+from mock import patch
+
+from cms.grading import WHITES, white_diff, white_diff_canonicalize
+
+
+def line_by_line_white_diff(output, res):
+    """The white diff as it was implemented before, line by line."""
+    while True:
+        lout = output.readline()
+        lres = res.readline()
+        if lres == b'' and lout == b'':
+            return True
+        elif lres == b'' or lout == b'':
+            if lout.strip(WHITES) != b'' or lres.strip(WHITES) != b'':
+                return False
+        elif white_diff_canonicalize(lout) != white_diff_canonicalize(lres):
+            return False
+
+
+class TestWhiteDiff(unittest.TestCase):
+
+    def assertWhiteDiff(self, expected, output, res):
+        for chunk_size in [1, 2, 3, 7, 2 ** 20]:
+            with patch("cms.grading.WHITE_DIFF_CHUNK_SIZE", chunk_size):
+                self.assertEqual(
+                    expected,
+                    white_diff(io.BytesIO(output), io.BytesIO(res)),
+                    "%r vs %r, chunks of %d" % (output, res, chunk_size))
+                self.assertEqual(
+                    expected,
+                    white_diff(io.BytesIO(res), io.BytesIO(output)),
+                    "%r vs %r, chunks of %d" % (res, output, chunk_size))
+
+    def test_equal(self):
+        self.assertWhiteDiff(True, b"", b"")
+        self.assertWhiteDiff(True, b"1 2\n3\n", b"1 2\n3\n")
+
+    def test_whitespaces(self):
+        self.assertWhiteDiff(True, b"1 2\n3\n", b"  1\t\t2 \r\n3")
+        self.assertWhiteDiff(True, b"1\x0b2\x0c", b"1 2")
+        self.assertWhiteDiff(True, b"1\r2", b"1 2")
+        self.assertWhiteDiff(False, b"12", b"1 2")
+
+    def test_empty_lines(self):
+        """Only trailing empty lines are ignored."""
+        self.assertWhiteDiff(True, b"1\n\n \n\t\n", b"1")
+        self.assertWhiteDiff(True, b"\n\n", b"")
+        self.assertWhiteDiff(False, b"\n1", b"1")
+        self.assertWhiteDiff(False, b"1\n\n2", b"1\n2")
+        self.assertWhiteDiff(False, b"1\n2\n", b"1\n2\n\n3\n")
+
+    def test_difference_after_equal_prefix(self):
+        self.assertWhiteDiff(True, b"1 2\n3 4\n5  6\n", b"1 2\n3 4\n5 6")
+        self.assertWhiteDiff(False, b"1 2\n3 4\n5 6\n", b"1 2\n3 4\n5 7\n")
+        self.assertWhiteDiff(False, b"1 2\n3 4", b"1 2\n3 45")
+
+    def test_random(self):
+        """The results are those of the line by line comparison."""
+        rng = random.Random(0)
+        alphabet = [b"a", b"b", b" ", b"\t", b"\n", b"\r", b"\x0b"]
+        for _ in xrange(2000):
+            output = b"".join(rng.choice(alphabet)
+                              for _ in xrange(rng.randint(0, 12)))
+            # Similar outputs are more likely to be equal.
+            res = bytearray(output)
+            for _ in xrange(rng.randint(0, 3)):
+                position = rng.randint(0, len(res))
+                res[position:position + rng.randint(0, 1)] = \
+                    rng.choice(alphabet)
+            res = bytes(res)
+            self.assertWhiteDiff(
+                line_by_line_white_diff(io.BytesIO(output), io.BytesIO(res)),
+                output, res)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -180,6 +180,72 @@ class TestPriorityQueue(unittest.TestCase):
         self.assertFalse(self.item_b in self.queue)
         self.queue._verify()
 
+    def test_remove_top(self):
+        """Test that removing the top item exposes the next one."""
+        self.queue.push(self.item_a, PriorityQueue.PRIORITY_HIGH)
+        self.queue.push(self.item_b, PriorityQueue.PRIORITY_LOW)
+        self.queue.remove(self.item_a)
+        self.assertTrue(self.queue._verify())
+        self.assertEqual(self.queue.top().item, self.item_b)
+        self.queue.remove(self.item_b)
+        self.assertTrue(self.queue._verify())
+        self.assertTrue(self.queue.empty())
+        with self.assertRaises(KeyError):
+            self.queue.remove(self.item_b)
+
+    def test_set_priority_lower(self):
+        """Test that lowering the priority of the top moves it down."""
+        self.queue.push(self.item_a, PriorityQueue.PRIORITY_HIGH)
+        self.queue.push(self.item_b, PriorityQueue.PRIORITY_MEDIUM)
+        self.queue.set_priority(self.item_a, PriorityQueue.PRIORITY_LOW)
+        self.assertTrue(self.queue._verify())
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(self.queue.pop().item, self.item_b)
+        top = self.queue.pop()
+        self.assertEqual(top.item, self.item_a)
+        self.assertEqual(top.priority, PriorityQueue.PRIORITY_LOW)
+        self.assertTrue(self.queue.empty())
+
+    def test_push_many(self):
+        """Test pushing several items together."""
+        self.queue.push(self.item_a, PriorityQueue.PRIORITY_LOW)
+        pushed = self.queue.push_many([
+            (self.item_a, PriorityQueue.PRIORITY_HIGH, None),
+            (self.item_b, PriorityQueue.PRIORITY_MEDIUM, make_datetime(10)),
+            (self.item_c, PriorityQueue.PRIORITY_MEDIUM, make_datetime(5)),
+        ])
+        self.assertEqual(pushed, 2)
+        self.assertTrue(self.queue._verify())
+        self.assertEqual(
+            [self.item_c, self.item_b, self.item_a],
+            [entry.item for entry in self.queue.pop_many(5)])
+        self.assertTrue(self.queue._verify())
+
+    def test_pop_many(self):
+        """Test popping several items together."""
+        self.assertEqual(self.queue.pop_many(2), [])
+        for item in [self.item_a, self.item_b, self.item_c]:
+            self.queue.push(item)
+        entries = self.queue.pop_many(2)
+        self.assertEqual([self.item_a, self.item_b],
+                         [entry.item for entry in entries])
+        self.assertTrue(self.queue._verify())
+        self.assertEqual(len(self.queue), 1)
+
+    def test_many_removals(self):
+        """Test that the heap stays consistent with many stale entries."""
+        items = [FakeQueueItem("%d" % i) for i in xrange(100)]
+        for i, item in enumerate(items):
+            self.queue.push(item, timestamp=make_datetime(i))
+        for item in items[:90]:
+            self.queue.remove(item)
+        for item in items[90:95]:
+            self.queue.set_priority(item, PriorityQueue.PRIORITY_LOW)
+        self.assertTrue(self.queue._verify())
+        self.assertEqual(
+            items[95:] + items[90:95],
+            [entry.item for entry in self.queue.pop_many(100)])
+
 
 if __name__ == "__main__":
     unittest.main()
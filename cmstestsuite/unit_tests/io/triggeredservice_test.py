@@ -74,6 +74,11 @@ class FakeBatchExecutor(FakeExecutor):
         super(FakeBatchExecutor, self).execute(operations[0])
 
 
+class FakeSmallBatchExecutor(FakeBatchExecutor):
+    def batch_is_full(self, entries):
+        return len(entries) >= 2
+
+
 class FakeTriggeredService(TriggeredService):
     def __init__(self, shard, timeout):
         super(FakeTriggeredService, self).__init__(shard)
@@ -176,6 +181,17 @@ class TestTriggeredService(unittest.TestCase):
         # Just one call to the batch executor.
         self.assertEqual(batch_notifier.get_notifications(), 1)
 
+    def test_batch_full(self):
+        """Test a batch executor limiting the content of batches."""
+        self.setUpService()
+        batch_notifier = Notifier()
+        self.service.add_executor(FakeSmallBatchExecutor(batch_notifier))
+        for i in xrange(3):
+            self.service.enqueue(FakeQueueItem('op %d' % i))
+        gevent.sleep(0.01)
+        # Two batches, the first with two operations.
+        self.assertEqual(batch_notifier.get_notifications(), 2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -28,14 +28,16 @@ from __future__ import unicode_literals
 
 import gevent
 import unittest
-from mock import Mock, call
+from mock import Mock, call, patch
 
 from cmstestsuite.unit_tests.testidgenerator import \
     unique_long_id, unique_unicode_id
 
 import cms.service.Worker
+from cms import ConfigError, config
 from cms.grading import JobException
 from cms.grading.Job import JobGroup, EvaluationJob
+from cms.grading.phasetimer import PhaseTimer, timed_phase
 from cms.service.Worker import Worker
 from cms.service.esoperations import ESOperation
 
@@ -254,6 +256,145 @@ class TestWorker(unittest.TestCase):
             JobGroup.import_from_dict(
                 self.service.execute_job_group(job_groups[0].export_to_dict()))
 
+    def test_execute_job_group_slots(self):
+        """Executes two job groups concurrently in different slots.
+
+        """
+        worker_slots = config.worker_slots
+        config.worker_slots = 2
+        try:
+            self.service = Worker(0)
+        finally:
+            config.worker_slots = worker_slots
+        task_type = FakeTaskType([0.01, 0.01])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        job_groups, calls = TestWorker.new_job_groups([1, 1])
+        greenlets = [
+            gevent.spawn(self.service.execute_job_group,
+                         job_group.export_to_dict(), slot)
+            for slot, job_group in enumerate(job_groups)]
+        gevent.sleep(0)
+        self.assertEqual([True, True], [
+            status["busy"] for status in self.service.slots_status()])
+
+        for greenlet in greenlets:
+            ret_job_group = JobGroup.import_from_dict(greenlet.get())
+            self.assertTrue(ret_job_group.jobs[0].success)
+        self.assertEqual([False, False], [
+            status["busy"] for status in self.service.slots_status()])
+        cms.service.Worker.get_task_type.assert_has_calls(
+            calls, any_order=True)
+
+    def test_execute_job_group_pipelined(self):
+        """Executes two job groups in the same slot, one after the
+        other, and declines a third one.
+
+        """
+        pipeline_depth = config.worker_pipeline_depth
+        config.worker_pipeline_depth = 2
+        self.addCleanup(setattr, config, "worker_pipeline_depth",
+                        pipeline_depth)
+        task_type = FakeTaskType([0.01, 0.01])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        job_groups, calls = TestWorker.new_job_groups([1, 1, 1])
+        greenlets = [
+            gevent.spawn(self.service.execute_job_group,
+                         job_group.export_to_dict())
+            for job_group in job_groups[:2]]
+        gevent.sleep(0)
+        self.assertEqual(2, self.service.slots_status()[0]["queued"])
+
+        with self.assertRaises(JobException):
+            self.service.execute_job_group(job_groups[2].export_to_dict())
+
+        for greenlet in greenlets:
+            ret_job_group = JobGroup.import_from_dict(greenlet.get())
+            self.assertTrue(ret_job_group.jobs[0].success)
+        self.assertEqual(0, self.service.slots_status()[0]["queued"])
+        cms.service.Worker.get_task_type.assert_has_calls(calls[:2])
+        self.assertEquals(task_type.call_count, 2)
+
+    def test_execute_job_group_invalid_slot(self):
+        """Executes a job group in a slot that does not exist.
+
+        """
+        jobs, unused_calls = TestWorker.new_jobs(1)
+        task_type = FakeTaskType([True])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        with self.assertRaises(JobException):
+            self.service.execute_job_group(
+                JobGroup(jobs).export_to_dict(), slot=len(self.service.slots))
+        self.assertEquals(task_type.call_count, 0)
+
+    # Testing get_job_stats.
+
+    def test_job_stats(self):
+        """The time spent in the phases is returned with the jobs, and
+        aggregated by the Worker.
+
+        """
+        job_groups, unused_calls = TestWorker.new_job_groups([2])
+        task_type = FakeTaskType([0.01, True])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        ret_job_group = JobGroup.import_from_dict(
+            self.service.execute_job_group(job_groups[0].export_to_dict()))
+
+        timings = [job.timings for job in ret_job_group.jobs]
+        self.assertGreater(timings[0][PhaseTimer.EXECUTION], 0.0)
+        self.assertEqual({}, timings[1])
+
+        stats = self.service.get_job_stats()
+        self.assertEqual(2, stats["jobs"])
+        self.assertGreaterEqual(stats["time"],
+                                timings[0][PhaseTimer.EXECUTION])
+        self.assertEqual(1, stats["phases"][PhaseTimer.EXECUTION]["count"])
+        self.assertEqual(0, stats["phases"][PhaseTimer.CHECKING]["count"])
+
+    def test_prefetch_stats(self):
+        """The files downloaded while prefetching count as misses in
+        the statistics, but not in the timings of the jobs.
+
+        """
+        jobs, unused_calls = TestWorker.new_jobs(1)
+        jobs[0].input = "input"
+        jobs[0].output = "output"
+        slot = self.service.slots[0]
+        slot.file_cacher = Mock()
+        slot.file_cacher.is_cached.side_effect = \
+            lambda digest: digest == "output"
+        slot.file_cacher.load.side_effect = \
+            lambda digest, if_needed: gevent.sleep(0.01)
+
+        Worker._prefetch_files(JobGroup(jobs), slot)
+
+        slot.file_cacher.load.assert_called_once_with("input",
+                                                      if_needed=True)
+        stats = slot.get_job_stats()
+        miss_stats = stats["phases"][PhaseTimer.FILE_FETCH_MISS]
+        self.assertEqual(1, miss_stats["count"])
+        self.assertGreater(miss_stats["time"], 0.0)
+        self.assertEqual({}, slot.phase_timer.times)
+
+    def test_box_ids(self):
+        """A Worker does not start if isolate has not enough boxes
+        for the slots of all Workers.
+
+        """
+        with patch.object(config, "sandbox_implementation", "isolate"), \
+                patch.object(config, "worker_slots", 4), \
+                patch.object(config, "isolate_num_boxes", 100), \
+                patch("cms.service.Worker.get_service_shards",
+                      return_value=2):
+            Worker(1)
+            with self.assertRaises(ConfigError):
+                Worker(2)
+            config.isolate_num_boxes = 130
+            Worker(2)
+
     @staticmethod
     def new_jobs(number_of_jobs, prefix=None):
         prefix = prefix if prefix is not None else ""
@@ -305,9 +446,10 @@ class FakeTaskType(object):
             # Exception: raise.
             raise result
         else:
-            # Float: wait the number of seconds.
+            # Float: wait the number of seconds, as if executing.
             job.success = True
-            gevent.sleep(result)
+            with timed_phase(file_cacher, PhaseTimer.EXECUTION):
+                gevent.sleep(result)
 
     def set_results(self, results):
         self.execute_results = results
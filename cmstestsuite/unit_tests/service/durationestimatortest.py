@@ -0,0 +1,72 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the estimates of the duration of the operations."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from cms.service.durationestimator import DurationEstimator
+from cms.service.esoperations import ESOperation
+
+
+class TestDurationEstimator(unittest.TestCase):
+
+    def setUp(self):
+        self.estimator = DurationEstimator()
+
+    def test_default(self):
+        self.assertEqual(DurationEstimator.DEFAULT_DURATION,
+                         self.estimator.estimate(ESOperation.EVALUATION, 1))
+
+    def test_converges(self):
+        """Repeated measurements move the estimate towards them."""
+        operations = [ESOperation(ESOperation.EVALUATION, 1, 1, "%d" % i)
+                      for i in xrange(4)]
+        for _ in xrange(100):
+            self.estimator.add_measurement(operations, 20.0)
+        self.assertAlmostEqual(
+            5.0, self.estimator.estimate(ESOperation.EVALUATION, 1))
+        # Other kinds of operations are not affected.
+        self.assertEqual(DurationEstimator.DEFAULT_DURATION,
+                         self.estimator.estimate(ESOperation.EVALUATION, 2))
+        self.assertEqual(DurationEstimator.DEFAULT_DURATION,
+                         self.estimator.estimate(ESOperation.COMPILATION, 1))
+
+    def test_mixed_group(self):
+        """The duration of a group is split according to the estimates."""
+        compilation = ESOperation(ESOperation.COMPILATION, 1, 1)
+        evaluation = ESOperation(ESOperation.EVALUATION, 1, 1, "0")
+        for _ in xrange(100):
+            self.estimator.add_measurement([compilation], 3.0)
+        for _ in xrange(100):
+            self.estimator.add_measurement([compilation, evaluation], 4.0)
+        self.assertAlmostEqual(
+            3.0, self.estimator.estimate(ESOperation.COMPILATION, 1),
+            places=2)
+        self.assertAlmostEqual(
+            1.0, self.estimator.estimate(ESOperation.EVALUATION, 1),
+            places=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
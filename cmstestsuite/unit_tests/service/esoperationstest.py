@@ -30,9 +30,42 @@ import unittest
 
 from cmstestsuite.unit_tests.testdbgenerator import TestCaseWithDatabase
 
+from cms.db import Executable
+from cms.grading import skipped_evaluation_text
 from cms.io.priorityqueue import PriorityQueue
 from cms.service.esoperations import ESOperation, get_submissions_operations, \
-    get_user_tests_operations
+    get_user_tests_operations, submission_reuse_evaluations
+
+
+class TestESOperation(unittest.TestCase):
+
+    def test_equality(self):
+        operation = ESOperation(ESOperation.EVALUATION, 1, 2, "000")
+        same = ESOperation.from_dict(operation.to_dict())
+        self.assertEqual(operation, same)
+        self.assertFalse(operation != same)
+        self.assertEqual(hash(operation), hash(same))
+        self.assertNotEqual(
+            operation, ESOperation(ESOperation.EVALUATION, 1, 2, "001"))
+        self.assertNotEqual(
+            operation, ESOperation(ESOperation.COMPILATION, 1, 2))
+        self.assertNotEqual(operation, None)
+
+    def test_compact(self):
+        """Operations have no __dict__ and share their strings."""
+        first = ESOperation("evaluate", 1, 2, "000")
+        second = ESOperation.from_dict(
+            {"type": "evaluate", "object_id": 3, "dataset_id": 2,
+             "testcase_codename": "".join(["00", "0"])})
+        self.assertFalse(hasattr(first, "__dict__"))
+        self.assertIs(first.type_, second.type_)
+        self.assertIs(first.testcase_codename, second.testcase_codename)
+
+    def test_side_data(self):
+        operation = ESOperation(ESOperation.COMPILATION, 1, 2)
+        self.assertIsNone(operation.side_data)
+        operation.side_data = (1, 2)
+        self.assertEqual(operation, ESOperation(ESOperation.COMPILATION, 1, 2))
 
 
 class TestESOperations(TestCaseWithDatabase):
@@ -265,6 +298,55 @@ class TestESOperations(TestCaseWithDatabase):
 
     # Testing get_user_tests_operations.
 
+    def test_get_submissions_operations_restricted(self):
+        """Test for the operations of only some submissions."""
+        submissions = [self.add_submission(self.tasks[0], self.participation)
+                       for _ in xrange(3)]
+        self.session.flush()
+
+        expected_operations = [set(
+            self.submission_compilation_operation(submission, dataset)
+            for dataset in submission.task.datasets if self.to_judge(dataset))
+            for submission in submissions]
+
+        self.assertEqual(
+            set(get_submissions_operations(
+                self.session, self.contest.id, min_id=submissions[1].id)),
+            expected_operations[2])
+        self.assertEqual(
+            set(get_submissions_operations(
+                self.session, self.contest.id, ids={submissions[0].id})),
+            expected_operations[0])
+        self.assertEqual(
+            set(get_submissions_operations(
+                self.session, self.contest.id, min_id=submissions[1].id,
+                ids={submissions[0].id})),
+            expected_operations[0] | expected_operations[2])
+        self.assertEqual(
+            set(get_submissions_operations(
+                self.session, self.contest.id, min_id=submissions[2].id,
+                ids=set())),
+            set())
+
+    def test_get_submissions_operations_es_shard(self):
+        """Test for the operations of the submissions of a shard of ES."""
+        submissions = [self.add_submission(self.tasks[0], self.participation)
+                       for _ in xrange(4)]
+        self.session.flush()
+
+        for es_shard in xrange(2):
+            expected_operations = set(
+                self.submission_compilation_operation(submission, dataset)
+                for submission in submissions
+                if submission.id % 2 == es_shard
+                for dataset in submission.task.datasets
+                if self.to_judge(dataset))
+            self.assertEqual(
+                set(get_submissions_operations(
+                    self.session, self.contest.id,
+                    es_shard=es_shard, es_shards=2)),
+                expected_operations)
+
     def test_get_user_tests_operations_no_operations(self):
         """Test for user_tests without operations to do."""
         # A user_test for a different contest.
@@ -398,6 +480,26 @@ class TestESOperations(TestCaseWithDatabase):
             set(get_user_tests_operations(self.session, self.contest.id)),
             expected_operations)
 
+    def test_get_user_tests_operations_restricted(self):
+        """Test for the operations of only some user tests."""
+        user_tests = [self.add_user_test(self.tasks[0], self.participation)
+                      for _ in xrange(2)]
+        self.session.flush()
+
+        expected_operations = [set(
+            self.user_test_compilation_operation(user_test, dataset)
+            for dataset in user_test.task.datasets if self.to_judge(dataset))
+            for user_test in user_tests]
+
+        self.assertEqual(
+            set(get_user_tests_operations(
+                self.session, self.contest.id, min_id=user_tests[0].id)),
+            expected_operations[1])
+        self.assertEqual(
+            set(get_user_tests_operations(
+                self.session, self.contest.id, ids={user_tests[0].id})),
+            expected_operations[0])
+
     def user_test_compilation_operation(self, user_test, dataset, result=None):
         active_priority = PriorityQueue.PRIORITY_HIGH \
             if result is None or result.compilation_tries == 0 \
@@ -424,5 +526,90 @@ class TestESOperations(TestCaseWithDatabase):
             or dataset.task.active_dataset_id == dataset.id)
 
 
+class TestSubmissionReuseEvaluations(TestCaseWithDatabase):
+
+    def setUp(self):
+        super(TestSubmissionReuseEvaluations, self).setUp()
+
+        self.contest = self.add_contest()
+        self.participation = self.add_participation(contest=self.contest)
+        self.task = self.add_task(self.contest)
+        # A dataset and its clone, with a testcase changed.
+        self.datasets = [
+            self.add_dataset(self.task, time_limit=1.0, memory_limit=256),
+            self.add_dataset(self.task, time_limit=1.0, memory_limit=256),
+        ]
+        self.task.active_dataset = self.datasets[0]
+        self.testcases = [
+            self.add_testcase(self.datasets[0], codename="0",
+                              input="i0", output="o0"),
+            self.add_testcase(self.datasets[0], codename="1",
+                              input="i1", output="o1"),
+            self.add_testcase(self.datasets[1], codename="0",
+                              input="i0", output="o0"),
+            self.add_testcase(self.datasets[1], codename="1",
+                              input="i1", output="o2"),
+        ]
+
+        self.submission, self.results = self.add_submission_with_results(
+            self.task, self.participation, True)
+        for result in self.results:
+            Executable(filename="exe", digest="digest",
+                       submission_result=result)
+        for testcase in self.testcases[:2]:
+            self.add_evaluation(self.results[0], testcase, outcome="1.0")
+        self.session.flush()
+
+    def tearDown(self):
+        self.session.close()
+        super(TestSubmissionReuseEvaluations, self).tearDown()
+
+    def test_reuse(self):
+        """Only the testcases with the same codename, input and output
+        are copied.
+
+        """
+        self.assertEqual(
+            [self.testcases[2].codename],
+            submission_reuse_evaluations(self.results[1]))
+        self.session.flush()
+        self.assertEqual(1, len(self.results[1].evaluations))
+        evaluation = self.results[1].evaluations[0]
+        self.assertIs(self.testcases[2], evaluation.testcase)
+        self.assertEqual("1.0", evaluation.outcome)
+
+        # Nothing else can be copied.
+        self.assertEqual([], submission_reuse_evaluations(self.results[1]))
+
+    def test_no_reuse_skipped(self):
+        """Evaluations skipped by the lazy evaluation are not copied."""
+        evaluation = self.results[0].evaluations[0]
+        self.assertIs(self.testcases[0], evaluation.testcase)
+        evaluation.outcome = "0.0"
+        evaluation.text = skipped_evaluation_text()
+        self.assertEqual([], submission_reuse_evaluations(self.results[1]))
+        self.assertEqual(0, len(self.results[1].evaluations))
+
+    def test_no_reuse_different_codename(self):
+        """OutputOnly evaluates a different file for each codename,
+        even if the input and output are the same.
+
+        """
+        for dataset in self.datasets:
+            dataset.task_type = "OutputOnly"
+            dataset.task_type_parameters = "[\"diff\"]"
+        self.testcases[2].codename = "2"
+        self.assertEqual([], submission_reuse_evaluations(self.results[1]))
+        self.assertEqual(0, len(self.results[1].evaluations))
+
+    def test_no_reuse_different_limits(self):
+        self.datasets[1].time_limit = 2.0
+        self.assertEqual([], submission_reuse_evaluations(self.results[1]))
+
+    def test_no_reuse_different_executables(self):
+        self.results[1].executables["exe"].digest = "other digest"
+        self.assertEqual([], submission_reuse_evaluations(self.results[1]))
+
+
 if __name__ == "__main__":
     unittest.main()
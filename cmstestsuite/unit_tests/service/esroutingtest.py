@@ -0,0 +1,88 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the partition of the work among the shards of ES."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+from mock import Mock, patch
+
+from cms.service.esrouting import EvaluationServiceRouter, get_es_shard, \
+    get_es_worker_shards, get_worker_es_shard
+
+
+class TestESRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.shards = {"EvaluationService": 3, "Worker": 7}
+        patcher = patch("cms.service.esrouting.get_service_shards",
+                        side_effect=lambda service: self.shards[service])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.service = Mock()
+        self.service.connect_to.side_effect = \
+            lambda coord, **kwargs: Mock(shard=coord.shard)
+        self.router = EvaluationServiceRouter(self.service)
+
+    def test_shards(self):
+        self.assertEqual(2, get_es_shard(5))
+        self.assertEqual(0, get_es_shard(6))
+        self.assertEqual(1, get_worker_es_shard(4))
+
+    def test_workers_partition(self):
+        """Each Worker is used by exactly one shard."""
+        worker_shards = [get_es_worker_shards(es_shard)
+                         for es_shard in xrange(3)]
+        self.assertEqual([0, 3, 6], worker_shards[0])
+        self.assertEqual(range(7), sorted(sum(worker_shards, [])))
+
+    def test_no_shards_configured(self):
+        """Without ES in the configuration, everything goes to shard 0."""
+        self.shards["EvaluationService"] = 0
+        self.assertEqual(0, get_es_shard(5))
+        self.assertEqual(range(7), get_es_worker_shards(0))
+
+    def test_router_new_submission(self):
+        self.router.new_submission(submission_id=4)
+        remote_services = self.router._remote_services
+        remote_services[1].new_submission.assert_called_once_with(
+            submission_id=4)
+        remote_services[0].new_submission.assert_not_called()
+        remote_services[2].new_submission.assert_not_called()
+
+    def test_router_invalidate(self):
+        """Invalidations go to one shard or to all of them."""
+        remote_services = self.router._remote_services
+        self.router.invalidate_submission(submission_id=5, level="evaluation")
+        remote_services[2].invalidate_submission.assert_called_once_with(
+            submission_id=5, level="evaluation", forward=False)
+        remote_services[0].invalidate_submission.assert_not_called()
+
+        self.router.invalidate_submission(task_id=1, level="evaluation")
+        for remote_service in remote_services:
+            remote_service.invalidate_submission.assert_called_with(
+                task_id=1, level="evaluation", forward=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the estimates of the failure rate of the testcases."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from cms.service.esoperations import ESOperation
+from cms.service.failureestimator import FailureEstimator
+from cmscommon.datetime import make_datetime
+
+
+class TestFailureEstimator(unittest.TestCase):
+
+    def setUp(self):
+        self.estimator = FailureEstimator()
+        self.operations = [ESOperation(ESOperation.EVALUATION, 1, 1, "%d" % i)
+                           for i in xrange(3)]
+
+    def test_default(self):
+        self.assertEqual(FailureEstimator.DEFAULT_RATE,
+                         self.estimator.estimate(1, "0"))
+
+    def test_converges(self):
+        """Repeated outcomes move the estimate towards them."""
+        for _ in xrange(100):
+            self.estimator.add_outcome(self.operations[0], "0.0")
+            self.estimator.add_outcome(self.operations[1], "1.0")
+        self.assertAlmostEqual(1.0, self.estimator.estimate(1, "0"), places=3)
+        self.assertAlmostEqual(0.0, self.estimator.estimate(1, "1"), places=3)
+        # Other datasets are not affected.
+        self.assertEqual(FailureEstimator.DEFAULT_RATE,
+                         self.estimator.estimate(2, "0"))
+
+    def test_sort_operations(self):
+        """Within a submission, the failing testcases come first."""
+        self.estimator.add_outcome(self.operations[2], "0.0")
+        self.estimator.add_outcome(self.operations[1], None)
+        self.estimator.add_outcome(self.operations[1], "0.0")
+        other = ESOperation(ESOperation.EVALUATION, 2, 1, "2")
+        early = make_datetime(0)
+        late = make_datetime(10)
+        operations = [(self.operations[0], 1, early),
+                      (other, 1, late),
+                      (self.operations[2], 1, early),
+                      (self.operations[1], 1, early)]
+        self.assertEqual(
+            [self.operations[1], self.operations[2], self.operations[0],
+             other],
+            [operation for operation, unused_priority, unused_timestamp
+             in self.estimator.sort_operations(operations)])
+
+
+if __name__ == "__main__":
+    unittest.main()
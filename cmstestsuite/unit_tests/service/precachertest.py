@@ -0,0 +1,156 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the precaching of the files of a contest."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+import gevent
+
+from mock import MagicMock, Mock, patch
+
+from cms import config
+from cms.service.precacher import Precacher
+
+
+class TestPrecacher(unittest.TestCase):
+
+    def setUp(self):
+        self.files = [("a", 10), ("b", 20), ("c", 30)]
+        patcher = patch("cms.service.precacher.get_precache_files",
+                        side_effect=lambda session, contest_id: self.files)
+        self.get_precache_files = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("cms.service.precacher.SessionGen", MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.loaded = []
+        self.file_cacher = Mock()
+        self.file_cacher.load.side_effect = \
+            lambda digest, if_needed: self.loaded.append(digest)
+
+    def test_order(self):
+        precacher = Precacher(self.file_cacher, 1)
+        precacher.start(1)
+        precacher.wait()
+        self.assertEqual(["a", "b", "c"], self.loaded)
+        status = precacher.get_status()
+        self.assertEqual(Precacher.DONE, status["state"])
+        self.assertEqual(1, status["contest_id"])
+        self.assertEqual((3, 3, 0), (status["files_total"],
+                                     status["files_done"],
+                                     status["files_missing"]))
+        self.assertEqual((60, 60), (status["bytes_total"],
+                                    status["bytes_done"]))
+
+    def test_missing(self):
+        def load(digest, if_needed):
+            if digest == "b":
+                raise KeyError()
+        self.file_cacher.load.side_effect = load
+        precacher = Precacher(self.file_cacher, 2)
+        precacher.start(1)
+        precacher.wait()
+        status = precacher.get_status()
+        self.assertEqual(Precacher.DONE, status["state"])
+        self.assertEqual((3, 1), (status["files_done"],
+                                  status["files_missing"]))
+
+    def test_concurrency(self):
+        """At most the given number of files is loaded at once."""
+        self.files = [(str(i), 1) for i in xrange(10)]
+        running = [0]
+        max_running = [0]
+
+        def load(digest, if_needed):
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+            gevent.sleep(0.01)
+            running[0] -= 1
+        self.file_cacher.load.side_effect = load
+        precacher = Precacher(self.file_cacher, 3)
+        precacher.start(1)
+        precacher.wait()
+        self.assertEqual(3, max_running[0])
+        self.assertEqual(10, precacher.get_status()["files_done"])
+
+    def test_delay(self):
+        precacher = Precacher(self.file_cacher, 1, delay=0.1)
+        precacher.start(1)
+        gevent.sleep(0.05)
+        self.assertEqual(Precacher.WAITING, precacher.get_status()["state"])
+        self.assertEqual([], self.loaded)
+        precacher.wait()
+        self.assertEqual(["a", "b", "c"], self.loaded)
+
+    def test_restart(self):
+        """Asking again for the same contest does nothing, asking for
+        another one stops the current precaching.
+
+        """
+        precacher = Precacher(self.file_cacher, 1, delay=0.1)
+        precacher.start(1)
+        precacher.start(1)
+        precacher.start(2)
+        precacher.wait()
+        self.assertEqual(2, precacher.get_status()["contest_id"])
+        self.assertEqual(1, self.get_precache_files.call_count)
+        self.assertEqual(2, self.get_precache_files.call_args[0][1])
+
+    def test_failure(self):
+        self.get_precache_files.side_effect = RuntimeError()
+        precacher = Precacher(self.file_cacher, 1)
+        precacher.start(1)
+        precacher.wait()
+        self.assertEqual(Precacher.FAILED, precacher.get_status()["state"])
+
+
+    def test_cache_size(self):
+        """Only the first files fitting in the cache are loaded."""
+        self.files = [("a", 2 * 2 ** 20), ("b", 2 * 2 ** 20),
+                      ("c", 1 * 2 ** 20), ("d", 1)]
+        precacher = Precacher(self.file_cacher, 1)
+        with patch.object(config, "file_cache_size", 4):
+            precacher.start(1)
+            precacher.wait()
+        self.assertEqual(["a", "b"], self.loaded)
+        status = precacher.get_status()
+        self.assertEqual(Precacher.DONE, status["state"])
+        self.assertEqual((2, 2, 2), (status["files_total"],
+                                     status["files_done"],
+                                     status["files_skipped"]))
+        self.assertEqual(4 * 2 ** 20, status["bytes_done"])
+
+    def test_no_cache_size(self):
+        self.files = [("a", 2 ** 30), ("b", 2 ** 30)]
+        precacher = Precacher(self.file_cacher, 1)
+        with patch.object(config, "file_cache_size", 0):
+            precacher.start(1)
+            precacher.wait()
+        self.assertEqual(["a", "b"], self.loaded)
+        self.assertEqual(0, precacher.get_status()["files_skipped"])
+
+
+if __name__ == "__main__":
+    unittest.main()
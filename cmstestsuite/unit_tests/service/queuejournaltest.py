@@ -0,0 +1,162 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the journal of the queue of ES."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+from cms.io import PriorityQueue
+from cms.service.esoperations import ESOperation
+from cms.service.queuejournal import QueueJournal
+from cmscommon.datetime import make_datetime
+
+
+class TestQueueJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "journal")
+        self.journal = QueueJournal(self.path, 1)
+        self.journal.load()
+        self.timestamp = make_datetime(1234567890)
+        self.operations = [
+            ESOperation(ESOperation.COMPILATION, 1, 2),
+            ESOperation(ESOperation.EVALUATION, 1, 2, "000"),
+            ESOperation(ESOperation.USER_TEST_COMPILATION, 3, 2),
+        ]
+        # The content of the queue, as held by ES.
+        self.entries = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_entries(self):
+        return self.entries
+
+    def reload(self, contest_id=1):
+        return QueueJournal(self.path, contest_id).load()
+
+    def test_empty(self):
+        self.assertEqual(([], None), self.reload())
+
+    def test_push_and_remove(self):
+        for operation in self.operations:
+            self.journal.record_push(
+                operation, PriorityQueue.PRIORITY_HIGH, self.timestamp)
+        self.journal.record_remove(self.operations[1])
+        self.journal.record_marks([None, 10], [None, 5])
+        self.journal.flush(self.get_entries)
+
+        operations, marks = self.reload()
+        self.assertEqual(
+            [(self.operations[0], PriorityQueue.PRIORITY_HIGH, self.timestamp),
+             (self.operations[2], PriorityQueue.PRIORITY_HIGH, self.timestamp)],
+            operations)
+        self.assertEqual(([None, 10], [None, 5]), marks)
+
+    def test_unflushed_records_lost(self):
+        self.journal.record_push(
+            self.operations[0], PriorityQueue.PRIORITY_HIGH, self.timestamp)
+        self.assertEqual(([], None), self.reload())
+
+    def test_truncated_record(self):
+        self.journal.record_push(
+            self.operations[0], PriorityQueue.PRIORITY_HIGH, self.timestamp)
+        self.journal.flush(self.get_entries)
+        with io.open(self.path, "at", encoding="utf-8") as journal:
+            journal.write('["+","evalua')
+
+        operations, unused_marks = self.reload()
+        self.assertEqual([self.operations[0]],
+                         [operation for operation, _, _ in operations])
+
+    def test_other_contest(self):
+        self.journal.record_push(
+            self.operations[0], PriorityQueue.PRIORITY_HIGH, self.timestamp)
+        self.journal.flush(self.get_entries)
+        self.assertEqual(([], None), self.reload(contest_id=2))
+
+    def test_compaction(self):
+        """The journal is rewritten from the queue when too long."""
+        for i in xrange(QueueJournal.MIN_COMPACTION_RECORDS):
+            operation = ESOperation(ESOperation.EVALUATION, 1, 2, "%d" % i)
+            self.journal.record_push(
+                operation, PriorityQueue.PRIORITY_LOW, self.timestamp)
+            self.journal.record_remove(operation)
+        self.journal.record_push(
+            self.operations[0], PriorityQueue.PRIORITY_HIGH, self.timestamp)
+        self.journal.record_marks([None, 10], [None, 5])
+        # The rewrite uses the content of the queue, not the records.
+        self.entries = [(self.operations[1], PriorityQueue.PRIORITY_HIGH,
+                         self.timestamp)]
+        self.journal.flush(self.get_entries)
+
+        with io.open(self.path, "rt", encoding="utf-8") as journal:
+            self.assertEqual(3, len(journal.readlines()))
+        operations, marks = self.reload()
+        self.assertEqual(self.entries, operations)
+        self.assertEqual(([None, 10], [None, 5]), marks)
+
+    def test_records_during_rewrite(self):
+        """The records buffered while rewriting are not lost."""
+        self.entries = [(operation, PriorityQueue.PRIORITY_HIGH,
+                         self.timestamp) for operation in self.operations]
+
+        def record(unused_seconds):
+            self.journal.record_remove(self.operations[0])
+            self.journal.flush(self.get_entries)
+
+        with patch.object(QueueJournal, "REWRITE_CHUNK_SIZE", 2), \
+                patch("cms.service.queuejournal.gevent.sleep",
+                      side_effect=record) as sleep:
+            self.journal.rewrite(self.entries)
+        self.assertEqual(2, sleep.call_count)
+
+        operations, unused_marks = self.reload()
+        self.assertEqual(self.entries[1:], operations)
+
+    def test_write_error(self):
+        """If a write fails, the journal is rewritten from the queue."""
+        self.journal.record_push(
+            self.operations[0], PriorityQueue.PRIORITY_HIGH, self.timestamp)
+        self.entries = [(self.operations[0], PriorityQueue.PRIORITY_HIGH,
+                         self.timestamp)]
+        journal_file = self.journal._file
+        self.journal._file = Mock()
+        self.journal._file.write.side_effect = IOError()
+        self.journal.flush(self.get_entries)
+        journal_file.close()
+
+        operations, unused_marks = self.reload()
+        self.assertEqual(self.entries, operations)
+        self.assertEqual([], self.journal._buffer)
+
+
+if __name__ == "__main__":
+    unittest.main()
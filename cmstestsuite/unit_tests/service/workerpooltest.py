@@ -0,0 +1,246 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the worker pool."""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+from datetime import timedelta
+from mock import Mock, patch
+
+from cms import ServiceCoord, config
+from cms.service.workerpool import WorkerPool
+from cmscommon.datetime import make_datetime
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    N_WORKERS = 4
+
+    def setUp(self):
+        super(TestWorkerPool, self).setUp()
+        self._affinity_scheduling = config.worker_affinity_scheduling
+        config.worker_affinity_scheduling = True
+        self.service = Mock()
+        self.service.connect_to.side_effect = \
+            lambda *args, **kwargs: Mock(connected=True)
+        self.pool = WorkerPool(self.service)
+        for shard in xrange(TestWorkerPool.N_WORKERS):
+            self.pool.add_worker(ServiceCoord("Worker", shard))
+
+    def tearDown(self):
+        config.worker_affinity_scheduling = self._affinity_scheduling
+        super(TestWorkerPool, self).tearDown()
+
+    def test_choose_worker_affinity(self):
+        """The worker that received the digests is chosen again."""
+        self.pool._remember_digests(2, {"a", "b"})
+        self.pool._remember_digests(3, {"a"})
+        self.assertEqual(2, self.pool._choose_worker({"a", "b", "c"}))
+
+    def test_choose_worker_only_inactive(self):
+        """Busy, disabled and disconnected workers are never chosen."""
+        self.pool._remember_digests(0, {"a"})
+        self.pool._remember_digests(1, {"a"})
+        self.pool._remember_digests(2, {"a"})
+        self.pool._add_operations(0, [])
+        self.pool.disable_worker(1)
+        self.pool._worker[2].connected = False
+        self.assertEqual(3, self.pool._choose_worker({"a"}))
+
+    def test_choose_worker_none_available(self):
+        for shard in xrange(TestWorkerPool.N_WORKERS):
+            self.pool.disable_worker(shard)
+        with self.assertRaises(LookupError):
+            self.pool._choose_worker({"a"})
+
+    def test_choose_worker_fairness(self):
+        """A worker passed over for too long is eventually chosen."""
+        self.pool._remember_digests(0, {"a"})
+        now = make_datetime()
+        with patch("cms.service.workerpool.make_datetime",
+                   side_effect=lambda: now):
+            for _ in xrange(10):
+                self.assertEqual(0, self.pool._choose_worker({"a"}))
+            now += WorkerPool.MAX_AFFINITY_WAIT
+            self.assertNotEqual(0, self.pool._choose_worker({"a"}))
+
+    def test_choose_worker_affinity_many_workers(self):
+        """Jobs sharing an executable keep going to the same worker,
+        while many others are idle.
+
+        """
+        for shard in xrange(TestWorkerPool.N_WORKERS, 16):
+            self.pool.add_worker(ServiceCoord("Worker", shard))
+        chosen = {"x": set(), "y": set()}
+        for i in xrange(20):
+            executable = "x" if i % 2 == 0 else "y"
+            digests = {executable, "input%d" % i}
+            shard = self.pool._choose_worker(digests)
+            self.pool._remember_digests(shard, digests)
+            chosen[executable].add(shard)
+        self.assertEqual(1, len(chosen["x"]))
+        self.assertEqual(1, len(chosen["y"]))
+
+    def test_choose_worker_no_affinity(self):
+        config.worker_affinity_scheduling = False
+        self.pool._remember_digests(0, {"a"})
+        chosen = set(self.pool._choose_worker({"a"}) for _ in xrange(100))
+        self.assertGreater(len(chosen), 1)
+
+    def test_remember_digests_bounded(self):
+        for i in xrange(WorkerPool.MAX_CACHED_DIGESTS + 10):
+            self.pool._remember_digests(0, {"%d" % i})
+        self.pool._remember_digests(0, {"0"})
+        cached_digests = self.pool._cached_digests[0]
+        self.assertEqual(WorkerPool.MAX_CACHED_DIGESTS, len(cached_digests))
+        self.assertIn("0", cached_digests)
+        self.assertNotIn("10", cached_digests)
+        self.assertIn("11", cached_digests)
+
+    def test_slots(self):
+        """Slots are separate workers sharing the Worker's cache."""
+        worker_slots = config.worker_slots
+        config.worker_slots = 2
+        try:
+            self.pool = WorkerPool(self.service)
+            for shard in xrange(2):
+                self.pool.add_worker(ServiceCoord("Worker", shard))
+            self.assertEqual(4, len(self.pool))
+            self.assertEqual((1, 0), self.pool.get_worker_shard_and_slot(2))
+            self.assertIs(self.pool._worker[2], self.pool._worker[3])
+
+            self.pool._remember_digests(3, {"a"})
+            self.assertIn(self.pool._choose_worker({"a"}), [2, 3])
+        finally:
+            config.worker_slots = worker_slots
+
+    def test_pipeline(self):
+        """Slots receive a second job group only when all are busy."""
+        pipeline_depth = config.worker_pipeline_depth
+        config.worker_pipeline_depth = 2
+        try:
+            self.pool = WorkerPool(self.service)
+            for shard in xrange(2):
+                self.pool.add_worker(ServiceCoord("Worker", shard))
+            self.assertEqual(4, len(self.pool))
+            self.assertEqual((1, 0), self.pool.get_worker_shard_and_slot(3))
+
+            self.pool._remember_digests(0, {"a"})
+            self.pool._add_operations(0, [])
+            # Worker 0 is busy, so worker 1 is chosen despite affinity.
+            self.assertIn(self.pool._choose_worker({"a"}), [2, 3])
+            self.pool._add_operations(2, [])
+            # Both are busy, so we queue on worker 0.
+            self.assertEqual(1, self.pool._choose_worker({"a"}))
+        finally:
+            config.worker_pipeline_depth = pipeline_depth
+
+    def test_usable_workers_count(self):
+        self.pool.disable_worker(0)
+        self.pool._worker[1].connected = False
+        self.assertEqual(TestWorkerPool.N_WORKERS - 2,
+                         self.pool.get_usable_workers_count())
+
+    def test_execution_time_after_previous_release(self):
+        """A queued job group starts when the previous one finishes."""
+        pipeline_depth = config.worker_pipeline_depth
+        config.worker_pipeline_depth = 2
+        try:
+            self.pool = WorkerPool(self.service)
+            self.pool.add_worker(ServiceCoord("Worker", 0))
+            self.assertIsNone(self.pool.get_execution_time(0))
+            self.pool._add_operations(0, [])
+            self.pool._add_operations(1, [])
+            self.pool._start_time[0] = make_datetime() - timedelta(seconds=20)
+            self.pool._start_time[1] = make_datetime() - timedelta(seconds=10)
+            self.assertGreaterEqual(self.pool.get_execution_time(0), 20)
+            # The second job group is waiting for the first.
+            self.assertEqual(0.0, self.pool.get_execution_time(1))
+            self.pool.release_worker(0)
+            self.assertLess(self.pool.get_execution_time(1), 5)
+        finally:
+            config.worker_pipeline_depth = pipeline_depth
+
+    def test_timeout_in_pipeline(self):
+        """A job group does not time out while waiting for the one
+        before it in the pipeline of the slot.
+
+        """
+        pipeline_depth = config.worker_pipeline_depth
+        config.worker_pipeline_depth = 2
+        try:
+            self.pool = WorkerPool(self.service)
+            self.pool.add_worker(ServiceCoord("Worker", 0))
+            self.pool._add_operations(0, [])
+            self.pool._add_operations(1, [])
+            now = make_datetime()
+            timeout = WorkerPool.WORKER_TIMEOUT
+            self.pool._start_time[0] = now - timeout * 3 / 2
+            self.pool._start_time[1] = now - timeout - timedelta(seconds=10)
+
+            # Only the first job group has been executing for too long.
+            self.assertEqual([], self.pool.check_timeouts())
+            self.assertEqual(WorkerPool.WORKER_DISABLED,
+                             self.pool._operations[0])
+            self.assertFalse(self.pool._schedule_disabling[1])
+            self.assertEqual(1, self.pool._worker[0].quit.call_count)
+        finally:
+            config.worker_pipeline_depth = pipeline_depth
+
+    def test_no_timeout_in_pipeline(self):
+        """A job group behind a long but healthy one is timed from
+        when the latter finishes.
+
+        """
+        pipeline_depth = config.worker_pipeline_depth
+        config.worker_pipeline_depth = 2
+        try:
+            self.pool = WorkerPool(self.service)
+            self.pool.add_worker(ServiceCoord("Worker", 0))
+            self.pool._add_operations(0, [])
+            self.pool._add_operations(1, [])
+            now = make_datetime()
+            timeout = WorkerPool.WORKER_TIMEOUT
+            self.pool._start_time[0] = now - timeout + timedelta(seconds=10)
+            self.pool._start_time[1] = now - timeout + timedelta(seconds=12)
+            with patch("cms.service.workerpool.make_datetime",
+                       return_value=now + timedelta(seconds=5)):
+                self.pool.release_worker(0)
+            # The second job group has been sent more than the
+            # timeout ago, but is executing only since 15 seconds.
+            with patch("cms.service.workerpool.make_datetime",
+                       return_value=now + timedelta(seconds=20)):
+                self.assertEqual([], self.pool.check_timeouts())
+            self.assertFalse(self.pool._schedule_disabling[1])
+            self.assertFalse(self.pool._worker[0].quit.called)
+        finally:
+            config.worker_pipeline_depth = pipeline_depth
+
+    def test_reconnection_forgets_digests(self):
+        self.pool._remember_digests(0, {"a"})
+        self.pool.on_worker_connected(ServiceCoord("Worker", 0))
+        self.assertEqual(0, len(self.pool._cached_digests[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
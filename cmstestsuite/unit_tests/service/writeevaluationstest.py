@@ -0,0 +1,114 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Contest Management System - http://cms-dev.github.io/
+# Copyright © 2016 Stefano Maggiolo <s.maggiolo@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the bulk writing of evaluations in EvaluationService,
+using a mocked session.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from mock import MagicMock, Mock, patch
+from sqlalchemy.exc import IntegrityError
+
+from cms.service.EvaluationService import EvaluationService, Result
+from cms.service.esoperations import ESOperation
+
+
+class TestWriteEvaluations(unittest.TestCase):
+
+    def setUp(self):
+        # The method does not use the state of the service.
+        self.service = EvaluationService.__new__(EvaluationService)
+        patcher = patch.object(self.service,
+                               "write_results_one_object_and_type")
+        self.write_one_by_one = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session = MagicMock()
+
+    @staticmethod
+    def new_evaluations(submission_id, codenames, compiled=True):
+        submission_result = Mock(submission_id=submission_id, dataset_id=1)
+        submission_result.compiled.return_value = compiled
+        operation_results = []
+        for codename in codenames:
+            job = Mock()
+            job.to_evaluation_row.return_value = {
+                "submission_id": submission_id, "dataset_id": 1,
+                "testcase_id": int(codename), "outcome": "1.0"}
+            operation_results.append(
+                (ESOperation(ESOperation.EVALUATION, submission_id, 1,
+                             codename),
+                 Result(job, True)))
+        return submission_result, operation_results
+
+    def test_bulk_insert(self):
+        """All evaluations are written with a single statement."""
+        evaluations = [self.new_evaluations(1, ["0", "1"]),
+                       self.new_evaluations(2, ["0"])]
+        self.service.write_evaluations(self.session, evaluations)
+        self.assertEqual(1, self.session.execute.call_count)
+        self.assertFalse(self.write_one_by_one.called)
+        # The ORM is told that the evaluations changed.
+        self.assertEqual(2, self.session.expire.call_count)
+        for submission_result, unused_operation_results in evaluations:
+            self.session.expire.assert_any_call(submission_result,
+                                                ["evaluations"])
+
+    def test_integrity_error(self):
+        """On integrity errors, evaluations are written one by one."""
+        self.session.execute.side_effect = \
+            IntegrityError("INSERT", {}, Exception())
+        evaluations = [self.new_evaluations(1, ["0", "1"]),
+                       self.new_evaluations(2, ["0"])]
+        self.service.write_evaluations(self.session, evaluations)
+        self.assertEqual(1, self.session.execute.call_count)
+        self.assertEqual(2, self.write_one_by_one.call_count)
+        for submission_result, operation_results in evaluations:
+            self.write_one_by_one.assert_any_call(
+                self.session, submission_result, operation_results)
+        self.assertFalse(self.session.expire.called)
+
+    def test_not_compiled(self):
+        """Evaluations of results whose compilation was invalidated
+        are dropped, and logged.
+
+        """
+        evaluations = [self.new_evaluations(1, ["0"], compiled=False),
+                       self.new_evaluations(2, ["0"])]
+        with patch("cms.service.EvaluationService.logger") as logger:
+            self.service.write_evaluations(self.session, evaluations)
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(1, self.session.execute.call_count)
+        self.session.expire.assert_called_once_with(evaluations[1][0],
+                                                    ["evaluations"])
+        evaluations[0][1][0][1].job.to_evaluation_row.assert_not_called()
+
+    def test_nothing_to_write(self):
+        evaluations = [self.new_evaluations(1, ["0"], compiled=False)]
+        self.service.write_evaluations(self.session, evaluations)
+        self.assertFalse(self.session.execute.called)
+
+
+if __name__ == "__main__":
+    unittest.main()